@@ -0,0 +1,87 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'starc-backend'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from api_project.database import Base
+from api_project.models import User, Document, DocumentHistory, DocumentHistoryHead
+from api_project.history import append_history, load_history
+
+def read_sample_text():
+    """Read sample text from file"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(script_dir, 'sample.txt'), 'r') as f:
+        return f.read()
+
+def build_versions(base_text, num_versions, pages=50):
+    """Simulate an editing session on a long document: each save changes one or two sentences"""
+    rng = random.Random(42)
+    sentences = [s.strip() + '.' for s in (base_text * pages).split('.') if s.strip()]
+    versions = []
+    for _ in range(num_versions):
+        for _ in range(rng.randint(1, 2)):
+            i = rng.randrange(len(sentences))
+            sentences[i] = sentences[i].replace(' the ', ' our ', 1) + ' Revised.'
+        versions.append(' '.join(sentences))
+    return versions
+
+def new_session():
+    engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    user = User(username="bench", email="bench@example.com", password="x")
+    db.add(user)
+    db.commit()
+    document = Document(title="Benchmark", user_id=user.id)
+    db.add(document)
+    db.commit()
+    return db, document.id
+
+def run_history_benchmark(num_versions=200):
+    versions = build_versions(read_sample_text(), num_versions)
+    print(f"\n{num_versions} versions of a {len(versions[0].encode('utf-8')) / 1024:.0f} KB document")
+
+    # Full copies, as history was stored before
+    db, doc_id = new_session()
+    start = time.time()
+    for content in versions:
+        db.add(DocumentHistory(document_id=doc_id, content=content, payload=None))
+        db.commit()
+    full_write = time.time() - start
+    full_bytes = sum(len(v.encode('utf-8')) for v in versions)
+    start = time.time()
+    full_rows = db.query(DocumentHistory).filter_by(document_id=doc_id).order_by(DocumentHistory.created_at.desc()).all()
+    [row.content for row in full_rows]
+    full_read = time.time() - start
+    db.close()
+
+    # Snapshots plus compressed deltas
+    db, doc_id = new_session()
+    start = time.time()
+    for content in versions:
+        append_history(db, doc_id, content)
+        db.commit()
+    delta_write = time.time() - start
+    delta_bytes = sum(len(row.payload) for row in db.query(DocumentHistory).filter_by(document_id=doc_id))
+    # The full latest version kept for the next save
+    delta_bytes += len(db.get(DocumentHistoryHead, doc_id).payload)
+    db.expire_all()
+    start = time.time()
+    history = load_history(db, doc_id)
+    delta_read = time.time() - start
+    assert [content for _, content in history] == versions
+    snapshots = sum(1 for entry, _ in history if entry.is_snapshot)
+    db.close()
+
+    print(f"{'':18}{'stored':>12}{'write':>10}{'read all':>10}")
+    print(f"{'full copies':18}{full_bytes / 1024:>9.0f} KB{full_write:>9.2f}s{full_read:>9.3f}s")
+    print(f"{'snapshot+delta':18}{delta_bytes / 1024:>9.0f} KB{delta_write:>9.2f}s{delta_read:>9.3f}s")
+    print(f"Storage reduced {full_bytes / delta_bytes:.0f}x ({snapshots} snapshots)")
+
+if __name__ == "__main__":
+    run_history_benchmark()
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'starc-backend'))
+
+from werkzeug.security import check_password_hash
+from api_project.passwords import PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS, hash_password, run_hashing
+
+TICK = 0.005
+
+async def measure_lag(stop):
+    """How late the event loop wakes a task that sleeps for TICK seconds"""
+    lags = []
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append(loop.time() - start - TICK)
+    return lags
+
+async def login_storm(verify, stored_hash, num_logins):
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(measure_lag(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(verify(stored_hash, "correct horse battery staple") for _ in range(num_logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    lags = await monitor
+    return elapsed, lags
+
+async def verify_on_loop(stored_hash, password):
+    """How login verified passwords before: the hash runs inside the coroutine"""
+    await asyncio.sleep(0)
+    return check_password_hash(stored_hash, password)
+
+async def verify_in_pool(stored_hash, password):
+    return await run_hashing(check_password_hash, stored_hash, password)
+
+def run_password_benchmark(num_logins=50):
+    stored_hash = hash_password("correct horse battery staple")
+    print(f"\n{num_logins} concurrent logins, {PASSWORD_HASH_METHOD}, {PASSWORD_HASH_WORKERS} hashing threads")
+    print(f"{'':20}{'total':>10}{'max lag':>12}{'p50 lag':>12}{'ticks':>8}")
+    for name, verify in (("on the event loop", verify_on_loop), ("hashing pool", verify_in_pool)):
+        elapsed, lags = asyncio.run(login_storm(verify, stored_hash, num_logins))
+        print(f"{name:20}{elapsed * 1000:>8.0f} ms{max(lags) * 1000:>9.1f} ms{statistics.median(lags) * 1000:>9.1f} ms{len(lags):>8}")
+
+if __name__ == "__main__":
+    run_password_benchmark()
@@ -0,0 +1,66 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'starc-backend'))
+
+from api_project.scoring import WEIGHTS_V1, compute_scores, pack_probabilities, score_distribution
+
+def build_sentence_scores(num_sentences):
+    """Random FinBERT-shaped probabilities for a long filing"""
+    rng = random.Random(42)
+    sentences = []
+    for _ in range(num_sentences):
+        tone = [rng.random() for _ in range(3)]
+        fls = [rng.random() for _ in range(3)]
+        sentences.append({
+            'tone': dict(zip(['Positive', 'Neutral', 'Negative'], [v / sum(tone) for v in tone])),
+            'fls': dict(zip(['Specific FLS', 'Non-specific FLS', 'Not FLS'], [v / sum(fls) for v in fls])),
+        })
+    return sentences
+
+def python_compute_scores(all_sentence_scores):
+    """The aggregation as it was written before vectorizing: one pass over the dicts per sum"""
+    sum_positives = sum(s['tone']['Positive'] for s in all_sentence_scores)
+    sum_neutrals = sum(s['tone']['Neutral'] for s in all_sentence_scores)
+    sum_negatives = sum(s['tone']['Negative'] for s in all_sentence_scores)
+    sum_specific_fls = sum(s['fls']['Specific FLS'] for s in all_sentence_scores)
+    sum_non_specific_fls = sum(s['fls']['Non-specific FLS'] for s in all_sentence_scores)
+    sentence_scores = [
+        (sum(WEIGHTS_V1[k] * v for k, v in s['tone'].items()) + sum(WEIGHTS_V1[k] * v for k, v in s['fls'].items())) / 2.0 * 100
+        for s in all_sentence_scores
+    ]
+    overall_score = sum(sentence_scores) / len(sentence_scores)
+    optimism = sum_positives / (sum_positives + sum_negatives) * 100
+    confidence = (sum_positives + sum_neutrals) / (sum_positives + sum_negatives + sum_neutrals) * 100
+    specific_fls = sum_specific_fls / (sum_specific_fls + sum_non_specific_fls) * 100
+    return [int(v * 100) / 100 for v in (overall_score, optimism, confidence, specific_fls)]
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def run_scoring_benchmark(num_sentences=10000, repeat=20):
+    sentences = build_sentence_scores(num_sentences)
+    packed = pack_probabilities(sentences)
+    print(f"\nAggregating {num_sentences} sentence scores (best of {repeat})")
+
+    python_time, python_result = best_of(lambda: python_compute_scores(sentences), repeat)
+    numpy_time, numpy_result = best_of(lambda: compute_scores(sentences), repeat)
+    packed_time, packed_result = best_of(lambda: compute_scores(packed), repeat)
+    distribution_time, distribution = best_of(lambda: score_distribution(packed), repeat)
+    assert python_result == numpy_result == packed_result
+
+    print(f"{'pure python':28}{python_time * 1000:>9.2f} ms")
+    print(f"{'numpy (pack + aggregate)':28}{numpy_time * 1000:>9.2f} ms{python_time / numpy_time:>8.1f}x")
+    print(f"{'numpy (already packed)':28}{packed_time * 1000:>9.2f} ms{python_time / packed_time:>8.1f}x")
+    print(f"{'distribution statistics':28}{distribution_time * 1000:>9.2f} ms")
+    print(f"Scores {numpy_result}, distribution {distribution}")
+
+if __name__ == "__main__":
+    run_scoring_benchmark()
@@ -8,6 +8,15 @@ from api_project.routes.auth_routes import auth_router
 from api_project.routes.documents import documents_router
 from api_project.routes.rewrites import rewrite_router
 from api_project.routes.search import search_router
+from api_project.history import compact_all_history, HISTORY_COMPACTION_INTERVAL
+from api_project.jobs import periodic_job
+from api_project.stats import reconcile_all_user_stats, STATS_RECONCILE_INTERVAL
+from api_project.pdf_extraction import shutdown_pdf_executor
+from api_project.metrics import MetricsMiddleware, metrics_response, mark_worker_stopped
+from api_project.timing import TimingMiddleware
+from api_project.profiling import ProfilingMiddleware, profiles_router
+from api_project.loop_watchdog import LoopWatchdogMiddleware, start_loop_watchdog, stop_loop_watchdog
+import asyncio
 import os
 from pydantic import BaseModel
 
@@ -41,10 +50,17 @@ def create_app():
         max_age=600,
     )
 
+    app.add_middleware(LoopWatchdogMiddleware)
+    app.add_middleware(ProfilingMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(TimingMiddleware)
+
     app.include_router(auth_router, prefix='/auth')
     app.include_router(documents_router, prefix='/docs')
     app.include_router(rewrite_router, prefix='/fix')
     app.include_router(search_router, prefix='/api')
+    app.include_router(profiles_router, prefix='/profiles', include_in_schema=False)
+    app.add_api_route('/metrics', metrics_response, methods=['GET'], include_in_schema=False)
 
     @app.exception_handler(AuthJWTException)
     def authjwt_exception_handler(request: Request, exc: AuthJWTException):
@@ -60,6 +76,20 @@ def create_app():
             content={"detail": "Token has expired or is invalid"}
         )
 
+    @app.on_event("startup")
+    async def start_background_jobs():
+        if HISTORY_COMPACTION_INTERVAL > 0:
+            asyncio.create_task(periodic_job(HISTORY_COMPACTION_INTERVAL, compact_all_history, 'history_compaction'))
+        if STATS_RECONCILE_INTERVAL > 0:
+            asyncio.create_task(periodic_job(STATS_RECONCILE_INTERVAL, reconcile_all_user_stats, 'stats_reconcile'))
+        start_loop_watchdog()
+
+    @app.on_event("shutdown")
+    def stop_pdf_workers():
+        stop_loop_watchdog()
+        shutdown_pdf_executor()
+        mark_worker_stopped()
+
     Base.metadata.create_all(bind=engine)
 
     return app
\ No newline at end of file
@@ -0,0 +1,192 @@
+"""
+Streaming export of all of a user's documents as a zip archive
+
+The archive holds documents.ndjson, one JSON record per document with its text, document and
+chunk scores and its full history, and optionally pdf/<document id>.pdf for every document.
+It is produced while it is sent: zipfile writes into a sink that the response drains after
+every few records, so nothing larger than one batch is held in memory.
+
+Documents are read through a server-side cursor (yield_per) in batches of EXPORT_BATCH_SIZE;
+chunks, scores and history are loaded with one query per table per batch. Fetching a batch
+and building its records run in a worker thread, so the event loop is free while the database
+is queried. PDFs are taken from the export cache where possible, and the rest of a batch is
+rendered concurrently in the PDF process pool.
+"""
+
+import asyncio
+import json
+import os
+import zipfile
+from collections import defaultdict
+from typing import AsyncIterator, BinaryIO, Iterator, List
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session, selectinload
+
+from api_project.models import Document, TextChunks, DocumentHistory
+from api_project.chunks import score_values, score_dict, aggregate_chunk_scores, document_text
+from api_project.history import decode_history
+from api_project.pdf_export import export_key, open_cached_export, render_export, iter_file
+
+# Documents loaded (and PDFs rendered) per round trip
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 50))
+
+# Buffered archive bytes that trigger sending a piece of the response
+_FLUSH_BYTES = 256 * 1024
+
+
+class _ZipSink:
+    '''Write-only file object that collects what zipfile writes until it is drained.'''
+
+    def __init__(self):
+        self._parts = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts = []
+        self.size = 0
+        return data
+
+
+def _document_batches(db: Session, user_id: int) -> Iterator[List]:
+    rows = db.execute(
+        select(Document.id, Document.title, Document.upload_date, Document.word_count, Document.version)
+        .where(Document.user_id == user_id)
+        .order_by(Document.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    for batch in rows.partitions():
+        yield batch
+
+
+async def _iter_batches(db: Session, user_id: int) -> AsyncIterator[List]:
+    '''_document_batches with every fetch from the cursor run in a worker thread.'''
+    batches = _document_batches(db, user_id)
+    try:
+        while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+            yield batch
+    finally:
+        batches.close()
+
+
+def _load_batch_chunks(db: Session, document_ids: List[int]) -> dict:
+    chunks = defaultdict(list)
+    for chunk in db.query(TextChunks)\
+            .options(selectinload(TextChunks.initial_score), selectinload(TextChunks.final_score))\
+            .filter(TextChunks.document_id.in_(document_ids))\
+            .order_by(TextChunks.document_id, TextChunks.position, TextChunks.id):
+        chunks[chunk.document_id].append(chunk)
+    return chunks
+
+
+def _load_batch_history(db: Session, document_ids: List[int]) -> dict:
+    entries = defaultdict(list)
+    for entry in db.query(DocumentHistory)\
+            .filter(DocumentHistory.document_id.in_(document_ids))\
+            .order_by(DocumentHistory.document_id, DocumentHistory.id):
+        entries[entry.document_id].append(entry)
+    return entries
+
+
+def _optional_scores(values):
+    return score_dict(values) if values else None
+
+
+def document_records(db: Session, batch: List) -> List[dict]:
+    '''Export records of one batch of document rows, in the same order.'''
+    document_ids = [document.id for document in batch]
+    chunks = _load_batch_chunks(db, document_ids)
+    history = _load_batch_history(db, document_ids)
+
+    records = []
+    for document in batch:
+        document_chunks = chunks.get(document.id, [])
+        entries = history.get(document.id, [])
+        contents = decode_history(entries)
+        records.append({
+            "id": document.id,
+            "title": document.title,
+            "upload_date": document.upload_date.isoformat() if document.upload_date else None,
+            "word_count": document.word_count,
+            "text": document_text(document_chunks),
+            "rewritten_text": document_text(document_chunks, rewritten=True),
+            "initial_scores": _optional_scores(aggregate_chunk_scores(document_chunks, initial=True)),
+            "final_scores": _optional_scores(aggregate_chunk_scores(document_chunks)),
+            "chunks": [{
+                "id": chunk.id,
+                "position": chunk.position,
+                "input_text": chunk.input_text_chunk,
+                "rewritten_text": chunk.rewritten_text,
+                "initial_score": score_dict(score_values(chunk.initial_score)) if chunk.initial_score else None,
+                "final_score": score_dict(score_values(chunk.final_score)) if chunk.final_score else None,
+            } for chunk in document_chunks],
+            "history": [{
+                "id": entry.id,
+                "created_at": entry.created_at.isoformat() if entry.created_at else None,
+                "content": contents[entry.id],
+            } for entry in entries],
+        })
+    return records
+
+
+async def _batch_pdfs(db: Session, batch: List) -> List[BinaryIO]:
+    '''Open the cached export of every document in a batch, rendering the missing ones concurrently.'''
+    keys = [export_key(document) for document in batch]
+    handles = await asyncio.gather(*(asyncio.to_thread(open_cached_export, key) for key in keys))
+    missing = [index for index, handle in enumerate(handles) if handle is None]
+    if missing:
+        chunks = await asyncio.to_thread(_load_batch_chunks, db, [batch[index].id for index in missing])
+        rendered = await asyncio.gather(*(
+            render_export(keys[index], batch[index].title, document_text(chunks.get(batch[index].id, [])))
+            for index in missing
+        ))
+        for index, handle in zip(missing, rendered):
+            handles[index] = handle
+    return list(handles)
+
+
+def _write_records(db: Session, batch: List, records: BinaryIO) -> None:
+    for record in document_records(db, batch):
+        records.write((json.dumps(record) + "\n").encode('utf-8'))
+
+
+async def export_archive(db: Session, user_id: int, include_pdfs: bool = False) -> AsyncIterator[bytes]:
+    '''Yield the zip archive of a user's documents piece by piece.'''
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('documents.ndjson', 'w', force_zip64=True) as records:
+            async for batch in _iter_batches(db, user_id):
+                await asyncio.to_thread(_write_records, db, batch, records)
+                if sink.size >= _FLUSH_BYTES:
+                    yield sink.drain()
+
+        if include_pdfs:
+            async for batch in _iter_batches(db, user_id):
+                handles = await _batch_pdfs(db, batch)
+                try:
+                    for document, handle in zip(batch, handles):
+                        # PDFs are compressed already
+                        info = zipfile.ZipInfo(f'pdf/{document.id}.pdf')
+                        if document.upload_date:
+                            info.date_time = document.upload_date.timetuple()[:6]
+                        info.compress_type = zipfile.ZIP_STORED
+                        with archive.open(info, 'w', force_zip64=True) as entry:
+                            for chunk in iter_file(handle):
+                                entry.write(chunk)
+                                if sink.size >= _FLUSH_BYTES:
+                                    yield sink.drain()
+                finally:
+                    for handle in handles:
+                        handle.close()
+
+    # The rest of the last entry and the central directory
+    yield sink.drain()
@@ -0,0 +1,358 @@
+"""
+Section/paragraph chunking of documents
+
+A document's text is stored as ordered TextChunks that are contiguous slices of the text,
+so ''.join() of the chunks gives back the document exactly. Chunks end at blank lines;
+short pieces such as headings are merged into the following paragraph and overlong
+paragraphs are broken at line or sentence ends.
+
+Scores are kept per chunk. Document-level scores are aggregated from the stored chunk
+scores, weighted by sentence count, so editing one paragraph only rescores that paragraph.
+The raw FinBERT probabilities of each sentence are stored alongside as SentenceScore rows,
+and within a rescored paragraph only the sentences that changed are sent to FinBERT.
+"""
+
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session, selectinload
+
+from api_project.models import Document, TextChunks, InitialScore, FinalScore, SentenceScore, content_hash
+from api_project.processing import split_sentences, sentence_spans, score_texts, TextScores
+from api_project.scoring import SCORING_VERSION
+
+# Pieces shorter than this (headings, one-line paragraphs) are merged into the next chunk
+MIN_CHUNK_CHARS = 200
+
+# Paragraphs longer than this are broken at line ends, then sentence ends
+MAX_CHUNK_CHARS = 2000
+
+_PARAGRAPH_END = re.compile(r'\r?\n[ \t]*\r?\n\s*')
+_LINE = re.compile(r'[^\n]*\n|[^\n]+$')
+_SENTENCE = re.compile(r'[^.!?]*[.!?]+\s*|[^.!?]+$')
+
+# Stored field for each position of a get_scoresSA result, in the order the frontend reads score arrays
+SCORE_FIELDS = ('score', 'optimism', 'forecast', 'confidence')
+
+
+def _split_long(piece: str) -> List[str]:
+    if len(piece) <= MAX_CHUNK_CHARS:
+        return [piece]
+
+    units = []
+    for line in _LINE.findall(piece):
+        units.extend(_SENTENCE.findall(line) if len(line) > MAX_CHUNK_CHARS else [line])
+
+    parts = []
+    current = ''
+    for unit in units:
+        if current and len(current) + len(unit) > MAX_CHUNK_CHARS:
+            parts.append(current)
+            current = ''
+        current += unit
+    if current:
+        parts.append(current)
+    return parts
+
+
+def split_into_chunks(text: str) -> List[str]:
+    '''
+    Split text into section/paragraph chunks. Each chunk keeps its trailing whitespace so
+    that ''.join(chunks) == text.
+    '''
+    pieces = []
+    start = 0
+    for match in _PARAGRAPH_END.finditer(text):
+        pieces.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+
+    chunks = []
+    buffer = ''
+    for piece in (part for piece in pieces for part in _split_long(piece)):
+        buffer += piece
+        if len(buffer.strip()) >= MIN_CHUNK_CHARS:
+            chunks.append(buffer)
+            buffer = ''
+    if buffer:
+        if chunks and len(buffer.strip()) < MIN_CHUNK_CHARS:
+            chunks[-1] += buffer
+        else:
+            chunks.append(buffer)
+
+    return chunks or [text]
+
+
+def keep_whitespace(original: str, new: str) -> str:
+    '''Carry a chunk's surrounding whitespace over to its replacement, so paragraph breaks survive rewrites.'''
+    leading = original[:len(original) - len(original.lstrip())]
+    trailing = original[len(original.rstrip()):]
+    return leading + new.strip() + trailing
+
+
+def load_chunks(db: Session, document_id: int, with_scores: bool = False) -> List[TextChunks]:
+    query = db.query(TextChunks).filter_by(document_id=document_id)
+    if with_scores:
+        query = query.options(selectinload(TextChunks.initial_score), selectinload(TextChunks.final_score))
+    return query.order_by(TextChunks.position, TextChunks.id).all()
+
+
+def document_text(chunks: Iterable[TextChunks], rewritten: bool = False) -> str:
+    return ''.join(chunk.rewritten_text if rewritten else chunk.input_text_chunk for chunk in chunks)
+
+
+def new_chunk(document_id: int, position: int, text: str) -> TextChunks:
+    return TextChunks(
+        document_id=document_id,
+        position=position,
+        input_text_chunk=text,
+        rewritten_text=text,
+        sentence_count=len(split_sentences(text))
+    )
+
+
+def score_values(score_row) -> List[float]:
+    '''Stored score row as a list in get_scoresSA order.'''
+    return [getattr(score_row, field) for field in SCORE_FIELDS]
+
+
+def score_dict(values: List[float]) -> dict:
+    return dict(zip(SCORE_FIELDS, values))
+
+
+def set_chunk_scores(chunk: TextChunks, values: List[float], initial: bool = False) -> None:
+    attribute = 'initial_score' if initial else 'final_score'
+    score_row = getattr(chunk, attribute)
+    if score_row is None:
+        score_row = (InitialScore if initial else FinalScore)()
+        setattr(chunk, attribute, score_row)
+    for field, value in zip(SCORE_FIELDS, values):
+        setattr(score_row, field, value)
+    score_row.scoring_version = SCORING_VERSION
+
+
+def sentence_rows(text: str, sentences: List[tuple]) -> List[dict]:
+    '''SentenceScore column values for a text's (start, end, raw probabilities or None) sentences.'''
+    rows = []
+    for position, (start, end, raw) in enumerate(sentences):
+        tone = raw['tone'] if raw else {}
+        fls = raw['fls'] if raw else {}
+        rows.append({
+            "position": position,
+            "start_offset": start,
+            "end_offset": end,
+            "text_hash": content_hash(text[start:end]),
+            "positive": tone.get('Positive'),
+            "neutral": tone.get('Neutral'),
+            "negative": tone.get('Negative'),
+            "specific_fls": fls.get('Specific FLS'),
+            "non_specific_fls": fls.get('Non-specific FLS'),
+            "not_fls": fls.get('Not FLS'),
+        })
+    return rows
+
+
+def raw_probabilities(sentence: SentenceScore) -> Optional[dict]:
+    '''A stored sentence's probabilities in the {'tone': ..., 'fls': ...} form FinBERT returns.'''
+    if sentence.positive is None:
+        return None
+    return {
+        'tone': {'Positive': sentence.positive, 'Neutral': sentence.neutral, 'Negative': sentence.negative},
+        'fls': {'Specific FLS': sentence.specific_fls, 'Non-specific FLS': sentence.non_specific_fls, 'Not FLS': sentence.not_fls},
+    }
+
+
+def set_sentence_scores(chunk: TextChunks, sentences: List[tuple]) -> None:
+    '''Replace the stored sentence probabilities of a chunk's rewritten text.'''
+    chunk.sentence_scores = [SentenceScore(**row) for row in sentence_rows(chunk.rewritten_text, sentences)]
+
+
+def find_sentence_scores_by_hashes(db: Session, text_hashes: Iterable[str]) -> Dict[str, dict]:
+    '''Raw probabilities of already scored sentences, keyed by sentence hash.'''
+    text_hashes = set(text_hashes)
+    if not text_hashes:
+        return {}
+
+    rows = db.query(SentenceScore)\
+        .filter(SentenceScore.text_hash.in_(text_hashes), SentenceScore.positive.isnot(None))\
+        .all()
+
+    found = {}
+    for row in rows:
+        found.setdefault(row.text_hash, raw_probabilities(row))
+    return found
+
+
+def combine_scores(scored: List[Tuple[List[float], int]]) -> Optional[List[float]]:
+    '''
+    Sentence-count weighted mean of per-chunk (score values, sentence count) pairs.
+    A single chunk's values are returned unchanged; None if there is nothing to combine.
+    '''
+    if not scored:
+        return None
+    if len(scored) == 1:
+        return list(scored[0][0])
+
+    total_weight = sum(weight for _, weight in scored)
+    return [
+        round(sum(values[i] * weight for values, weight in scored) / total_weight, 2)
+        for i in range(len(SCORE_FIELDS))
+    ]
+
+
+def aggregate_chunk_scores(chunks: List[TextChunks], initial: bool = False) -> Optional[List[float]]:
+    '''
+    Document-level scores from the stored chunk scores, weighted by each chunk's sentence count.
+    Returns None if no chunk has been scored.
+    '''
+    scored = [(chunk.initial_score if initial else chunk.final_score, max(chunk.sentence_count or 0, 1)) for chunk in chunks]
+    return combine_scores([(score_values(row), weight) for row, weight in scored if row is not None])
+
+
+def find_scores_by_hashes(db: Session, text_hashes: Iterable[str]) -> Dict[str, List[float]]:
+    '''
+    Scores of already stored chunks whose current text has the same hash, looked up through the
+    indexed hash. The final score is kept in step with the rewritten text (edits that reuse a
+    chunk row change its input text but not its initial score), so that is what is reused.
+    Only scores produced by the current formula are reused.
+    '''
+    text_hashes = set(text_hashes)
+    if not text_hashes:
+        return {}
+
+    rows = db.query(TextChunks.rewritten_text_hash, FinalScore)\
+        .join(FinalScore, FinalScore.text_chunk_id == TextChunks.id)\
+        .filter(TextChunks.rewritten_text_hash.in_(text_hashes), FinalScore.scoring_version == SCORING_VERSION)\
+        .all()
+
+    found = {}
+    for text_hash, score_row in rows:
+        found.setdefault(text_hash, score_values(score_row))
+    return found
+
+
+async def score_chunk_texts(db: Session, texts: Dict[str, str], known_sentences: Optional[Dict[str, dict]] = None) -> Dict[str, TextScores]:
+    '''
+    Score chunk texts keyed by their hash. Texts that were scored before reuse the stored
+    scores, with sentence probabilities looked up by sentence hash; the rest are scored in
+    one FinBERT dispatch, skipping sentences in known_sentences.
+    '''
+    known = find_scores_by_hashes(db, texts.keys())
+    to_score = {text_hash: text for text_hash, text in texts.items() if text_hash not in known}
+
+    results = {}
+    if to_score:
+        results.update(zip(to_score.keys(), await score_texts(list(to_score.values()), known_sentences)))
+
+    if known:
+        spans = {text_hash: sentence_spans(texts[text_hash]) for text_hash in known}
+        stored = find_sentence_scores_by_hashes(db, (
+            content_hash(texts[text_hash][start:end]) for text_hash in known for start, end in spans[text_hash]
+        ))
+        for text_hash, scores in known.items():
+            text = texts[text_hash]
+            sentences = [(start, end, stored.get(content_hash(text[start:end]))) for start, end in spans[text_hash]]
+            results[text_hash] = TextScores(scores, sentences)
+
+    return results
+
+
+async def score_new_chunks(db: Session, chunks: List[TextChunks], known_sentences: Optional[Dict[str, dict]] = None) -> None:
+    '''
+    Give new chunks their initial, final and sentence scores. Text that was scored before, or
+    repeats within the list, is not sent to FinBERT again; nor are sentences in known_sentences.
+    '''
+    scored = await score_chunk_texts(db, {chunk.input_text_hash: chunk.input_text_chunk for chunk in chunks}, known_sentences)
+
+    for chunk in chunks:
+        result = scored[chunk.input_text_hash]
+        set_chunk_scores(chunk, result.scores, initial=True)
+        set_chunk_scores(chunk, result.scores)
+        set_sentence_scores(chunk, result.sentences)
+
+
+def stored_sentence_scores(db: Session, texts: Iterable[str]) -> Dict[str, dict]:
+    '''
+    Stored probabilities for the sentences of texts, keyed by sentence text. Unchanged sentences
+    of an edited chunk still have their rows, so after a small edit only the new or changed
+    sentences are missing.
+    '''
+    sentences = {text[start:end] for text in texts for start, end in sentence_spans(text)}
+    hashes = {content_hash(sentence): sentence for sentence in sentences}
+    return {hashes[text_hash]: raw for text_hash, raw in find_sentence_scores_by_hashes(db, hashes.keys()).items()}
+
+
+async def rescore_chunks(db: Session, chunks: List[TextChunks], known_sentences: Optional[Dict[str, dict]] = None) -> None:
+    '''
+    Update the final scores of chunks whose rewritten text changed. Only sentences without stored
+    (or passed in known_sentences) probabilities are sent to FinBERT. Chunks without initial
+    scores get the same values.
+    '''
+    if not chunks:
+        return
+
+    texts = [chunk.rewritten_text for chunk in chunks]
+    known = {**stored_sentence_scores(db, texts), **(known_sentences or {})}
+    for chunk, result in zip(chunks, await score_texts(texts, known)):
+        store_rescored_text(chunk, result)
+
+
+async def score_unsaved_texts(db: Session, texts: List[str]) -> List[TextScores]:
+    '''
+    Score texts that are not stored as chunks yet (rewrite candidates, the first sections of an
+    upload) in one FinBERT dispatch, reusing stored sentence probabilities.
+    '''
+    return await score_texts(texts, stored_sentence_scores(db, texts))
+
+
+def store_rescored_text(chunk: TextChunks, result: TextScores) -> None:
+    '''Record the scores of a chunk's current rewritten text. Chunks without initial scores get the same values.'''
+    chunk.sentence_count = len(split_sentences(chunk.rewritten_text))
+    set_chunk_scores(chunk, result.scores)
+    set_sentence_scores(chunk, result.sentences)
+    if chunk.initial_score is None:
+        set_chunk_scores(chunk, result.scores, initial=True)
+
+
+def replace_document_text(db: Session, document: Document, chunks: List[TextChunks], text: str) -> Tuple[List[TextChunks], List[TextChunks]]:
+    '''
+    Re-chunk a document after its whole text was replaced, as the editor does on save.
+    Chunks whose text is unchanged keep their rows and scores; changed paragraphs reuse the
+    remaining rows in order (keeping their initial scores) and extra paragraphs get new rows.
+    Returns the document's chunks in order and the ones whose text changed and need rescoring.
+    '''
+    pieces = split_into_chunks(text)
+
+    unchanged = {}
+    for chunk in chunks:
+        unchanged.setdefault(chunk.rewritten_text_hash, []).append(chunk)
+
+    matched = []
+    for piece in pieces:
+        candidates = unchanged.get(content_hash(piece))
+        matched.append(candidates.pop(0) if candidates else None)
+
+    matched_ids = {chunk.id for chunk in matched if chunk is not None}
+    spare = [chunk for chunk in chunks if chunk.id not in matched_ids]
+
+    ordered = []
+    changed = []
+    for position, (piece, chunk) in enumerate(zip(pieces, matched)):
+        if chunk is None:
+            if spare:
+                chunk = spare.pop(0)
+            else:
+                chunk = TextChunks(document_id=document.id)
+                db.add(chunk)
+            chunk.sentence_count = len(split_sentences(piece))
+            changed.append(chunk)
+        chunk.position = position
+        chunk.input_text_chunk = piece
+        chunk.rewritten_text = piece
+        ordered.append(chunk)
+
+    for chunk in spare:
+        db.delete(chunk)
+
+    return ordered, changed
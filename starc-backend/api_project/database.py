@@ -1,7 +1,9 @@
 from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 import os
+from api_project.metrics import instrument_pool
 
 # Load environment variables from .env file
 from dotenv import load_dotenv
@@ -24,6 +26,8 @@ if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
 else:
     engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
+instrument_pool(engine)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 class Base(DeclarativeBase):
@@ -34,4 +38,20 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def upsert(db, model, values: dict, update, where=None):
+    '''
+    INSERT a row or, if one with the same primary key exists, UPDATE it in the same statement.
+    update (and the optional where, limiting which rows are updated) are called with the
+    `excluded` row, i.e. the values that were to be inserted. Works on PostgreSQL and SQLite.
+    The result's rowcount is 0 when an existing row was left alone.
+    '''
+    insert = postgresql.insert if db.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    statement = insert(model).values(**values)
+    statement = statement.on_conflict_do_update(
+        index_elements=[column.name for column in model.__table__.primary_key],
+        set_=update(statement.excluded),
+        where=where(statement.excluded) if where is not None else None
+    )
+    return db.execute(statement)
\ No newline at end of file
@@ -0,0 +1,201 @@
+"""
+Live editor sessions
+
+While a document is open in the editor, the client streams text patches over a WebSocket
+instead of re-uploading the whole document. The server keeps the current text in memory with
+the FinBERT probabilities of its sentences and of the document's stored sentences. After a
+short pause in typing (EDITOR_DEBOUNCE_SECONDS) only sentences without known probabilities are scored, and
+the sentence and aggregate scores are pushed back. The text is written to the database on an
+explicit save or once the client has been idle for EDITOR_IDLE_SAVE_SECONDS. A failed save is
+reported to the client and retried on the next save; if the document was deleted meanwhile the
+socket is closed with code 4404.
+
+Scores are computed per section/paragraph chunk and combined the same way as stored document
+scores, so what the editor shows matches what a save persists.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from api_project.chunks import split_into_chunks, combine_scores, score_dict
+from api_project.processing import score_texts
+from api_project.scoring import sentence_score, score_distribution
+
+logger = logging.getLogger(__name__)
+
+# Pause in patches before dirty sentences are scored
+EDITOR_DEBOUNCE_SECONDS = float(os.environ.get('EDITOR_DEBOUNCE_SECONDS', 0.75))
+
+# Unsaved changes are persisted after this long without a message from the client
+EDITOR_IDLE_SAVE_SECONDS = float(os.environ.get('EDITOR_IDLE_SAVE_SECONDS', 30))
+
+
+# Close code sent when the document no longer exists
+DOCUMENT_GONE_CLOSE_CODE = 4404
+
+
+class EditorMessageError(ValueError):
+    pass
+
+
+class EditorDocumentGone(Exception):
+    '''Raised by a save callback when the document was deleted during the session.'''
+
+
+class EditorSession:
+    '''
+    Server-held state of one open document: its current text, a revision counter bumped by
+    every patch, and sentence probabilities keyed by sentence text: the stored ones it was opened
+    with plus those of the last scored text.
+    '''
+
+    def __init__(self, text: str, known_sentences: Optional[Dict[str, dict]] = None):
+        self.text = text
+        self.revision = 0
+        self.saved_revision = 0
+        # Stored probabilities the session started with are kept for the whole session
+        self._stored_sentences = dict(known_sentences or {})
+        self.known_sentences = dict(self._stored_sentences)
+        self._score_lock = asyncio.Lock()
+
+    @property
+    def unsaved(self) -> bool:
+        return self.revision != self.saved_revision
+
+    def apply_patch(self, start: int, end: int, text: str) -> int:
+        '''Replace text[start:end] with text and return the new revision.'''
+        if not 0 <= start <= end <= len(self.text):
+            raise EditorMessageError(f"Patch range {start}-{end} is outside the document (length {len(self.text)})")
+        self.text = self.text[:start] + text + self.text[end:]
+        self.revision += 1
+        return self.revision
+
+    async def score(self) -> dict:
+        '''
+        Score the current text, sending only dirty sentences to FinBERT, and return the
+        message pushed to the client.
+        '''
+        async with self._score_lock:
+            revision = self.revision
+            text = self.text
+            chunks = split_into_chunks(text)
+            results = await score_texts(chunks, self.known_sentences)
+
+        sentences = []
+        raw_scores = []
+        chunk_scores = []
+        # Besides the stored ones, only sentences still in the text are kept, so a long
+        # session does not grow the cache
+        known_sentences = {}
+        offset = 0
+        for chunk, result in zip(chunks, results):
+            for start, end, raw in result.sentences:
+                if raw is not None:
+                    known_sentences.setdefault(chunk[start:end], raw)
+                raw_scores.append(raw)
+                sentences.append({
+                    "start": offset + start,
+                    "end": offset + end,
+                    "text": chunk[start:end],
+                    "score": round(sentence_score(raw), 2) if raw else None,
+                    "tone": raw['tone'] if raw else None,
+                    "fls": raw['fls'] if raw else None,
+                })
+            chunk_scores.append((result.scores, max(len(result.sentences), 1)))
+            offset += len(chunk)
+
+        self.known_sentences = {**self._stored_sentences, **known_sentences}
+        combined = combine_scores(chunk_scores)
+        return {
+            "type": "scores",
+            "revision": revision,
+            "sentences": sentences,
+            "scores": score_dict(combined) if combined else None,
+            "distribution": score_distribution(raw_scores),
+        }
+
+
+async def serve_editor(websocket: WebSocket, session: EditorSession, save: Callable[[str, Dict[str, dict]], Awaitable[dict]]) -> None:
+    '''
+    Run the message loop of an accepted editor WebSocket until the client disconnects.
+
+    Client messages: {"type": "patch", "start", "end", "text"} and {"type": "save"}.
+    Server messages: "state" once on connect (text plus scores), "scores" after each debounced
+    scoring pass, "saved" after persisting, and "error" for rejected messages and failed saves.
+    save(text, known_sentences) persists the text and returns the fields sent with "saved", or
+    raises EditorDocumentGone.
+    '''
+    tasks = set()
+    debounce = None
+
+    async def push_scores():
+        nonlocal debounce
+        await asyncio.sleep(EDITOR_DEBOUNCE_SECONDS)
+        # Patches arriving from here on schedule another pass instead of cancelling this one
+        debounce = None
+        await websocket.send_json(await session.score())
+
+    async def persist(notify: bool = True):
+        revision = session.revision
+        try:
+            result = await save(session.text, session.known_sentences)
+        except EditorDocumentGone:
+            raise
+        except Exception as e:
+            # The changes stay unsaved, so the next save or idle timeout tries again
+            logger.error(f"Live editor save failed: {str(e)}")
+            if notify:
+                await websocket.send_json({"type": "error", "revision": revision, "detail": "Could not save the document"})
+            return
+        session.saved_revision = revision
+        if notify:
+            await websocket.send_json({"type": "saved", "revision": revision, **result})
+
+    state = await session.score()
+    await websocket.send_json({**state, "type": "state", "text": session.text})
+
+    try:
+        while True:
+            try:
+                raw_message = await asyncio.wait_for(
+                    websocket.receive_text(), timeout=EDITOR_IDLE_SAVE_SECONDS if session.unsaved else None
+                )
+            except asyncio.TimeoutError:
+                await persist()
+                continue
+
+            try:
+                message = json.loads(raw_message)
+                kind = message.get("type")
+                if kind == "patch":
+                    session.apply_patch(int(message["start"]), int(message["end"]), str(message["text"]))
+                elif kind != "save":
+                    raise EditorMessageError(f"Unknown message type: {kind}")
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                await websocket.send_json({"type": "error", "revision": session.revision, "detail": str(e)})
+                continue
+
+            if kind == "patch":
+                if debounce is not None:
+                    debounce.cancel()
+                debounce = asyncio.create_task(push_scores())
+                tasks.add(debounce)
+                debounce.add_done_callback(tasks.discard)
+            else:
+                await persist()
+    except WebSocketDisconnect:
+        if session.unsaved:
+            try:
+                await persist(notify=False)
+            except EditorDocumentGone:
+                pass
+    except EditorDocumentGone:
+        await websocket.close(code=DOCUMENT_GONE_CLOSE_CODE, reason="Document not found")
+    finally:
+        for task in list(tasks):
+            task.cancel()
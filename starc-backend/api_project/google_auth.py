@@ -0,0 +1,122 @@
+"""
+Google ID token verification with cached signing certificates
+
+google.oauth2.id_token.verify_oauth2_token downloads Google's signing certificates with a
+blocking HTTP request on every call. Here the certificates are fetched asynchronously, kept in
+process for as long as the response's Cache-Control max-age allows (less its Age), and refreshed
+in the background once less than GOOGLE_CERTS_REFRESH_MARGIN seconds remain, so logins keep
+using the current set meanwhile. Concurrent logins after expiry share one fetch. A token signed
+with a key id that is not in the cached set triggers one immediate refresh, in case Google has
+rotated its keys early.
+
+A login then costs a local RSA signature check, which runs in a worker thread.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Dict, Optional
+
+import httpx
+from google.auth import jwt
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_CERTS_URL = os.environ.get('GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+
+# Seconds before expiry at which cached certificates are refreshed in the background
+GOOGLE_CERTS_REFRESH_MARGIN = float(os.environ.get('GOOGLE_CERTS_REFRESH_MARGIN', 300))
+
+# Lifetime assumed when the response carries no max-age
+GOOGLE_CERTS_DEFAULT_MAX_AGE = 3600
+
+# Tokens with unknown key ids trigger a refresh at most this often
+GOOGLE_CERTS_MIN_REFETCH_SECONDS = 60
+
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+_certs: Dict[str, str] = {}
+_expires_at = 0.0
+_refresh_at = 0.0
+_fetched_at = float('-inf')
+_fetch_lock = asyncio.Lock()
+_refresh_task: Optional[asyncio.Task] = None
+
+
+def _max_age(headers: httpx.Headers) -> float:
+    match = re.search(r'max-age=(\d+)', headers.get('cache-control', ''))
+    if not match:
+        return GOOGLE_CERTS_DEFAULT_MAX_AGE
+    return max(int(match.group(1)) - int(headers.get('age', 0) or 0), 0)
+
+
+async def _fetch_certs() -> Dict[str, str]:
+    global _certs, _expires_at, _refresh_at, _fetched_at
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.get(GOOGLE_CERTS_URL)
+        response.raise_for_status()
+    _certs = response.json()
+    lifetime = _max_age(response.headers)
+    _fetched_at = time.monotonic()
+    _expires_at = _fetched_at + lifetime
+    # Short-lived responses are refreshed halfway through instead
+    _refresh_at = _fetched_at + max(lifetime - GOOGLE_CERTS_REFRESH_MARGIN, lifetime / 2)
+    return _certs
+
+
+async def _refresh(force: bool = False) -> Dict[str, str]:
+    async with _fetch_lock:
+        now = time.monotonic()
+        # Another login may have refreshed the certificates while this one waited
+        if now >= _refresh_at:
+            return await _fetch_certs()
+        if force and now - _fetched_at >= GOOGLE_CERTS_MIN_REFETCH_SECONDS:
+            return await _fetch_certs()
+        return _certs
+
+
+async def _background_refresh() -> None:
+    try:
+        await _refresh()
+    except Exception as e:
+        logger.warning(f"Refreshing Google signing certificates failed: {str(e)}")
+
+
+async def google_certs(force_refresh: bool = False) -> Dict[str, str]:
+    '''Google's current signing certificates by key id, from the cache when still valid.'''
+    global _refresh_task
+    now = time.monotonic()
+    if force_refresh or not _certs or now >= _expires_at:
+        return await _refresh(force=force_refresh)
+    if now >= _refresh_at and (_refresh_task is None or _refresh_task.done()):
+        _refresh_task = asyncio.create_task(_background_refresh())
+    return _certs
+
+
+def clear_google_certs() -> None:
+    global _certs, _expires_at, _refresh_at, _fetched_at
+    _certs = {}
+    _expires_at = 0.0
+    _refresh_at = 0.0
+    _fetched_at = float('-inf')
+
+
+def _decode(token: str, certs: Dict[str, str], audience: Optional[str]) -> dict:
+    idinfo = jwt.decode(token, certs=certs, audience=audience)
+    if idinfo.get('iss') not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+    return idinfo
+
+
+async def verify_google_id_token(token: str, audience: Optional[str]) -> dict:
+    '''
+    Verify a Google ID token's signature, expiry, audience and issuer and return its claims.
+    Raises ValueError for an invalid token.
+    '''
+    certs = await google_certs()
+    key_id = jwt.decode_header(token).get('kid')
+    if key_id not in certs:
+        certs = await google_certs(force_refresh=True)
+    return await asyncio.to_thread(_decode, token, certs, audience)
@@ -0,0 +1,356 @@
+"""
+Compact storage for DocumentHistory
+
+Every saved version used to be a full copy of the document. Versions are now stored as
+periodic zlib-compressed snapshots with compressed segment diffs in between:
+
+    snapshot <- delta <- delta <- ... <- snapshot <- delta ...
+
+Each delta row points at the version it was diffed against through base_id, so any
+version can be rebuilt from the nearest snapshot before it. Rows written before this
+change still carry their text in `content` and are treated as uncompressed snapshots.
+
+The latest version of each document is also kept in full (compressed) in DocumentHistoryHead,
+so saving a new version diffs against it directly instead of replaying the chain.
+"""
+
+import json
+import logging
+import os
+import re
+import zlib
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from api_project.database import upsert
+from api_project.models import DocumentHistory, DocumentHistoryHead
+
+logger = logging.getLogger(__name__)
+
+# Longest run of deltas before a fresh snapshot is forced; bounds reconstruction cost
+SNAPSHOT_INTERVAL = 20
+
+# Versions newer than this are never thinned by compaction
+HISTORY_KEEP_ALL_DAYS = int(os.environ.get('HISTORY_KEEP_ALL_DAYS', 7))
+
+# Seconds between background compaction passes (0 disables the job, see jobs.py)
+HISTORY_COMPACTION_INTERVAL = int(os.environ.get('HISTORY_COMPACTION_INTERVAL', 6 * 60 * 60))
+
+# Sentence-sized segments ending at a terminator or newline, so ''.join() gives back the exact text
+_SEGMENT = re.compile(r'[^.!?\n]*[.!?\n]|[^.!?\n]+\Z')
+_TERMINATORS = '.!?\n'
+
+
+def _segments(text: str) -> List[str]:
+    return _SEGMENT.findall(text)
+
+
+def encode_snapshot(text: str) -> bytes:
+    return zlib.compress(text.encode('utf-8'))
+
+
+def decode_snapshot(payload: bytes) -> str:
+    return zlib.decompress(payload).decode('utf-8')
+
+
+def _common_prefix_length(a: str, b: str, limit: int) -> int:
+    # Binary search over slice comparisons, which run in C, instead of comparing character by character
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix_length(a: str, b: str, limit: int) -> int:
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _count_terminators(text: str, start: int, end: int) -> int:
+    return sum(text.count(terminator, start, end) for terminator in _TERMINATORS)
+
+
+def encode_delta(base: str, target: str) -> bytes:
+    '''
+    Diff target against base at sentence granularity.
+    The delta is a list where [i, j] copies base segments i..j and a string is inserted as is.
+    '''
+    # Edits are usually local, so the unchanged text before and after them is found by comparing
+    # characters and only the segments in between are split out and matched. A segment ends at
+    # each terminator, so the common parts are cut back to the terminators inside them.
+    common = _common_prefix_length(base, target, min(len(base), len(target)))
+    prefix_end = max(base.rfind(terminator, 0, common) for terminator in _TERMINATORS) + 1
+    prefix = _count_terminators(base, 0, prefix_end)
+
+    common = _common_suffix_length(base, target, min(len(base), len(target)) - prefix_end)
+    suffix_starts = [i + 1 for i in (base.find(terminator, len(base) - common) for terminator in _TERMINATORS) if i != -1]
+    base_end = min(suffix_starts) if suffix_starts else len(base)
+    target_end = base_end + len(target) - len(base)
+    suffix = _count_terminators(base, base_end, len(base))
+    if base_end < len(base) and base[-1] not in _TERMINATORS:
+        # Unterminated last segment
+        suffix += 1
+
+    base_segments = _segments(base[prefix_end:base_end])
+    target_segments = _segments(target[prefix_end:target_end])
+
+    ops = [[0, prefix]] if prefix else []
+    matcher = SequenceMatcher(None, base_segments, target_segments, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([prefix + i1, prefix + i2])
+        elif j2 > j1:
+            ops.append(''.join(target_segments[j1:j2]))
+    if suffix:
+        suffix_start = prefix + len(base_segments)
+        ops.append([suffix_start, suffix_start + suffix])
+
+    return zlib.compress(json.dumps(ops, separators=(',', ':')).encode('utf-8'))
+
+
+def _apply_delta_segments(base_segments: List[str], payload: bytes) -> List[str]:
+    '''
+    Apply a delta to the segments of its base and return the segments of the result, so a chain
+    of deltas is decoded without splitting every intermediate version into segments again.
+    '''
+    segments = []
+    for op in json.loads(zlib.decompress(payload)):
+        piece = _segments(op) if isinstance(op, str) else base_segments[op[0]:op[1]]
+        # Only a final segment can lack a terminator; text that follows it continues the same segment
+        if piece and segments and segments[-1][-1] not in _TERMINATORS:
+            segments[-1] += piece[0]
+            piece = piece[1:]
+        segments.extend(piece)
+    return segments
+
+
+def apply_delta(base: str, payload: bytes) -> str:
+    return ''.join(_apply_delta_segments(_segments(base), payload))
+
+
+def _encode_entry(entry: DocumentHistory, content: str, base: Optional[Tuple[int, str]], chain_length: int,
+                  snapshot: Optional[bytes] = None) -> int:
+    '''
+    Store content on entry as a delta against base (a history id and its content) when that is
+    worthwhile, otherwise as a snapshot. Returns the number of deltas since the last snapshot
+    including this entry.
+    '''
+    snapshot = snapshot or encode_snapshot(content)
+    entry.content = None
+    entry.content_size = len(content.encode('utf-8'))
+    entry.word_count = len(content.split())
+
+    if base is not None and chain_length + 1 < SNAPSHOT_INTERVAL:
+        base_id, base_content = base
+        delta = encode_delta(base_content, content)
+        if len(delta) < len(snapshot):
+            entry.payload = delta
+            entry.is_snapshot = False
+            entry.base_id = base_id
+            return chain_length + 1
+
+    entry.payload = snapshot
+    entry.is_snapshot = True
+    entry.base_id = None
+    return 0
+
+
+def decode_history(entries: List[DocumentHistory]) -> Dict[int, str]:
+    '''
+    Rebuild the text of a contiguous run of history rows (ordered by id) that starts at a snapshot.
+    Returns a mapping of history id to content.
+    '''
+    contents = {}
+    # Segments of the previous entry, which is the base of the next delta unless compaction left a gap
+    previous_id, previous_segments = None, None
+    for entry in entries:
+        segments = None
+        if entry.payload is None:
+            # Legacy row stored before compression was introduced
+            content = entry.content
+        elif entry.is_snapshot:
+            content = decode_snapshot(entry.payload)
+        else:
+            base_segments = previous_segments if entry.base_id == previous_id and previous_segments is not None \
+                else _segments(contents[entry.base_id])
+            segments = _apply_delta_segments(base_segments, entry.payload)
+            content = ''.join(segments)
+        contents[entry.id] = content
+        previous_id, previous_segments = entry.id, segments
+    return contents
+
+
+def _load_chain(db: Session, entry: DocumentHistory) -> List[DocumentHistory]:
+    '''Load the rows from the nearest snapshot up to and including entry.'''
+    snapshot_id = db.query(DocumentHistory.id).filter(
+        DocumentHistory.document_id == entry.document_id,
+        DocumentHistory.id <= entry.id,
+        DocumentHistory.is_snapshot.is_(True)
+    ).order_by(DocumentHistory.id.desc()).limit(1).scalar()
+
+    return db.query(DocumentHistory).filter(
+        DocumentHistory.document_id == entry.document_id,
+        DocumentHistory.id >= (snapshot_id or 0),
+        DocumentHistory.id <= entry.id
+    ).order_by(DocumentHistory.id).all()
+
+
+def load_version(db: Session, entry: DocumentHistory) -> str:
+    '''Reconstruct the content of a single history entry.'''
+    return decode_history(_load_chain(db, entry))[entry.id]
+
+
+def load_history(db: Session, document_id: int) -> List[Tuple[DocumentHistory, str]]:
+    '''Return every history entry of a document with its reconstructed content, oldest first.'''
+    entries = db.query(DocumentHistory).filter_by(document_id=document_id).order_by(DocumentHistory.id).all()
+    contents = decode_history(entries)
+    return [(entry, contents[entry.id]) for entry in entries]
+
+
+def _store_head(db: Session, document_id: int, history_id: int, chain_length: int, snapshot: bytes) -> None:
+    # A save that lost a race with a newer one must not move the head back
+    upsert(
+        db, DocumentHistoryHead,
+        dict(document_id=document_id, history_id=history_id, chain_length=chain_length, payload=snapshot),
+        update=lambda excluded: dict(history_id=excluded.history_id, chain_length=excluded.chain_length, payload=excluded.payload),
+        where=lambda excluded: DocumentHistoryHead.history_id <= excluded.history_id
+    )
+
+
+def _latest_version(db: Session, document_id: int) -> Optional[Tuple[int, str, int]]:
+    '''The id, content and chain length of a document's latest version, from its head row when that is current.'''
+    latest_id = db.query(DocumentHistory.id).filter_by(document_id=document_id)\
+        .order_by(DocumentHistory.id.desc()).limit(1).scalar()
+    if latest_id is None:
+        return None
+
+    head = db.query(DocumentHistoryHead.history_id, DocumentHistoryHead.chain_length, DocumentHistoryHead.payload)\
+        .filter_by(document_id=document_id).first()
+    if head is not None and head.history_id == latest_id:
+        return latest_id, decode_snapshot(head.payload), head.chain_length
+
+    # No head yet (versions saved before heads existed) or it lags a concurrent save: rebuild from the chain
+    chain = _load_chain(db, db.get(DocumentHistory, latest_id))
+    return latest_id, decode_history(chain)[latest_id], len(chain) - 1
+
+
+def append_history(db: Session, document_id: int, content: str) -> DocumentHistory:
+    '''
+    Add a new version to a document's history, diffed against the latest version.
+    The caller is responsible for committing.
+    '''
+    latest = _latest_version(db, document_id)
+    base = (latest[0], latest[1]) if latest is not None else None
+    chain_length = latest[2] if latest is not None else 0
+
+    snapshot = encode_snapshot(content)
+    new_history = DocumentHistory(document_id=document_id)
+    chain_length = _encode_entry(new_history, content, base, chain_length, snapshot)
+    db.add(new_history)
+    db.flush()
+    _store_head(db, document_id, new_history.id, chain_length, snapshot)
+    return new_history
+
+
+def _versions_to_keep(entries: List[DocumentHistory], cutoff: datetime) -> List[bool]:
+    '''
+    Keep every version newer than cutoff, and only the last version of each day before it.
+    '''
+    keep = []
+    for index, entry in enumerate(entries):
+        if entry.created_at is None or entry.created_at >= cutoff:
+            keep.append(True)
+            continue
+        following = entries[index + 1] if index + 1 < len(entries) else None
+        keep.append(following is None or following.created_at is None or following.created_at.date() != entry.created_at.date())
+    return keep
+
+
+def compact_document_history(db: Session, document_id: int, now: Optional[datetime] = None) -> int:
+    '''
+    Thin out old versions of a document and re-encode the retained rows so the delta chain stays valid.
+    Legacy uncompressed rows are converted along the way. Returns the number of rows removed.
+    '''
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=HISTORY_KEEP_ALL_DAYS)
+
+    entries = db.query(DocumentHistory).filter_by(document_id=document_id).order_by(DocumentHistory.id).all()
+    if not entries:
+        return 0
+
+    contents = decode_history(entries)
+    keep = _versions_to_keep(entries, cutoff)
+
+    # Versions saved since the entries were loaded may be deltas against a version that would be dropped
+    referenced = {
+        row[0] for row in db.query(DocumentHistory.base_id).filter(
+            DocumentHistory.document_id == document_id,
+            DocumentHistory.id > entries[-1].id,
+            DocumentHistory.base_id.isnot(None)
+        )
+    }
+    keep = [kept or entry.id in referenced for kept, entry in zip(keep, entries)]
+
+    # Rows before the first dropped or legacy row are already encoded against their retained predecessor
+    dirty_from = next(
+        (i for i, entry in enumerate(entries) if not keep[i] or entry.payload is None),
+        len(entries)
+    )
+    if dirty_from == len(entries):
+        return 0
+
+    removed = 0
+    previous = None
+    chain_length = 0
+    for index, entry in enumerate(entries):
+        if not keep[index]:
+            db.delete(entry)
+            removed += 1
+            continue
+
+        if index >= dirty_from:
+            base = (previous.id, contents[previous.id]) if previous is not None else None
+            chain_length = _encode_entry(entry, contents[entry.id], base, chain_length)
+        else:
+            chain_length = 0 if entry.is_snapshot else chain_length + 1
+        previous = entry
+
+    # Re-encoding may have moved snapshots, so the head's chain length changes with it
+    _store_head(db, document_id, previous.id, chain_length, encode_snapshot(contents[previous.id]))
+    db.commit()
+    return removed
+
+
+def compact_all_history(db: Session, now: Optional[datetime] = None) -> int:
+    '''Run compaction for every document that has versions old enough to thin or legacy rows to convert.'''
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=HISTORY_KEEP_ALL_DAYS)
+
+    document_ids = [
+        row[0] for row in db.query(DocumentHistory.document_id).filter(
+            (DocumentHistory.created_at < cutoff) | DocumentHistory.payload.is_(None)
+        ).distinct().all()
+    ]
+
+    removed = 0
+    for document_id in document_ids:
+        try:
+            removed += compact_document_history(db, document_id, now)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"History compaction failed for document {document_id}: {str(e)}")
+
+    return removed
@@ -0,0 +1,61 @@
+"""
+Helpers for conditional GET handling (ETag / If-None-Match)
+
+Document read endpoints derive their ETags from Document.version, which every write path
+bumps through bump_document_version, and from the scoring formula version, since a new formula
+changes the scores derived from stored sentence probabilities without any write. A matching
+If-None-Match can then be answered with a 304 from the documents row alone, without loading
+chunk text or scores.
+"""
+
+from typing import Dict, Optional
+from fastapi import Request, Response
+from sqlalchemy.orm import Session
+
+from api_project.models import Document
+from api_project.scoring import SCORING_VERSION
+
+
+def _strip_weak(tag: str) -> str:
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    '''
+    Check the request's If-None-Match header against etag using weak comparison (RFC 9110 13.1.2).
+    '''
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(_strip_weak(tag.strip()) == _strip_weak(etag) for tag in header.split(','))
+
+
+def cache_headers(etag: str, cache_control: str = 'private, no-cache') -> Dict[str, str]:
+    return {'ETag': etag, 'Cache-Control': cache_control}
+
+
+def document_etag(kind: str, document: Document) -> str:
+    return f'"{kind}-{document.id}-v{document.version}-s{SCORING_VERSION}"'
+
+
+def bump_document_version(db: Session, document_id: int) -> None:
+    '''Invalidate cached representations of a document. The caller is responsible for committing.'''
+    db.query(Document).filter(Document.id == document_id).update(
+        {Document.version: Document.version + 1}, synchronize_session=False
+    )
+
+
+def bump_document_versions(db: Session, document_ids) -> None:
+    '''bump_document_version for several documents in one statement.'''
+    if document_ids:
+        db.query(Document).filter(Document.id.in_(document_ids)).update(
+            {Document.version: Document.version + 1}, synchronize_session=False
+        )
+
+
+def not_modified(etag: str, cache_control: Optional[str] = None) -> Response:
+    if cache_control is None:
+        return Response(status_code=304, headers=cache_headers(etag))
+    return Response(status_code=304, headers=cache_headers(etag, cache_control))
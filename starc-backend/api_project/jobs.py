@@ -0,0 +1,59 @@
+"""
+Periodic background jobs
+
+The app's startup handlers run in every uvicorn worker, so a job started there would run once
+per worker. periodic_job wakes up every `interval` seconds in each worker, but a round only
+runs in the worker that claims it: claiming moves the job's JobRun.last_run forward in a single
+conditional upsert, which succeeds for one worker per interval. The job then runs in a worker
+thread with its own session, so the event loop stays free.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from api_project.database import SessionLocal, upsert
+from api_project.models import JobRun
+
+logger = logging.getLogger(__name__)
+
+# A round can be claimed once this fraction of the interval has passed, so a worker waking up a little early is not skipped
+CLAIM_SLACK = 0.9
+
+
+def claim_job_run(db: Session, name: str, interval: float, now: datetime = None) -> bool:
+    '''Record that this process runs the job now, unless another one did within the interval.'''
+    now = now or datetime.utcnow()
+    previous_round = now - timedelta(seconds=interval * CLAIM_SLACK)
+    claimed = upsert(
+        db, JobRun, dict(name=name, last_run=now),
+        update=lambda excluded: dict(last_run=excluded.last_run),
+        where=lambda excluded: JobRun.last_run <= previous_round
+    ).rowcount > 0
+    db.commit()
+    return claimed
+
+
+def _run_if_claimed(fn: Callable[[Session], int], name: str, interval: float):
+    db = SessionLocal()
+    try:
+        if not claim_job_run(db, name, interval):
+            return None
+        return fn(db)
+    finally:
+        db.close()
+
+
+async def periodic_job(interval: float, fn: Callable[[Session], int], name: str):
+    '''Run fn(db) every interval seconds in one worker at a time.'''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            result = await asyncio.to_thread(_run_if_claimed, fn, name, interval)
+            if result is not None:
+                logger.info(f"Job {name} finished: {result}")
+        except Exception as e:
+            logger.error(f"Job {name} failed: {str(e)}")
@@ -0,0 +1,135 @@
+"""
+Event-loop blocking detector
+
+Synchronous work inside an async route (an OpenAI call, a database query, PDF parsing, password
+hashing) stops the event loop and every other request with it. When LOOP_BLOCK_THRESHOLD_MS is
+set, a watchdog thread schedules a no-op callback on the loop every LOOP_WATCHDOG_INTERVAL_MS
+and measures how late it runs (event_loop_lag_seconds). If the callback has not run after the
+threshold, the loop counts as blocked: the watchdog captures the loop thread's stack at that
+moment and finds the request whose task is running. Once the loop recovers it counts the stall
+under that request's route (event_loop_blocked_total, event_loop_blocked_seconds_total) and
+logs one JSON line with the route, request id, duration and stack to the
+api_project.loop_watchdog logger. Stalls outside any request are labelled "background".
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional, Tuple
+
+from api_project.metrics import LOOP_BLOCKED, LOOP_BLOCKED_SECONDS, LOOP_LAG
+from api_project.timing import request_id
+
+logger = logging.getLogger(__name__)
+
+# Loop stalls longer than this are reported (0 disables the watchdog)
+LOOP_BLOCK_THRESHOLD_MS = float(os.environ.get('LOOP_BLOCK_THRESHOLD_MS', 0))
+
+LOOP_WATCHDOG_INTERVAL_MS = float(os.environ.get('LOOP_WATCHDOG_INTERVAL_MS', 100))
+
+# Task of each request being handled -> (its ASGI scope, its request id)
+_requests: Dict[asyncio.Task, Tuple[dict, Optional[str]]] = {}
+_watchdog: Optional['LoopWatchdog'] = None
+
+
+def _route(scope: dict) -> str:
+    # The router stores the matched route in the scope, so its template is known once routing ran
+    route = scope.get('route')
+    return f"{scope['method']} {route.path if route is not None else scope['path']}"
+
+
+class LoopWatchdog(threading.Thread):
+    '''Measures how late the event loop runs callbacks and reports stalls longer than the threshold.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, loop_thread_id: int, threshold: float, interval: float):
+        super().__init__(name='loop-watchdog', daemon=True)
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+        self.threshold = threshold
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            ran = threading.Event()
+            scheduled = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(ran.set)
+            except RuntimeError:
+                # The loop has been closed
+                return
+            if not ran.wait(self.threshold):
+                blocker = self.capture()
+                while not ran.wait(self.interval):
+                    if self._stop_event.is_set():
+                        return
+                self.report(time.monotonic() - scheduled, *blocker)
+            LOOP_LAG.observe(time.monotonic() - scheduled)
+
+    def capture(self) -> Tuple[str, Optional[str], list]:
+        '''The route, request id and stack of whatever is running on the loop right now.'''
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = traceback.format_stack(frame) if frame is not None else []
+        task = asyncio.current_task(self.loop)
+        request = _requests.get(task) if task is not None else None
+        if request is None:
+            return 'background', None, stack
+        scope, current_id = request
+        return _route(scope), current_id, stack
+
+    def report(self, seconds: float, route: str, current_id: Optional[str], stack: list) -> None:
+        LOOP_BLOCKED.labels(route).inc()
+        LOOP_BLOCKED_SECONDS.labels(route).inc(seconds)
+        logger.warning(json.dumps({
+            "event": "event_loop_blocked",
+            "route": route,
+            "request_id": current_id,
+            "blocked_ms": round(seconds * 1000, 1),
+            "stack": [line.rstrip() for line in stack],
+        }))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def start_loop_watchdog() -> None:
+    '''Start watching the running event loop. Does nothing unless LOOP_BLOCK_THRESHOLD_MS is set.'''
+    global _watchdog
+    if _watchdog is None and LOOP_BLOCK_THRESHOLD_MS > 0:
+        _watchdog = LoopWatchdog(
+            asyncio.get_running_loop(), threading.get_ident(),
+            LOOP_BLOCK_THRESHOLD_MS / 1000, LOOP_WATCHDOG_INTERVAL_MS / 1000,
+        )
+        _watchdog.start()
+
+
+def stop_loop_watchdog() -> None:
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+        _watchdog = None
+
+
+class LoopWatchdogMiddleware:
+    '''ASGI middleware letting the watchdog attribute a stall to the request whose task caused it.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or _watchdog is None:
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        _requests[task] = (scope, request_id.get())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _requests.pop(task, None)
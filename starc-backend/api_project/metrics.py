@@ -0,0 +1,167 @@
+"""
+Prometheus metrics
+
+GET /metrics serves, in the Prometheus text format:
+- per-route request counts, latency histograms and in-flight requests (MetricsMiddleware),
+- FinBERT dispatch latency, sentences per dispatch and failed sentence requests,
+- OpenAI call latency, token usage and errors per operation,
+- database connection pool capacity and checked-out connections,
+- finbert_warm_until_timestamp_seconds: FinBERT instances count as warm until then,
+- event loop lag and stalls per route, when the loop watchdog is enabled (loop_watchdog.py).
+
+With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the
+workers before they start (the Procfile does). Each worker then writes its values there and
+every scrape, whichever worker answers it, reports the sum over all workers.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+from sqlalchemy import event
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Match
+
+from api_project.timing import span
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests handled', ['method', 'route', 'status'])
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time until the response was fully sent', ['method', 'route'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'HTTP requests being handled', ['method', 'route'], multiprocess_mode='livesum',
+)
+
+FINBERT_LATENCY = Histogram(
+    'finbert_dispatch_duration_seconds', 'Time for one round of concurrent FinBERT requests',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 40, 60),
+)
+FINBERT_BATCH_SIZE = Histogram(
+    'finbert_dispatch_sentences', 'Sentences sent in one round of FinBERT requests', buckets=(1, 2, 5, 10, 20, 30, 40),
+)
+FINBERT_ERRORS = Counter('finbert_errors_total', 'FinBERT requests that returned no scores', ['kind'])
+FINBERT_WARMUPS = Counter('finbert_warmups_total', 'FinBERT warmup rounds', ['outcome'])
+FINBERT_WARM_UNTIL = Gauge(
+    'finbert_warm_until_timestamp_seconds', 'Unix time until which FinBERT instances count as warm',
+    multiprocess_mode='max',
+)
+
+OPENAI_LATENCY = Histogram(
+    'openai_request_duration_seconds', 'OpenAI chat completion latency', ['operation'],
+    buckets=(0.25, 0.5, 1, 2, 5, 10, 20, 40, 60),
+)
+OPENAI_TOKENS = Counter('openai_tokens_total', 'OpenAI tokens used', ['operation', 'kind'])
+OPENAI_ERRORS = Counter('openai_errors_total', 'Failed OpenAI requests', ['operation'])
+
+DB_POOL_SIZE = Gauge('db_pool_size', 'Connections the pool keeps open', multiprocess_mode='livesum')
+DB_POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Connections currently in use', multiprocess_mode='livesum')
+
+LOOP_LAG = Histogram(
+    'event_loop_lag_seconds', 'How late the event loop ran a scheduled callback',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_BLOCKED = Counter('event_loop_blocked_total', 'Event loop stalls longer than the threshold', ['route'])
+LOOP_BLOCKED_SECONDS = Counter('event_loop_blocked_seconds', 'Time the event loop spent stalled', ['route'])
+
+
+@contextmanager
+def track_openai(operation: str):
+    '''Time an OpenAI request (also as a span of the current request) and count it as failed if it raises.'''
+    start = time.perf_counter()
+    try:
+        with span(f'openai_{operation}'):
+            yield
+    except Exception:
+        OPENAI_ERRORS.labels(operation).inc()
+        raise
+    finally:
+        OPENAI_LATENCY.labels(operation).observe(time.perf_counter() - start)
+
+
+def record_openai_usage(operation: str, response) -> None:
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        OPENAI_TOKENS.labels(operation, 'prompt').inc(usage.prompt_tokens or 0)
+        OPENAI_TOKENS.labels(operation, 'completion').inc(usage.completion_tokens or 0)
+
+
+def instrument_pool(engine) -> None:
+    '''Keep the pool gauges of an engine up to date through pool events.'''
+    size = getattr(engine.pool, 'size', None)
+    if callable(size):
+        DB_POOL_SIZE.inc(size())
+    event.listen(engine, 'checkout', lambda *args: DB_POOL_CHECKED_OUT.inc())
+    event.listen(engine, 'checkin', lambda *args: DB_POOL_CHECKED_OUT.dec())
+
+
+def _route_template(app, scope) -> str:
+    # Labels use the path template, e.g. /docs/{doc_id}, so ids do not create new series
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    '''ASGI middleware recording request counts, latency and in-flight requests per route.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method = scope['method']
+        route = _route_template(scope['app'], scope)
+        status = 500
+        in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+        start = time.perf_counter()
+        finished = False
+
+        def finish():
+            # Recorded once, when the last body chunk is sent: background tasks run after that
+            nonlocal finished
+            if not finished:
+                finished = True
+                REQUEST_LATENCY.labels(method, route).observe(time.perf_counter() - start)
+                REQUESTS.labels(method, route, str(status)).inc()
+                in_progress.dec()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                finish()
+
+        in_progress.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The app failed or never sent a complete response
+            finish()
+
+def metrics_response(request: Request) -> Response:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+def mark_worker_stopped() -> None:
+    '''Drop this worker's live gauges from the aggregate when it shuts down.'''
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
@@ -10,11 +10,17 @@ Ensure relations are now updated to reflect this change
 Text Chunk allows flexibility incase subsections of a text need to be rewritten
 """
 
+import hashlib
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, Boolean, Index
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, Boolean, Index, LargeBinary
+from sqlalchemy.orm import relationship, backref, validates
 from .database import Base
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from .passwords import hash_password
+
+def content_hash(text):
+    '''SHA-256 hex digest used to index and compare large text columns without touching the text itself.'''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest() if text is not None else None
 
 # Create user with username, password, email connected to all their docs
 class User(Base):
@@ -30,16 +36,27 @@ class User(Base):
     email = Column(String, nullable=False)
     is_oauth_user = Column(Boolean, default=False)
     documents = relationship('Document', backref='user', lazy=True, cascade="all, delete-orphan")
+    stats = relationship('UserStats', backref='user', uselist=False, cascade="all, delete-orphan")
 
-    # Set and check for password using Werkzeug functions.
+    # Set and check for password using Werkzeug functions. Async routes use api_project.passwords instead.
     def set_password(self, password):
-        self.password = generate_password_hash(password)
+        self.password = hash_password(password)
 
     def check_password(self, password):
         if self.is_oauth_user:
             return False
         return check_password_hash(self.password, password)
 
+# Dashboard counters kept up to date by the routes that change them (see stats.py), so /docs/user/stats is a single read.
+class UserStats(Base):
+    __tablename__ = 'user_stats'
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    total_documents = Column(Integer, default=0, nullable=False)
+    total_rewrites = Column(Integer, default=0, nullable=False)
+    last_activity = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 # Store basic document details.
 class Document(Base):
     __tablename__ = 'documents'
@@ -59,26 +76,50 @@ class Document(Base):
     upload_date = Column(DateTime, default=datetime.utcnow)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     word_count = Column(Integer, default=0, nullable=False)
+    # Bumped on every write that changes what the read endpoints return; used for ETags
+    version = Column(Integer, default=1, nullable=False)
     text_chunks = relationship('TextChunks', backref='document', lazy=True, cascade="all, delete-orphan")
     history = relationship('DocumentHistory', backref='document', lazy=True, cascade="all, delete-orphan")
+    history_head = relationship('DocumentHistoryHead', uselist=False, lazy=True, cascade="all, delete-orphan")
     suggestions = relationship("Suggestion", back_populates="document", cascade="all, delete-orphan")
 
 # Store a complete piece of text associated with each doc. By segregating docs and its text, we can allow for rewrite and scoring process for a subsection of an entire docs text is an extension feature than rewriting the entire doc.
 class TextChunks(Base):
     __tablename__ = 'text_chunks'
     __table_args__ = (
-        # Index for document lookups
-        Index('idx_doc_chunks', 'document_id'),
-        # Index for text search if needed
-        Index('idx_input_text', 'input_text_chunk'),
+        # Index for loading a document's chunks in order
+        Index('idx_doc_chunks', 'document_id', 'position'),
+        # Equality and dedupe lookups go through the hashes; a btree over the full text
+        # breaks on Postgres once an entry exceeds ~2.7KB
+        Index('idx_input_text_hash', 'input_text_hash'),
+        Index('idx_rewritten_text_hash', 'rewritten_text_hash'),
     )
 
     id = Column(Integer, primary_key=True, index=True)
     input_text_chunk = Column(Text, nullable=False)
     rewritten_text = Column(Text, nullable=False)
+    # Kept in sync by the validators below (set them explicitly for bulk inserts)
+    input_text_hash = Column(String(64), nullable=False)
+    rewritten_text_hash = Column(String(64), nullable=False)
     document_id = Column(Integer, ForeignKey('documents.id', ondelete='CASCADE'), nullable=False)
+    # Order of the chunk within its document; the document text is the chunks joined in this order
+    position = Column(Integer, nullable=False, default=0)
+    # Weight of the chunk when aggregating document-level scores
+    sentence_count = Column(Integer, nullable=False, default=1)
     initial_score = relationship('InitialScore', backref='text_chunk', uselist=False, cascade="all, delete-orphan")
     final_score = relationship('FinalScore', backref='text_chunk', uselist=False, cascade="all, delete-orphan")
+    sentence_scores = relationship('SentenceScore', backref='text_chunk', lazy=True, cascade="all, delete-orphan",
+                                   order_by='SentenceScore.position')
+
+    @validates('input_text_chunk')
+    def _hash_input_text(self, key, value):
+        self.input_text_hash = content_hash(value)
+        return value
+
+    @validates('rewritten_text')
+    def _hash_rewritten_text(self, key, value):
+        self.rewritten_text_hash = content_hash(value)
+        return value
 
 class DocumentHistory(Base):
     __tablename__ = 'document_history'
@@ -88,9 +129,34 @@ class DocumentHistory(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     document_id = Column(Integer, ForeignKey('documents.id', ondelete='CASCADE'), nullable=False)
-    content = Column(Text, nullable=False)
+    # Only set on rows saved before history compression; newer rows keep their text in payload
+    content = Column(Text, nullable=True)
+    # zlib-compressed full text for snapshots, compressed diff against base_id otherwise (see history.py)
+    payload = Column(LargeBinary, nullable=True)
+    is_snapshot = Column(Boolean, default=True, nullable=False)
+    base_id = Column(Integer, nullable=True)
+    content_size = Column(Integer, default=0, nullable=False)
+    word_count = Column(Integer, default=0, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+# Latest history version of a document in full, so a save can diff against it without replaying the chain
+class DocumentHistoryHead(Base):
+    __tablename__ = 'document_history_heads'
+
+    document_id = Column(Integer, ForeignKey('documents.id', ondelete='CASCADE'), primary_key=True)
+    history_id = Column(Integer, nullable=False)
+    # Deltas since the last snapshot up to and including history_id
+    chain_length = Column(Integer, default=0, nullable=False)
+    # zlib-compressed text of history_id
+    payload = Column(LargeBinary, nullable=False)
+
+# Last run of each periodic job (see jobs.py), shared by all workers
+class JobRun(Base):
+    __tablename__ = 'job_runs'
+
+    name = Column(String(64), primary_key=True)
+    last_run = Column(DateTime, nullable=False)
+
 # Store scores for original text.
 class InitialScore(Base):
     __tablename__ = 'initial_scores'
@@ -104,6 +170,8 @@ class InitialScore(Base):
     optimism = Column(Float, nullable=False)
     forecast = Column(Float, nullable=False)
     confidence = Column(Float, nullable=False)
+    # Version of the scoring formula (scoring.py) that produced the values
+    scoring_version = Column(Integer, nullable=False, default=1)
     text_chunk_id = Column(Integer, ForeignKey('text_chunks.id', ondelete='CASCADE'), nullable=False)
 
 # Store scores for rewritten text.
@@ -119,7 +187,34 @@ class FinalScore(Base):
     optimism = Column(Float, nullable=False)
     forecast = Column(Float, nullable=False)
     confidence = Column(Float, nullable=False)
+    # Version of the scoring formula (scoring.py) that produced the values
+    scoring_version = Column(Integer, nullable=False, default=1)
+    text_chunk_id = Column(Integer, ForeignKey('text_chunks.id', ondelete='CASCADE'), nullable=False)
+
+class SentenceScore(Base):
+    '''Raw FinBERT probabilities of one sentence of a chunk's rewritten text, stored when the chunk is scored.'''
+    __tablename__ = 'sentence_scores'
+    __table_args__ = (
+        # Index for loading a chunk's sentences in order
+        Index('idx_chunk_sentences', 'text_chunk_id', 'position'),
+        # Index for reusing the probabilities of an already scored sentence
+        Index('idx_sentence_text_hash', 'text_hash'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
     text_chunk_id = Column(Integer, ForeignKey('text_chunks.id', ondelete='CASCADE'), nullable=False)
+    position = Column(Integer, nullable=False)
+    # Character offsets of the sentence within the chunk's rewritten text
+    start_offset = Column(Integer, nullable=False)
+    end_offset = Column(Integer, nullable=False)
+    text_hash = Column(String(64), nullable=False)
+    # Probabilities are null when the sentence could not be scored
+    positive = Column(Float)
+    neutral = Column(Float)
+    negative = Column(Float)
+    specific_fls = Column(Float)
+    non_specific_fls = Column(Float)
+    not_fls = Column(Float)
 
 class Suggestion(Base):
     __tablename__ = "suggestions"
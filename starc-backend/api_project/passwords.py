@@ -0,0 +1,69 @@
+"""
+Password hashing off the event loop
+
+werkzeug's password hashes are deliberately slow (tens of milliseconds for scrypt), so async
+routes hash and verify in a small dedicated thread pool instead of on the event loop. hashlib
+releases the GIL while it works, so other requests keep being served, and at most
+PASSWORD_HASH_WORKERS hashes run at once however many logins arrive together.
+
+Hashes record the method they were made with. When PASSWORD_HASH_METHOD changes, a user's
+hash is replaced with one using the new parameters on their next successful login.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+
+# Hashes computed at once by this process
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(PASSWORD_HASH_WORKERS, 1), thread_name_prefix='password-hash')
+    return _executor
+
+
+def hash_password(password: str) -> str:
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+@lru_cache(maxsize=None)
+def _method_prefix(method: str) -> str:
+    # werkzeug fills in default parameters, so compare against what it actually records
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def needs_rehash(password_hash: str) -> bool:
+    '''Whether a stored hash was made with other parameters than PASSWORD_HASH_METHOD.'''
+    return password_hash.split('$', 1)[0] != _method_prefix(PASSWORD_HASH_METHOD)
+
+
+async def run_hashing(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), function, *args)
+
+
+async def authenticate(db: Session, user, password: str) -> bool:
+    '''
+    Check a user's login password in the hashing pool. On success, a hash made with outdated
+    parameters is replaced and committed.
+    '''
+    if user.is_oauth_user:
+        return False
+    if not await run_hashing(check_password_hash, user.password, password):
+        return False
+    if await run_hashing(needs_rehash, user.password):
+        user.password = await run_hashing(hash_password, password)
+        db.commit()
+    return True
@@ -0,0 +1,96 @@
+"""
+Cache of extracted PDF text keyed by the uploaded file's content hash
+
+The same filing is often uploaded many times (by different users, after a delete, from a
+shared draft). The SHA-256 of the upload is computed while it is spooled to disk, and the
+extracted text is kept zlib-compressed in PDF_CACHE_DIR under that hash, so a repeat upload
+skips parsing entirely. The directory is bounded by PDF_CACHE_MAX_BYTES with least recently
+used eviction: a hit refreshes the file's modification time and the oldest files are removed
+first. Files are written atomically, so several API processes can share the directory.
+"""
+
+import logging
+import os
+import tempfile
+import zlib
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'starc-pdf-cache'))
+
+# Total size of cached entries on disk (0 disables the cache)
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+_SUFFIX = '.txt.z'
+
+
+def _entry_path(content_hash: str) -> str:
+    return os.path.join(PDF_CACHE_DIR, content_hash + _SUFFIX)
+
+
+def cached_pdf_text(content_hash: str) -> Optional[str]:
+    '''Extracted text of a previously uploaded PDF with this content hash, or None.'''
+    if PDF_CACHE_MAX_BYTES <= 0:
+        return None
+    path = _entry_path(content_hash)
+    try:
+        with open(path, 'rb') as f:
+            text = zlib.decompress(f.read()).decode('utf-8')
+        # Mark as recently used
+        os.utime(path)
+        return text
+    except FileNotFoundError:
+        return None
+    except (OSError, zlib.error, UnicodeDecodeError) as e:
+        logger.warning(f"Dropping unreadable PDF cache entry {content_hash}: {str(e)}")
+        _remove(path)
+        return None
+
+
+def store_pdf_text(content_hash: str, text: str) -> None:
+    '''Cache the extracted text of a PDF, then evict least recently used entries over the size limit.'''
+    if PDF_CACHE_MAX_BYTES <= 0:
+        return
+    try:
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=PDF_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(zlib.compress(text.encode('utf-8')))
+        os.replace(tmp_path, _entry_path(content_hash))
+        evict_lru(PDF_CACHE_DIR, _SUFFIX, PDF_CACHE_MAX_BYTES)
+    except OSError as e:
+        logger.warning(f"Could not cache extracted PDF text: {str(e)}")
+
+
+def evict_lru(directory: str, suffix: str, max_bytes: int) -> int:
+    '''
+    Remove the least recently used files ending in suffix from directory until they fit max_bytes.
+    Returns the number removed. Readers mark a file as used by refreshing its modification time.
+    '''
+    entries = []
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            if entry.name.endswith(suffix):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        _remove(path)
+        total -= size
+        removed += 1
+    return removed
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
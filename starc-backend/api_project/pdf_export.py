@@ -0,0 +1,127 @@
+"""
+Rendering documents as PDF for download
+
+Documents are laid out with a platypus document template, so long texts flow over as many
+pages as they need: blank lines separate paragraphs, paragraphs split across page breaks and
+every page carries a page number. Rendering is CPU-bound and runs in the PDF process pool; a
+render interrupted by a pool recycle (see pdf_extraction.py) is retried once in the new pool.
+
+Rendered files are cached in PDF_EXPORT_CACHE_DIR under a hash of the document id and version
+(every write bumps the version), bounded by PDF_EXPORT_CACHE_MAX_BYTES with least recently used
+eviction. Downloads stream from the cached file, so repeating one renders nothing.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
+from typing import BinaryIO, Iterator, Optional
+from xml.sax.saxutils import escape
+
+from reportlab.lib.pagesizes import LETTER
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import Paragraph, SimpleDocTemplate
+
+from api_project.models import Document
+from api_project.pdf_cache import evict_lru
+from api_project.pdf_extraction import get_pdf_executor
+
+logger = logging.getLogger(__name__)
+
+PDF_EXPORT_CACHE_DIR = os.environ.get('PDF_EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'starc-pdf-export'))
+
+# Total size of cached exports on disk (0 disables the cache)
+PDF_EXPORT_CACHE_MAX_BYTES = int(os.environ.get('PDF_EXPORT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Bump when the layout changes so exports rendered by an older layout are not served
+RENDERER_VERSION = 1
+
+_SUFFIX = '.pdf'
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def export_key(document: Document) -> str:
+    return hashlib.sha256(f"{document.id}:{document.version}:{RENDERER_VERSION}".encode('utf-8')).hexdigest()
+
+
+def _number_page(canvas, doc):
+    canvas.saveState()
+    canvas.setFont('Helvetica', 9)
+    canvas.drawCentredString(doc.pagesize[0] / 2, 36, str(doc.page))
+    canvas.restoreState()
+
+
+def render_document_pdf(title: str, text: str) -> bytes:
+    '''Lay out a document's text over as many LETTER pages as it needs. Runs in a worker process.'''
+    styles = getSampleStyleSheet()
+    story = [Paragraph(escape(title), styles["Heading1"])]
+    for paragraph in text.split("\n\n"):
+        if paragraph.strip():
+            story.append(Paragraph(escape(paragraph.strip()).replace("\n", "<br/>"), styles["Normal"]))
+
+    buffer = io.BytesIO()
+    template = SimpleDocTemplate(
+        buffer, pagesize=LETTER, title=title,
+        leftMargin=72, rightMargin=72, topMargin=72, bottomMargin=72,
+    )
+    template.build(story, onFirstPage=_number_page, onLaterPages=_number_page)
+    return buffer.getvalue()
+
+
+def open_cached_export(key: str) -> Optional[BinaryIO]:
+    '''Open a cached export for reading, or return None.'''
+    if PDF_EXPORT_CACHE_MAX_BYTES <= 0:
+        return None
+    path = os.path.join(PDF_EXPORT_CACHE_DIR, key + _SUFFIX)
+    try:
+        handle = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    # Mark as recently used; an open handle stays readable even if the file is evicted meanwhile
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return handle
+
+
+def store_export(key: str, pdf: bytes) -> BinaryIO:
+    '''Cache a rendered export and return it opened for reading (in memory if it cannot be cached).'''
+    if PDF_EXPORT_CACHE_MAX_BYTES <= 0:
+        return io.BytesIO(pdf)
+    try:
+        os.makedirs(PDF_EXPORT_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=PDF_EXPORT_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf)
+        path = os.path.join(PDF_EXPORT_CACHE_DIR, key + _SUFFIX)
+        os.replace(tmp_path, path)
+        handle = open(path, 'rb')
+        evict_lru(PDF_EXPORT_CACHE_DIR, _SUFFIX, PDF_EXPORT_CACHE_MAX_BYTES)
+        return handle
+    except OSError as e:
+        logger.warning(f"Could not cache PDF export: {str(e)}")
+        return io.BytesIO(pdf)
+
+
+async def render_export(key: str, title: str, text: str) -> BinaryIO:
+    '''Render a document in the PDF process pool and cache the result. Raises BrokenProcessPool if the retry is interrupted too.'''
+    loop = asyncio.get_running_loop()
+    try:
+        pdf = await loop.run_in_executor(get_pdf_executor(), render_document_pdf, title, text)
+    except BrokenProcessPool:
+        # Another request's timeout recycled the pool while this render was using it
+        pdf = await loop.run_in_executor(get_pdf_executor(), render_document_pdf, title, text)
+    return await asyncio.to_thread(store_export, key, pdf)
+
+
+def iter_file(handle: BinaryIO) -> Iterator[bytes]:
+    '''Stream an open file in chunks and close it afterwards.'''
+    try:
+        while chunk := handle.read(_STREAM_CHUNK_SIZE):
+            yield chunk
+    finally:
+        handle.close()
@@ -0,0 +1,168 @@
+"""
+PDF text extraction off the event loop
+
+pypdf parsing is CPU-bound, so it runs in a bounded process pool rather than inside the request
+coroutine. An upload is first spooled to a temporary file (enforcing PDF_MAX_BYTES and hashing its
+bytes for api_project.pdf_cache); the page
+count is checked against PDF_MAX_PAGES, and ranges of PAGES_PER_TASK pages are then extracted
+by the pool's workers in parallel. iter_pdf_text yields the ranges in page order as soon as each
+one (and every range before it) is done, so callers can start scoring the first sections while
+later pages are still being parsed. The whole extraction is bounded by PDF_EXTRACTION_TIMEOUT;
+a task still running when it expires cannot be cancelled, so the pool is recycled: new work goes
+to a fresh pool and the old pool's workers are terminated. Workers are started by a forkserver,
+so they do not inherit the API process's threads, sockets or database connections.
+
+Page texts are collected in lists and joined once; the result is the same text as reading the
+pages one by one, each followed by a newline.
+"""
+
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, NamedTuple, Optional
+
+from fastapi import UploadFile
+from pypdf import PdfReader
+
+# Largest accepted upload
+PDF_MAX_BYTES = int(os.environ.get('PDF_MAX_BYTES', 50 * 1024 * 1024))
+
+# Documents with more pages are rejected before any text is extracted
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', 1000))
+
+# Seconds allowed for extracting one document
+PDF_EXTRACTION_TIMEOUT = float(os.environ.get('PDF_EXTRACTION_TIMEOUT', 120))
+
+# Worker processes shared by all requests (0 extracts in a thread of the API process instead)
+PDF_EXTRACTION_WORKERS = int(os.environ.get('PDF_EXTRACTION_WORKERS', min(4, os.cpu_count() or 1)))
+
+# Pages extracted by one worker task
+PAGES_PER_TASK = 20
+
+_UPLOAD_READ_SIZE = 1024 * 1024
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+class SpooledUpload(NamedTuple):
+    path: str
+    content_hash: str
+    size: int
+
+
+class PdfExtractionError(Exception):
+    '''A PDF was rejected by a limit; the message is meant for the client.'''
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def get_pdf_executor() -> Optional[ProcessPoolExecutor]:
+    '''Process pool shared by PDF extraction and export, or None to use the default thread pool.'''
+    global _executor
+    if _executor is None and PDF_EXTRACTION_WORKERS > 0:
+        _executor = ProcessPoolExecutor(max_workers=PDF_EXTRACTION_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+    return _executor
+
+
+def recycle_pdf_executor(executor: Optional[ProcessPoolExecutor]) -> None:
+    '''
+    Replace a pool whose workers may be stuck on a timed-out task and terminate those workers.
+    Other tasks still running in it fail with BrokenProcessPool. Does nothing for the thread pool.
+    '''
+    global _executor
+    if executor is None:
+        return
+    if _executor is executor:
+        _executor = None
+    # ProcessPoolExecutor has no public way to stop a running task before Python 3.14
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+def shutdown_pdf_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _page_count(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def _extract_pages(path: str, start: int, end: int) -> str:
+    # Runs in a worker process; each task opens the file itself so only the path is pickled
+    reader = PdfReader(path)
+    return ''.join([reader.pages[i].extract_text() + "\n" for i in range(start, end)])
+
+
+@asynccontextmanager
+async def spooled_upload(upload: UploadFile) -> AsyncIterator[SpooledUpload]:
+    '''
+    Copy an uploaded file to a temporary file in chunks, enforcing PDF_MAX_BYTES, and yield its
+    path with the SHA-256 of its bytes (computed while copying). The file is removed afterwards.
+    '''
+    handle = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+    try:
+        size = 0
+        digest = hashlib.sha256()
+        with handle:
+            while chunk := await upload.read(_UPLOAD_READ_SIZE):
+                size += len(chunk)
+                if size > PDF_MAX_BYTES:
+                    raise PdfExtractionError(f"PDF file is larger than {PDF_MAX_BYTES // (1024 * 1024)} MB", status_code=413)
+                digest.update(chunk)
+                handle.write(chunk)
+        yield SpooledUpload(handle.name, digest.hexdigest(), size)
+    finally:
+        os.unlink(handle.name)
+
+
+async def iter_pdf_text(path: str) -> AsyncIterator[str]:
+    '''
+    Yield the text of consecutive page ranges in page order while later ranges are still being
+    extracted. Raises PdfExtractionError if the page limit or the time budget is exceeded.
+    '''
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PDF_EXTRACTION_TIMEOUT
+    executor = get_pdf_executor()
+
+    async def within_budget(future):
+        try:
+            return await asyncio.wait_for(future, timeout=max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            recycle_pdf_executor(executor)
+            raise PdfExtractionError("PDF text extraction timed out", status_code=408)
+        except BrokenProcessPool:
+            # Another request's timeout recycled the pool while this one was using it
+            raise PdfExtractionError("PDF text extraction was interrupted, please try again", status_code=503)
+
+    page_count = await within_budget(loop.run_in_executor(executor, _page_count, path))
+    if page_count > PDF_MAX_PAGES:
+        raise PdfExtractionError(f"PDF has {page_count} pages; at most {PDF_MAX_PAGES} are supported")
+
+    futures = [
+        loop.run_in_executor(executor, _extract_pages, path, start, min(start + PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, PAGES_PER_TASK)
+    ]
+    try:
+        for future in futures:
+            yield await within_budget(future)
+    finally:
+        # Ranges that have not started are dropped if the caller stops early or the budget runs out
+        for future in futures:
+            future.cancel()
+
+
+async def extract_pdf_text(path: str) -> str:
+    '''Text of every page of the PDF at path, each page followed by a newline.'''
+    return ''.join([part async for part in iter_pdf_text(path)])
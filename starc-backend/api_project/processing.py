@@ -2,17 +2,26 @@ import requests
 import json
 import os
 import aiohttp
-from openai import OpenAI
+from collections import namedtuple
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 import time
 from urllib.parse import urlencode
 import asyncio
 from datetime import datetime
+from api_project.scoring import DEFAULT_SCORES, compute_scores
+from api_project.timing import span
+from api_project.metrics import (
+    FINBERT_LATENCY, FINBERT_BATCH_SIZE, FINBERT_ERRORS, FINBERT_WARMUPS, FINBERT_WARM_UNTIL,
+    track_openai, record_openai_usage,
+)
 
 load_dotenv()
 
 model_name = os.getenv('StarcAI_Rewrite_Model', 'gpt-4.5-preview')
 client = OpenAI(api_key= os.getenv('StarcAI_API_KEY'))
+# Used by jobs that issue many LLM calls concurrently from the event loop
+async_client = AsyncOpenAI(api_key=os.getenv('StarcAI_API_KEY'))
 
 # Google API Key for function calls
 gc_virtual_api_key = os.environ.get("GOOGLE_CLOUD_API_KEY")
@@ -27,6 +36,7 @@ class WarmupManager:
     def update_activity_time(self):
         """Update the last activity time to now"""
         self.last_activity_time = time.time()
+        FINBERT_WARM_UNTIL.set(self.last_activity_time + self.WARMUP_INTERVAL)
 
     async def validate_response(self, response):
         """Validate response format and content"""
@@ -91,9 +101,12 @@ class WarmupManager:
             print(f"Warmup completed: {successful_warmups}/{self.MAX_INSTANCES} instances warmed successfully")
             
             if successful_warmups > 0:
+                FINBERT_WARMUPS.labels('success').inc()
                 self.last_activity_time = current_time
+                FINBERT_WARM_UNTIL.set(current_time + self.WARMUP_INTERVAL)
                 return True
             else:
+                FINBERT_WARMUPS.labels('failure').inc()
                 print("All warmups failed - check response validation logs above")
                 return False
 
@@ -116,45 +129,49 @@ SYSTEM_PROMPT = (
     "Do not repeat back the user prompt or mention explicitly wording that makes you appear an AI bot like 'as an AI agent' or 'is there anything else I can assist you with' etc."
 )
 
-def rewrite_text_with_prompt(original_text: str, prompt: str):
+async def rewrite_text_with_prompt(original_text: str, prompt: str):
     '''
     Rewrite the given text based on the provided prompt.
     '''
     
-    response = client.chat.completions.create(
-        # model="gpt-4o",
-        
-        # allows for using custom GPT model that we finetuned on investor relations data from S&P 500 companies
-        model=model_name,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": f"Please rewrite the following text to {prompt}: {original_text}"}
-        ],        
-        max_tokens=500,
-        temperature=0.5,
-    )
-    
+    with track_openai('rewrite'):
+        response = await async_client.chat.completions.create(
+            # model="gpt-4o",
+
+            # allows for using custom GPT model that we finetuned on investor relations data from S&P 500 companies
+            model=model_name,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": f"Please rewrite the following text to {prompt}: {original_text}"}
+            ],
+            max_tokens=500,
+            temperature=0.5,
+        )
+    record_openai_usage('rewrite', response)
+
     rewritten_text = response.choices[0].message.content.strip()
     return rewritten_text
 
-def generate_sentence_suggestions(text):
+async def generate_sentence_suggestions(text):
     '''
     Generate sentence suggestions for the given text.
-    Not being used for now.
+    Returns a list of {'original': ..., 'suggested': ...} dicts (empty if the reply is not valid JSON).
     '''
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        max_tokens=500,
-        temperature=0.2,
-        response_format={ "type": "json_object" },
-        messages=[
-            {"role": "system", "content": """You are a writer. You are given a text and your job is to generate 
+    with track_openai('suggestions'):
+        response = await async_client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            max_tokens=500,
+            temperature=0.2,
+            response_format={ "type": "json_object" },
+            messages=[
+                {"role": "system", "content": """You are a writer. You are given a text and your job is to generate 
              sentence-by-sentence suggestions. The suggestions should be in JSON format, with each entry containing 
              'original' and 'suggested' keys, and all suggestions should be contained in an array."""},
-            {"role": "user", "content": text}
-        ]
-    )
-    
+                {"role": "user", "content": text}
+            ]
+        )
+    record_openai_usage('suggestions', response)
+
     content = response.choices[0].message.content
     
     try:
@@ -165,11 +182,38 @@ def generate_sentence_suggestions(text):
     
     return suggestions
   
-async def get_scoresSA(text):
+# Aggregated scores of one text plus each sentence's (start, end, raw probabilities or None)
+TextScores = namedtuple('TextScores', ['scores', 'sentences'])
+
+def sentence_spans(text):
     '''
-    Get sentiment and FLS scores for the given text.
-    Returns a list containing [overall_score, optimism, confidence, specific_fls (trustworthy)].
+    Character offsets (start, end) of the sentences split_sentences returns.
+    '''
+    spans = []
+    start = 0
+    for part in text.split('.'):
+        stripped = part.strip()
+        if stripped:
+            offset = start + len(part) - len(part.lstrip())
+            spans.append((offset, offset + len(stripped)))
+        start += len(part) + 1
+    return spans
+
+def split_sentences(text):
+    '''
+    Simple sentence splitting used for FinBERT scoring.
+    '''
+    return [text[start:end] for start, end in sentence_spans(text)]
+
+async def fetch_sentence_scores(sentences):
     '''
+    Score sentences with FinBERT, fanned out over the warm instances.
+    Returns a list aligned with sentences holding each sentence's raw {'tone': ..., 'fls': ...}
+    probabilities, or None where the request for that sentence failed.
+    '''
+    if not sentences:
+        return []
+
     base_url = 'https://finbert-merged-351460998552.us-central1.run.app'
     params = {'apikey': gc_virtual_api_key}
     url_SA = f'{base_url}?{urlencode(params)}'
@@ -179,31 +223,21 @@ async def get_scoresSA(text):
         'Authorization': f'bearer {os.getenv("GOOGLE_CLOUD_TOKEN")}',
         'X-Goog-Api-Key': gc_virtual_api_key
     }
-    
-    # Simple sentence splitting
-    sentences = [s.strip() for s in text.split('.') if s.strip()]
-    
-    if not sentences:
-        return [0.33, 0.33, 0.34, 0.33]
 
     # Try to warm up instances, but proceed even if warmup fails
-    warmup_success = await warmup_manager.warmup_all_instances()
+    with span('finbert_warmup'):
+        warmup_success = await warmup_manager.warmup_all_instances()
     if not warmup_success:
         print("Warning: Proceeding with scoring despite warmup failure")
     
-    all_sentence_scores = []
+    all_sentence_scores = [None] * len(sentences)
     
-    # Process sentences in chunks of up to 20 (10 instances * 2 sentences per instance)
+    # Process sentences in chunks of up to 40 (20 instances * 2 sentences per instance)
     for i in range(0, len(sentences), warmup_manager.MAX_INSTANCES * 2):
-        chunk = sentences[i:min(i + warmup_manager.MAX_INSTANCES * 2, len(sentences))]
+        chunk_end = min(i + warmup_manager.MAX_INSTANCES * 2, len(sentences))
         
-        # Group sentences into pairs for each instance
-        sentence_pairs = []
-        for j in range(0, len(chunk), 2):
-            if j + 1 < len(chunk):
-                sentence_pairs.append(chunk[j:j+2])
-            else:
-                sentence_pairs.append([chunk[j]])
+        # Group sentences into pairs for each instance, remembering where each pair starts
+        sentence_pairs = [(j, sentences[j:min(j + 2, chunk_end)]) for j in range(i, chunk_end, 2)]
         
         num_real = len(sentence_pairs)
         
@@ -212,7 +246,7 @@ async def get_scoresSA(text):
             chunk_tasks = []
             
             # Add real sentence pair requests
-            for pair in sentence_pairs:
+            for _, pair in sentence_pairs:
                 if len(pair) == 2:
                     payload = {"texts": pair}
                 else:
@@ -228,15 +262,18 @@ async def get_scoresSA(text):
                 chunk_tasks.append(task)
             
             # Wait for ALL requests (real + filler) to complete
-            chunk_responses = await asyncio.gather(*chunk_tasks, return_exceptions=True)
+            FINBERT_BATCH_SIZE.observe(chunk_end - i)
+            with FINBERT_LATENCY.time(), span('finbert_dispatch'):
+                chunk_responses = await asyncio.gather(*chunk_tasks, return_exceptions=True)
             
             # Process only the real responses
-            for response in chunk_responses[:num_real]:
+            for (offset, pair), response in zip(sentence_pairs, chunk_responses[:num_real]):
                 try:
                     if isinstance(response, Exception):
                         raise response
                     
                     if response.status != 200:
+                        FINBERT_ERRORS.labels('status').inc()
                         print(f"Error: Non-200 status code: {response.status}")
                         continue
                     
@@ -244,72 +281,70 @@ async def get_scoresSA(text):
                     scores = json.loads(content)
                     
                     # Handle both single and paired responses
-                    if isinstance(scores, list):
-                        all_sentence_scores.extend(scores)
-                    else:
-                        all_sentence_scores.append(scores)
+                    if not isinstance(scores, list):
+                        scores = [scores]
+                    for k, sentence_score in enumerate(scores[:len(pair)]):
+                        all_sentence_scores[offset + k] = sentence_score
                 except Exception as e:
+                    FINBERT_ERRORS.labels('exception').inc()
                     print(f"Error processing sentence: {str(e)}")
                     continue
             
             # Update activity time after processing chunk
             warmup_manager.update_activity_time()
+
+    return all_sentence_scores
+
+def aggregate_scores(raw_sentence_scores):
+    '''
+    Collapse per-sentence FinBERT probabilities into [overall_score, optimism, confidence, specific_fls]
+    with the current scoring formula (see scoring.py). Sentences that failed to score (None) are skipped.
+    '''
+    return compute_scores(raw_sentence_scores)
+
+
+async def get_scoresSA(text):
+    '''
+    Get sentiment and FLS scores for the given text.
+    Returns a list containing [overall_score, optimism, confidence, specific_fls (trustworthy)].
+    '''
+    sentences = split_sentences(text)
     
-    if not all_sentence_scores:
-        return [0.33, 0.33, 0.34, 0.33]
-    
-    # Calculate aggregated scores across all sentences
-    sum_positives = sum(s['tone']['Positive'] for s in all_sentence_scores)
-    sum_neutrals = sum(s['tone']['Neutral'] for s in all_sentence_scores)
-    sum_negatives = sum(s['tone']['Negative'] for s in all_sentence_scores)
-    sum_specific_fls = sum(s['fls']['Specific FLS'] for s in all_sentence_scores)
-    sum_non_specific_fls = sum(s['fls']['Non-specific FLS'] for s in all_sentence_scores)
-    sum_not_fls = sum(s['fls']['Not FLS'] for s in all_sentence_scores)
-    
-    # Weights for overall score calculation
-    weights = {
-        'Positive': 1.0,
-        'Neutral': 0.7,
-        'Negative': 0.0,
-        'Specific FLS': 1.0,
-        'Non-specific FLS': 0.0,
-        'Not FLS': 1.0
-    }
-    
-    # Calculate overall score for each sentence and take average
-    max_score = 2.0  # Sum of max weights
-    sentence_scores = []
-    
-    for scores in all_sentence_scores:
-        score = (
-            sum(weights[k] * v for k, v in scores['tone'].items()) +
-            sum(weights[k] * v for k, v in scores['fls'].items())
-        ) / max_score * 100
-        sentence_scores.append(score)
-    
-    overall_score = sum(sentence_scores) / len(sentence_scores)
-    
-    # Calculate optimism = (Positive) / (Positive + Negative) * 100
-    total_pos_neg = sum_positives + sum_negatives
-    optimism = (sum_positives / total_pos_neg * 100) if total_pos_neg > 0 else 50
-    
-    # Calculate confidence = (Positive + Neutral) / (Positive + Negative + Neutral) * 100
-    total_tone = sum_positives + sum_negatives + sum_neutrals
-    confidence = ((sum_positives + sum_neutrals) / total_tone * 100) if total_tone > 0 else 50
-    
-    # Calculate specific FLS = Specific FLS / (Specific FLS + Non-specific FLS) * 100
-    total_fls = sum_specific_fls + sum_non_specific_fls
-    specific_fls = (sum_specific_fls / total_fls * 100) if total_fls > 0 else 0
-    
-    # Truncate to 2 decimal places
-    final_scores = [
-        int(overall_score * 100) / 100,
-        int(optimism * 100) / 100,
-        int(confidence * 100) / 100,
-        int(specific_fls * 100) / 100
-    ]
-    
-    return final_scores
+    if not sentences:
+        return list(DEFAULT_SCORES)
+
+    sentence_scores = await fetch_sentence_scores(sentences)
+    with span('aggregate'):
+        return aggregate_scores(sentence_scores)
+
+
+async def score_texts(texts, known_sentences=None):
+    '''
+    Score several texts (e.g. the chunks of a document) with a single FinBERT dispatch.
+    Returns a TextScores per text: the [overall_score, optimism, confidence, specific_fls] list
+    and the raw per-sentence probabilities with their offsets in the text.
+    known_sentences maps sentence text to probabilities that are already stored; only the other
+    sentences are sent to FinBERT, each distinct sentence once, and the aggregates are rebuilt from both.
+    '''
+    known_sentences = known_sentences or {}
+    spans_per_text = [sentence_spans(text) for text in texts]
+    all_sentences = [text[start:end] for text, spans in zip(texts, spans_per_text) for start, end in spans]
+    to_fetch = list(dict.fromkeys(sentence for sentence in all_sentences if sentence not in known_sentences))
+    fetched = dict(zip(to_fetch, await fetch_sentence_scores(to_fetch))) if to_fetch else {}
+    raw_scores = [known_sentences[sentence] if sentence in known_sentences else fetched[sentence] for sentence in all_sentences]
+
+    with span('aggregate'):
+        results = []
+        offset = 0
+        for spans in spans_per_text:
+            if not spans:
+                results.append(TextScores(list(DEFAULT_SCORES), []))
+                continue
+            text_raw_scores = raw_scores[offset:offset + len(spans)]
+            sentences = [(start, end, raw) for (start, end), raw in zip(spans, text_raw_scores)]
+            results.append(TextScores(aggregate_scores(text_raw_scores), sentences))
+            offset += len(spans)
+        return results
 
 
 def chat_bot(prompt, chat_log=None):
@@ -332,10 +367,12 @@ def chat_bot(prompt, chat_log=None):
 
     try:
         print("Sending the following chat log to OpenAI API:", chat_log)
-        response = client.chat.completions.create(
-            model='gpt-4o-mini',
-            messages=chat_log
-        )
+        with track_openai('chatbot'):
+            response = client.chat.completions.create(
+                model='gpt-4o-mini',
+                messages=chat_log
+            )
+        record_openai_usage('chatbot', response)
         print("Received response from OpenAI API:", response)
         chat_log.append({
             'role': 'assistant',
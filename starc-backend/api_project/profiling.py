@@ -0,0 +1,229 @@
+"""
+On-demand profiling of live requests
+
+A request carrying the PROFILING_TOKEN in an X-Profile header (or a ?profile= query parameter)
+is profiled while it runs:
+- a sampler thread records the request's stack every PROFILE_INTERVAL_MS. When the request's
+  task is running on the event loop, the sample is the loop thread's stack ("cpu"). Otherwise
+  it is the chain of coroutines the task is awaiting ("wait"), which shows which call it is
+  waiting on: FinBERT, OpenAI, a worker thread.
+- a tracemalloc snapshot taken before and after the request is diffed by line. Allocations by
+  concurrent requests are included, so profile on a quiet instance for clean numbers.
+
+The response carries an X-Profile-URL header pointing to GET /profiles/{id}, which returns the
+artifact (collapsed stacks for flame graph tools, the hottest lines and the memory diff) to
+holders of the token. With PROFILE_SAMPLE_RATE above 0 that fraction of all requests is
+stack-sampled as well, without tracemalloc. Artifacts are kept in PROFILE_DIR, bounded by
+PROFILE_MAX_BYTES. Profiling is off unless PROFILING_TOKEN is set.
+"""
+
+import asyncio
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from typing import List, Optional
+from urllib.parse import parse_qs
+
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import FileResponse
+
+from api_project.pdf_cache import evict_lru
+
+# Shared secret that enables profiling of a request (profiling is off when unset)
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+
+# Fraction of all requests that are stack-sampled without being asked to
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'starc-profiles'))
+
+# Total size of stored profiles (oldest are removed first)
+PROFILE_MAX_BYTES = int(os.environ.get('PROFILE_MAX_BYTES', 64 * 1024 * 1024))
+
+_SUFFIX = '.json'
+_PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+# tracemalloc is process-wide; it runs while at least one profiled request needs it
+_tracemalloc_users = 0
+_tracemalloc_lock = threading.Lock()
+
+profiles_router = APIRouter()
+
+
+def token_matches(token: Optional[str]) -> bool:
+    return bool(PROFILING_TOKEN) and token is not None and hmac.compare_digest(token, PROFILING_TOKEN)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _thread_stack(frame) -> List:
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    return frames[::-1]
+
+
+def _await_stack(coro) -> List:
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None) or getattr(coro, 'ag_frame', None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None) or getattr(coro, 'ag_await', None)
+    return frames
+
+
+class StackSampler(threading.Thread):
+    '''Samples the stack of one request task from a background thread until stopped.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, task: asyncio.Task, loop_thread_id: int):
+        super().__init__(name='request-profiler', daemon=True)
+        self.loop = loop
+        self.task = task
+        self.loop_thread_id = loop_thread_id
+        self.stacks = Counter()
+        self.lines = Counter()
+        self.samples = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while not self._stop_event.wait(interval):
+            try:
+                self.sample()
+            except Exception:
+                # Frames can change under the sampler; a lost sample is harmless
+                continue
+
+    def sample(self):
+        if asyncio.current_task(self.loop) is self.task:
+            kind = 'cpu'
+            frames = _thread_stack(sys._current_frames().get(self.loop_thread_id))
+            if frames:
+                leaf = frames[-1]
+                self.lines[f"{leaf.f_code.co_filename}:{leaf.f_lineno} {leaf.f_code.co_name}"] += 1
+        else:
+            kind = 'wait'
+            frames = _await_stack(self.task.get_coro())
+        if frames:
+            self.samples[kind] += 1
+            self.stacks[';'.join([kind] + [_frame_label(frame) for frame in frames])] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _start_tracemalloc() -> tracemalloc.Snapshot:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+    return tracemalloc.take_snapshot()
+
+
+def _stop_tracemalloc(before: tracemalloc.Snapshot) -> List[dict]:
+    global _tracemalloc_users
+    after = tracemalloc.take_snapshot()
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+    return [{
+        "line": str(stat.traceback[0]),
+        "size_diff_bytes": stat.size_diff,
+        "count_diff": stat.count_diff,
+    } for stat in diff[:25]]
+
+
+def store_profile(profile_id: str, profile: dict) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PROFILE_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(profile, f)
+    os.replace(tmp_path, os.path.join(PROFILE_DIR, profile_id + _SUFFIX))
+    evict_lru(PROFILE_DIR, _SUFFIX, PROFILE_MAX_BYTES)
+
+
+class ProfilingMiddleware:
+    '''ASGI middleware profiling requests that carry the profiling token, and a sample of the rest.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not (PROFILING_TOKEN or PROFILE_SAMPLE_RATE > 0):
+            await self.app(scope, receive, send)
+            return
+
+        token = dict(scope['headers']).get(b'x-profile', b'').decode('latin-1') or \
+            parse_qs(scope.get('query_string', b'').decode('latin-1')).get('profile', [None])[0]
+        requested = token_matches(token)
+        if not requested and not (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+        status = 500
+
+        async def send_with_link(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if requested:
+                    message = {**message, 'headers': [*message.get('headers', []), (b'x-profile-url', f"/profiles/{profile_id}".encode())]}
+            await send(message)
+
+        sampler = StackSampler(asyncio.get_running_loop(), asyncio.current_task(), threading.get_ident())
+        memory_before = _start_tracemalloc() if requested else None
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_link)
+        finally:
+            duration = time.perf_counter() - start
+            await asyncio.to_thread(sampler.stop)
+            profile = {
+                "id": profile_id,
+                "method": scope['method'],
+                "path": scope['path'],
+                "status": status,
+                "mode": "requested" if requested else "sampled",
+                "duration_ms": round(duration * 1000, 1),
+                "interval_ms": PROFILE_INTERVAL_MS,
+                "samples": dict(sampler.samples),
+                "top_lines": [{"line": line, "samples": count} for line, count in sampler.lines.most_common(25)],
+                # "frame;frame;... count" lines, for flamegraph.pl or speedscope
+                "collapsed_stacks": [f"{stack} {count}" for stack, count in sampler.stacks.most_common()],
+                "memory": await asyncio.to_thread(_stop_tracemalloc, memory_before) if memory_before is not None else None,
+            }
+            await asyncio.to_thread(store_profile, profile_id, profile)
+
+
+@profiles_router.get("/{profile_id}")
+def get_profile(profile_id: str, x_profile: Optional[str] = Header(None), profile: Optional[str] = Query(None)):
+    if not token_matches(x_profile or profile):
+        raise HTTPException(status_code=403, detail="Profiling token required")
+    path = os.path.join(PROFILE_DIR, profile_id + _SUFFIX)
+    if not _PROFILE_ID.match(profile_id) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json")
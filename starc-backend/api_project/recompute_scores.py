@@ -0,0 +1,151 @@
+"""
+Recompute stored scores with the current scoring formula
+
+Refreshes InitialScore/FinalScore rows that were produced by an older formula version from the
+stored per-sentence probabilities (SentenceScore). No FinBERT requests are made. Chunks are
+processed in id order in batches: one query per table per batch and a bulk UPDATE by primary key.
+The version of every document with a changed row is bumped in the same transaction, so cached
+score responses are revalidated.
+
+    python -m api_project.recompute_scores [--batch-size 500] [--all]
+
+FinalScore is always recomputable once the chunk has sentence rows, since those describe its
+rewritten text. InitialScore describes the input text, so for rewritten chunks its sentences are
+looked up by hash and the row is left alone if any of them is no longer stored.
+"""
+
+import argparse
+import logging
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from api_project.models import TextChunks, InitialScore, FinalScore, SentenceScore, content_hash
+from api_project.processing import sentence_spans
+from api_project.scoring import SCORING_VERSION, compute_scores
+from api_project.chunks import SCORE_FIELDS, find_sentence_scores_by_hashes
+from api_project.http_cache import bump_document_versions
+
+# SentenceScore columns in the order of scoring.PROBABILITY_COLUMNS
+SENTENCE_COLUMNS = (
+    SentenceScore.positive, SentenceScore.neutral, SentenceScore.negative,
+    SentenceScore.specific_fls, SentenceScore.non_specific_fls, SentenceScore.not_fls,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _outdated(db: Session, model, chunk_ids, version: int, recompute_all: bool) -> dict:
+    query = db.query(model.id, model.text_chunk_id).filter(model.text_chunk_id.in_(chunk_ids))
+    if not recompute_all:
+        query = query.filter(model.scoring_version != version)
+    return {text_chunk_id: score_id for score_id, text_chunk_id in query}
+
+
+def _update_rows(db: Session, model, values: dict, version: int) -> None:
+    if values:
+        db.execute(update(model), [
+            {"id": score_id, "scoring_version": version, **dict(zip(SCORE_FIELDS, scores))}
+            for score_id, scores in values.items()
+        ])
+
+
+def recompute_scores(db: Session, version: int = SCORING_VERSION, batch_size: int = 500, recompute_all: bool = False) -> dict:
+    '''
+    Recompute outdated (or, with recompute_all, all) score rows with the given formula version.
+    Commits after every batch. Returns counts of updated and skipped rows.
+    '''
+    counts = {"final_updated": 0, "initial_updated": 0, "skipped": 0}
+    last_id = 0
+
+    while True:
+        chunks = db.query(TextChunks.id, TextChunks.document_id, TextChunks.input_text_chunk, TextChunks.input_text_hash, TextChunks.rewritten_text_hash)\
+            .filter(TextChunks.id > last_id)\
+            .order_by(TextChunks.id)\
+            .limit(batch_size)\
+            .all()
+        if not chunks:
+            break
+        last_id = chunks[-1].id
+        chunk_ids = [chunk.id for chunk in chunks]
+
+        final_ids = _outdated(db, FinalScore, chunk_ids, version, recompute_all)
+        initial_ids = _outdated(db, InitialScore, chunk_ids, version, recompute_all)
+        if not final_ids and not initial_ids:
+            continue
+
+        # Stored probabilities go straight into one packed array per chunk
+        rows = defaultdict(list)
+        for text_chunk_id, *probabilities in db.query(SentenceScore.text_chunk_id, *SENTENCE_COLUMNS)\
+                .filter(SentenceScore.text_chunk_id.in_(chunk_ids), SentenceScore.positive.isnot(None))\
+                .order_by(SentenceScore.text_chunk_id, SentenceScore.position):
+            rows[text_chunk_id].append(probabilities)
+        sentences = {text_chunk_id: np.array(values, dtype=np.float64) for text_chunk_id, values in rows.items()}
+
+        # Input sentences of rewritten chunks are only stored under their hash
+        input_hashes = {}
+        for chunk in chunks:
+            if chunk.id in initial_ids and chunk.input_text_hash != chunk.rewritten_text_hash:
+                text = chunk.input_text_chunk
+                input_hashes[chunk.id] = [content_hash(text[start:end]) for start, end in sentence_spans(text)]
+        stored = find_sentence_scores_by_hashes(db, (h for hashes in input_hashes.values() for h in hashes))
+
+        final_values = {}
+        initial_values = {}
+        changed_documents = set()
+        for chunk in chunks:
+            rewritten_sentences = sentences.get(chunk.id)
+
+            if chunk.id in final_ids:
+                if rewritten_sentences is not None:
+                    final_values[final_ids[chunk.id]] = compute_scores(rewritten_sentences, version)
+                    changed_documents.add(chunk.document_id)
+                else:
+                    counts["skipped"] += 1
+
+            if chunk.id in initial_ids:
+                if chunk.id in input_hashes:
+                    hashes = input_hashes[chunk.id]
+                    input_sentences = [stored[h] for h in hashes] if all(h in stored for h in hashes) else None
+                else:
+                    input_sentences = rewritten_sentences
+                if input_sentences is not None and len(input_sentences):
+                    initial_values[initial_ids[chunk.id]] = compute_scores(input_sentences, version)
+                    changed_documents.add(chunk.document_id)
+                else:
+                    counts["skipped"] += 1
+
+        _update_rows(db, FinalScore, final_values, version)
+        _update_rows(db, InitialScore, initial_values, version)
+        bump_document_versions(db, changed_documents)
+        db.commit()
+        counts["final_updated"] += len(final_values)
+        counts["initial_updated"] += len(initial_values)
+
+    return counts
+
+
+def main():
+    from api_project.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Recompute stored scores from stored sentence probabilities.")
+    parser.add_argument("--batch-size", type=int, default=500, help="Chunks per pass")
+    parser.add_argument("--all", action="store_true", help="Recompute rows already at the current formula version too")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = SessionLocal()
+    try:
+        counts = recompute_scores(db, batch_size=args.batch_size, recompute_all=args.all)
+    finally:
+        db.close()
+    logger.info(
+        f"Recomputed {counts['final_updated']} final and {counts['initial_updated']} initial scores "
+        f"with formula v{SCORING_VERSION}; {counts['skipped']} rows skipped for lack of stored sentences"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,13 @@ from sqlalchemy.orm import Session
 from fastapi_jwt_auth import AuthJWT
 from authlib.integrations.starlette_client import OAuth
 from starlette.config import Config
-from api_project.models import User
+from api_project.models import User, UserStats
 from api_project.database import get_db
 from api_project.schemas import UserCreate, UserLogin, TokenResponse
 from api_project.processing import ensure_model_warm
+from api_project.passwords import authenticate, hash_password, run_hashing
+from api_project.google_auth import verify_google_id_token
 import os
-from google.oauth2 import id_token
-from google.auth.transport import requests
 import asyncio
 
 auth_router = APIRouter()
@@ -33,12 +33,8 @@ async def google_login(request: Request, db: Session = Depends(get_db), Authoriz
             raise HTTPException(status_code=400, detail="Token is required")
 
         try:
-            # Verify the token with Google
-            idinfo = id_token.verify_oauth2_token(
-                token,
-                requests.Request(),
-                os.getenv('GOOGLE_CLIENT_ID')
-            )
+            # Verify the token against Google's cached signing certificates
+            idinfo = await verify_google_id_token(token, os.getenv('GOOGLE_CLIENT_ID'))
             
             # Get user email and name from the verified token
             user_email = idinfo['email']
@@ -53,6 +49,7 @@ async def google_login(request: Request, db: Session = Depends(get_db), Authoriz
                     password="OAUTH_USER",
                     is_oauth_user=True
                 )
+                user.stats = UserStats()
                 db.add(user)
                 db.commit()
 
@@ -75,14 +72,15 @@ async def google_login(request: Request, db: Session = Depends(get_db), Authoriz
 
 # Register unique user using name, email, and password.
 @auth_router.post('/register', response_model=dict)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: Session = Depends(get_db)):
     if db.query(User).filter_by(username=user.username).first():
         raise HTTPException(status_code=400, detail="Username already exists")
     if db.query(User).filter_by(email=user.email).first():
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    new_user = User(username=user.username, email=user.email)
-    new_user.set_password(user.password)
+    # Hashed in the same bounded pool as logins, so a burst of sign-ups cannot starve them
+    new_user = User(username=user.username, email=user.email, password=await run_hashing(hash_password, user.password))
+    new_user.stats = UserStats()
     db.add(new_user)
     db.commit()
 
@@ -96,7 +94,8 @@ async def login(user: UserLogin, Authorize: AuthJWT = Depends(), db: Session = D
         (User.email == user.login_identifier)
     ).first()
     
-    if not db_user or not db_user.check_password(user.password):
+    # Hashing runs in its own thread pool so a burst of logins does not stall the event loop
+    if not db_user or not await authenticate(db, db_user, user.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     access_token = Authorize.create_access_token(subject=db_user.id)
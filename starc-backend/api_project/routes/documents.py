@@ -1,20 +1,35 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, UploadFile, File, Request, Response, Query, WebSocket, status
 from fastapi_jwt_auth import AuthJWT
-from sqlalchemy.orm import Session
-from api_project.models import Document, TextChunks, InitialScore, FinalScore, DocumentHistory, User
-from api_project.database import get_db
-from api_project.processing import get_scoresSA, chat_bot, ensure_model_warm
-from api_project.schemas import DocumentCreate, DocumentResponse, PDFUploadResponse, ChatBotRequest, ChatBotResponse,SaveRewriteRequest, DocumentHistoryCreate, DocumentHistoryResponse
-from pypdf import PdfReader
+from fastapi_jwt_auth.exceptions import AuthJWTException
+from sqlalchemy.orm import Session, selectinload
+from api_project.models import Document, TextChunks, InitialScore, FinalScore, SentenceScore, DocumentHistory, User, UserStats, content_hash
+from api_project.database import get_db, SessionLocal
+from api_project.processing import chat_bot, ensure_model_warm, split_sentences
+from api_project.scoring import SCORING_VERSION, sentence_score, score_distribution
+from api_project.chunks import (
+    split_into_chunks, keep_whitespace, load_chunks, document_text, new_chunk, score_dict, score_values,
+    aggregate_chunk_scores, score_chunk_texts, score_new_chunks, rescore_chunks, replace_document_text,
+    sentence_rows, raw_probabilities, stored_sentence_scores, score_unsaved_texts
+)
+from api_project.editor import EditorSession, EditorDocumentGone, serve_editor
+from api_project.suggestions import schedule_suggestions
+from api_project.pdf_extraction import PdfExtractionError, spooled_upload, iter_pdf_text, extract_pdf_text
+from api_project.pdf_cache import cached_pdf_text, store_pdf_text
+from api_project.pdf_export import export_key, open_cached_export, render_export, iter_file
+from api_project.bulk_export import export_archive
+from api_project.timing import span
+from api_project.history import append_history, load_history, load_version
+from api_project.http_cache import etag_matches, cache_headers, not_modified, document_etag, bump_document_version
+from api_project.stats import is_rewritten, record_document_created, record_document_deleted, record_rewrite_change, record_activity, reconcile_user_stats
+from api_project.schemas import DocumentCreate, DocumentResponse, PDFUploadResponse, ChatBotRequest, ChatBotResponse,SaveRewriteRequest, DocumentHistoryCreate, DocumentHistoryResponse, DocumentHistorySummary, DocumentHistoryPage, DocumentBatchCreate, DocumentBatchItemResult, DocumentBatchResponse, TextChunkUpdate, TextChunkDetail, TextChunkUpdateResponse
 from fastapi.responses import StreamingResponse
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import LETTER
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import Paragraph, Frame
-import io
+import asyncio
+import base64
 import logging
-from typing import List
-from sqlalchemy import func
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import List, Optional, Tuple
+from sqlalchemy import insert
 
 documents_router = APIRouter()
 
@@ -22,61 +37,232 @@ documents_router = APIRouter()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def process_document(user_id: int, title: str, text: str, db: Session):
+# Upper bound on documents accepted by a single POST /docs/batch
+MAX_BATCH_DOCUMENTS = 50
+
+async def extract_and_prescore(db: Session, path: str) -> Tuple[str, dict]:
+    '''
+    Extract a PDF's text while its first sections are already being scored: each time a page
+    range arrives, the chunks it completes are sent to FinBERT. Returns the text and the sentence
+    probabilities gathered that way, for process_document to reuse.
+    '''
+    parts = []
+    prescoring = []
+    sent = 0
+    try:
+        async for part in iter_pdf_text(path):
+            parts.append(part)
+            # The last chunk may still continue on the next pages
+            complete = split_into_chunks(''.join(parts))[:-1]
+            if len(complete) > sent:
+                texts = complete[sent:]
+                prescoring.append((texts, asyncio.create_task(score_unsaved_texts(db, texts))))
+                sent = len(complete)
+
+        # Anything that failed here is simply scored again with the rest of the document
+        outcomes = await asyncio.gather(*(task for _, task in prescoring), return_exceptions=True)
+    finally:
+        # Extraction failed or timed out: stop scoring sections of a document that will not be created
+        for _, task in prescoring:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in prescoring), return_exceptions=True)
+
+    known_sentences = {}
+    for (texts, _), results in zip(prescoring, outcomes):
+        if isinstance(results, Exception):
+            logger.warning(f"Early scoring of PDF sections failed: {str(results)}")
+            continue
+        for chunk_text, result in zip(texts, results):
+            for start, end, raw in result.sentences:
+                if raw is not None:
+                    known_sentences[chunk_text[start:end]] = raw
+    return ''.join(parts), known_sentences
+
+async def process_document(user_id: int, title: str, text: str, db: Session, known_sentences: dict = None):
     # Ensure model is warm before processing
-    await ensure_model_warm()
+    with span('warmup'):
+        await ensure_model_warm()
     
     new_document = Document(title=title, user_id=user_id, word_count=len(text.split()))
     db.add(new_document)
     db.commit()
     db.refresh(new_document)
 
-    new_text_chunk = TextChunks(document_id=new_document.id, input_text_chunk=text)
-    original_scores_data = await get_scoresSA(text)
-    rewritten_text = text
-    rewritten_scores_data = await get_scoresSA(rewritten_text)
-
-    new_text_chunk.rewritten_text = rewritten_text
-    db.add(new_text_chunk)
-    db.commit()
-    db.refresh(new_text_chunk)
-
-    initial_score = InitialScore(
-        text_chunk_id=new_text_chunk.id,
-        score=original_scores_data[0],
-        optimism=original_scores_data[1],
-        forecast=original_scores_data[2],
-        confidence=original_scores_data[3],
-    )
-
-    final_score = FinalScore(
-        text_chunk_id=new_text_chunk.id,
-        score=rewritten_scores_data[0],
-        optimism=rewritten_scores_data[1],
-        forecast=rewritten_scores_data[2],
-        confidence=rewritten_scores_data[3],
-    )
+    # One chunk per section/paragraph; all of them are scored in a single FinBERT dispatch and
+    # chunks whose text was scored before reuse those scores
+    with span('chunking'):
+        new_chunks = [new_chunk(new_document.id, position, piece) for position, piece in enumerate(split_into_chunks(text))]
+    with span('scoring'):
+        await score_new_chunks(db, new_chunks, known_sentences)
 
-    db.add(initial_score)
-    db.add(final_score)
+    db.add_all(new_chunks)
+    record_document_created(db, user_id, at=new_document.upload_date)
     db.commit()
 
     return new_document
 
+def chunk_detail(chunk: TextChunks) -> TextChunkDetail:
+    return TextChunkDetail(
+        id=chunk.id,
+        position=chunk.position,
+        input_text_chunk=chunk.input_text_chunk,
+        rewritten_text=chunk.rewritten_text,
+        sentence_count=chunk.sentence_count,
+        initial_scores=score_dict(score_values(chunk.initial_score)) if chunk.initial_score else None,
+        final_scores=score_dict(score_values(chunk.final_score)) if chunk.final_score else None
+    )
+
 @documents_router.post("", response_model=DocumentResponse)
-async def create_document(document: DocumentCreate, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+async def create_document(document: DocumentCreate, background_tasks: BackgroundTasks, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
     new_document = await process_document(user_id, document.title, document.text, db)
+    schedule_suggestions(background_tasks, new_document.id)
     return DocumentResponse(
         id=new_document.id,
         title=new_document.title,
         word_count=new_document.word_count
     )
 
+async def process_documents_batch(user_id: int, items: List[dict], db: Session) -> List[DocumentBatchItemResult]:
+    '''
+    Create many documents at once. Items are dicts with index, title, text and error (set when
+    the input could not be read). Every new chunk across the batch is scored in one shared
+    FinBERT dispatch, and all rows are written with bulk inserts in a single transaction.
+    '''
+    results = {item['index']: DocumentBatchItemResult(index=item['index'], title=item['title'], status="failed", error=item['error'])
+               for item in items}
+    pending = [item for item in items if item['error'] is None]
+    if not pending:
+        return list(results.values())
+
+    with span('warmup'):
+        await ensure_model_warm()
+
+    # Chunk texts that were scored before (or repeat within the batch) are only scored once
+    with span('chunking'):
+        for item in pending:
+            item['chunks'] = [(piece, content_hash(piece)) for piece in split_into_chunks(item['text'])]
+    with span('scoring'):
+        scored = await score_chunk_texts(db, {text_hash: piece for item in pending for piece, text_hash in item['chunks']})
+
+    now = datetime.utcnow()
+    try:
+        document_ids = db.scalars(
+            insert(Document).returning(Document.id, sort_by_parameter_order=True),
+            [{"title": item['title'], "user_id": user_id, "word_count": len(item['text'].split()), "upload_date": now}
+             for item in pending]
+        ).all()
+
+        # Bulk inserts bypass the model validators, so the hashes are set explicitly
+        chunk_rows = [
+            {"document_id": document_id, "position": position, "input_text_chunk": piece, "rewritten_text": piece,
+             "input_text_hash": text_hash, "rewritten_text_hash": text_hash, "sentence_count": len(split_sentences(piece))}
+            for item, document_id in zip(pending, document_ids)
+            for position, (piece, text_hash) in enumerate(item['chunks'])
+        ]
+        chunk_ids = db.scalars(
+            insert(TextChunks).returning(TextChunks.id, sort_by_parameter_order=True),
+            chunk_rows
+        ).all()
+
+        score_rows = [
+            {"text_chunk_id": chunk_id, "scoring_version": SCORING_VERSION, **score_dict(scored[row['input_text_hash']].scores)}
+            for row, chunk_id in zip(chunk_rows, chunk_ids)
+        ]
+        db.execute(insert(InitialScore), score_rows)
+        db.execute(insert(FinalScore), score_rows)
+
+        sentence_score_rows = [
+            {"text_chunk_id": chunk_id, **sentence}
+            for row, chunk_id in zip(chunk_rows, chunk_ids)
+            for sentence in sentence_rows(row['input_text_chunk'], scored[row['input_text_hash']].sentences)
+        ]
+        if sentence_score_rows:
+            db.execute(insert(SentenceScore), sentence_score_rows)
+
+        record_document_created(db, user_id, at=now, count=len(pending))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Batch document creation failed: {str(e)}")
+        for item in pending:
+            results[item['index']].error = "Could not save document"
+        return list(results.values())
+
+    first_chunk_ids = {}
+    for row, chunk_id in zip(chunk_rows, chunk_ids):
+        first_chunk_ids.setdefault(row['document_id'], chunk_id)
+
+    for item, document_id in zip(pending, document_ids):
+        result = results[item['index']]
+        result.status = "created"
+        result.document_id = document_id
+        result.text_chunk_id = first_chunk_ids[document_id]
+        result.word_count = len(item['text'].split())
+
+    return list(results.values())
+
+def check_batch_size(count: int) -> None:
+    if not count:
+        raise HTTPException(status_code=400, detail="No documents provided")
+    if count > MAX_BATCH_DOCUMENTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_DOCUMENTS} documents per batch")
+
+async def create_batch(user_id: int, items: List[dict], background_tasks: BackgroundTasks, db: Session) -> DocumentBatchResponse:
+    results = await process_documents_batch(user_id, items, db)
+    for result in results:
+        if result.status == "created":
+            schedule_suggestions(background_tasks, result.document_id)
+    created = sum(1 for result in results if result.status == "created")
+    return DocumentBatchResponse(created=created, failed=len(results) - created, results=results)
+
+@documents_router.post("/batch", response_model=DocumentBatchResponse)
+async def create_documents_batch(batch: DocumentBatchCreate, background_tasks: BackgroundTasks, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    '''
+    Create several documents from their title and text. Each document's outcome is reported separately.
+    '''
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    check_batch_size(len(batch.documents))
+    items = [{"index": index, "title": document.title, "text": document.text, "error": None}
+             for index, document in enumerate(batch.documents)]
+    return await create_batch(user_id, items, background_tasks, db)
+
+@documents_router.post("/batch/pdf", response_model=DocumentBatchResponse)
+async def upload_pdfs_batch(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...), Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    '''
+    Create one document per uploaded PDF. Each document's outcome is reported separately.
+    '''
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    check_batch_size(len(files))
+    items = []
+    for index, file in enumerate(files):
+        item = {"index": index, "title": file.filename, "text": None, "error": None}
+        if file.content_type != "application/pdf":
+            item['error'] = "Invalid file type"
+        else:
+            try:
+                async with spooled_upload(file) as upload:
+                    item['text'] = await asyncio.to_thread(cached_pdf_text, upload.content_hash)
+                    if item['text'] is None:
+                        with span('pdf_extract'):
+                            item['text'] = await extract_pdf_text(upload.path)
+                        await asyncio.to_thread(store_pdf_text, upload.content_hash, item['text'])
+            except PdfExtractionError as e:
+                item['error'] = str(e)
+            except Exception as e:
+                logger.error(f"Could not read PDF file {file.filename}: {str(e)}")
+                item['error'] = f"Could not read PDF file: {str(e)}"
+        items.append(item)
+    return await create_batch(user_id, items, background_tasks, db)
+
 @documents_router.post("/pdf", response_model=PDFUploadResponse)
-async def upload_pdf(file: UploadFile = File(...), Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+async def upload_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(...), Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
@@ -84,21 +270,29 @@ async def upload_pdf(file: UploadFile = File(...), Authorize: AuthJWT = Depends(
         raise HTTPException(status_code=400, detail="Invalid file type")
 
     try:
-        pdf_reader = PdfReader(file.file)
-        text_content = ""
-        for page in pdf_reader.pages:
-            text_content += page.extract_text() + "\n"
-
-        new_document = await process_document(user_id, file.filename, text_content, db)
-        
-        # Retrieve the TextChunks object associated with the new document
-        new_text_chunk = db.query(TextChunks).filter_by(document_id=new_document.id).first()
+        # A PDF uploaded before skips parsing. Otherwise extraction runs in the process pool
+        # and sections complete early are scored meanwhile
+        async with spooled_upload(file) as upload:
+            text_content = await asyncio.to_thread(cached_pdf_text, upload.content_hash)
+            known_sentences = None
+            if text_content is None:
+                with span('pdf_extract'):
+                    text_content, known_sentences = await extract_and_prescore(db, upload.path)
+                await asyncio.to_thread(store_pdf_text, upload.content_hash, text_content)
+
+        new_document = await process_document(user_id, file.filename, text_content, db, known_sentences)
+        schedule_suggestions(background_tasks, new_document.id)
+
+        # Retrieve the first TextChunks object associated with the new document
+        new_text_chunk = db.query(TextChunks).filter_by(document_id=new_document.id).order_by(TextChunks.position).first()
 
         return {
             "message": "PDF uploaded and document processed",
             "document_id": new_document.id,
             "text_chunk_id": new_text_chunk.id
         }
+    except PdfExtractionError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         logger.error(f"Could not read PDF file: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Could not read PDF file: {str(e)}")
@@ -119,11 +313,44 @@ def delete_document(doc_id: int, Authorize: AuthJWT = Depends(), db: Session = D
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
+    record_document_deleted(db, document)
     db.delete(document)
     db.commit()
 
     return {"message": "Document and related data deleted successfully"}
 
+async def save_document_text(db: Session, document: Document, user_id: int, text: str, known_sentences: dict = None):
+    '''
+    Replace a document's text, rescoring only the paragraphs that changed. known_sentences are
+    sentence probabilities the caller already holds. Returns the aggregated initial and final
+    score dicts, or None if the document has no chunks.
+    '''
+    chunks = load_chunks(db, document.id, with_scores=True)
+    if not chunks:
+        return None
+
+    was_rewritten = is_rewritten(chunks)
+    # Only paragraphs whose text changed are rescored; the others keep their scores
+    chunks, changed_chunks = replace_document_text(db, document, chunks, text)
+
+    # Initial scores of reused chunks are kept - they represent the original text's scores.
+    # Nothing is written until the changed chunks are scored, so a failed or cancelled
+    # rescore leaves the stored text and scores as they were.
+    try:
+        await rescore_chunks(db, changed_chunks, known_sentences)
+    except BaseException:
+        db.rollback()
+        raise
+    initial_scores = aggregate_chunk_scores(chunks, initial=True)
+    final_scores = aggregate_chunk_scores(chunks)
+
+    document.word_count = len(text.split())
+    record_rewrite_change(db, user_id, was_rewritten, is_rewritten(chunks))
+    bump_document_version(db, document.id)
+    db.commit()
+
+    return {"initial_scores": score_dict(initial_scores), "final_scores": score_dict(final_scores)}
+
 @documents_router.put("/{doc_id}", response_model=dict)
 async def update_document(doc_id: int, document: DocumentCreate, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
@@ -134,53 +361,53 @@ async def update_document(doc_id: int, document: DocumentCreate, Authorize: Auth
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
     if document.text:
-        existing_text_chunk = db.query(TextChunks).filter_by(document_id=existing_document.id).first()
-        if existing_text_chunk:
-            existing_text_chunk.input_text_chunk = document.text
-            rewritten_text = document.text
-            existing_text_chunk.rewritten_text = rewritten_text
-            db.commit()
-            db.refresh(existing_text_chunk)
-
-            new_text_scores = await get_scoresSA(document.text)
-
-            # Keep initial_score as is - it represents the original text's scores
-            initial_score = db.query(InitialScore).filter_by(text_chunk_id=existing_text_chunk.id).first()
-
-            # Update final_score with the new text's scores
-            final_score = db.query(FinalScore).filter_by(text_chunk_id=existing_text_chunk.id).first()
-            if final_score:
-                final_score.score = new_text_scores[0]
-                final_score.optimism = new_text_scores[1]
-                final_score.forecast = new_text_scores[2]
-                final_score.confidence = new_text_scores[3]
-
-            existing_document.word_count = len(document.text.split())
-            db.commit()
-            db.refresh(initial_score)
-            db.refresh(final_score)
-
-            return {
-                "message": "Document updated successfully", 
-                "document_id": existing_document.id,
-                "initial_scores": {
-                    "score": initial_score.score,
-                    "optimism": initial_score.optimism,
-                    "forecast": initial_score.forecast,
-                    "confidence": initial_score.confidence
-                },
-                "final_scores": {
-                    "score": final_score.score,
-                    "optimism": final_score.optimism,
-                    "forecast": final_score.forecast,
-                    "confidence": final_score.confidence
-                }
-            }
+        scores = await save_document_text(db, existing_document, user_id, document.text)
+        if scores:
+            return {"message": "Document updated successfully", "document_id": existing_document.id, **scores}
 
     return {"message": "Document updated successfully", "document_id": existing_document.id}
 
+@documents_router.websocket("/{doc_id}/live")
+async def live_editor(websocket: WebSocket, doc_id: int, token: str = Query(...), Authorize: AuthJWT = Depends()):
+    '''
+    Live editor session for one document. The access token is passed as the token query
+    parameter; see editor.py for the message protocol.
+    '''
+    await websocket.accept()
+    try:
+        Authorize.jwt_required("websocket", token=token)
+        user_id = Authorize.get_raw_jwt(token)["sub"]
+    except AuthJWTException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.message)
+        return
+
+    # The socket stays open for as long as the document is being edited, so sessions are only
+    # held while loading and saving rather than for the connection's lifetime
+    with SessionLocal() as db:
+        document = db.query(Document).filter_by(id=doc_id, user_id=user_id).first()
+        chunks = load_chunks(db, doc_id) if document else []
+        texts = [chunk.input_text_chunk for chunk in chunks]
+        # Stored sentence rows hold the rewritten text, which may differ from the input text
+        known_sentences = stored_sentence_scores(db, texts + [chunk.rewritten_text for chunk in chunks if chunk.rewritten_text])
+    if not chunks:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Document not found or access denied")
+        return
+
+    session = EditorSession(''.join(texts), known_sentences)
+
+    async def save(text, known_sentences):
+        with SessionLocal() as db:
+            document = db.get(Document, doc_id)
+            if document is None:
+                raise EditorDocumentGone()
+            scores = await save_document_text(db, document, user_id, text, known_sentences)
+        # None when the document has no chunks left to replace
+        return scores or {"initial_scores": None, "final_scores": None}
+
+    await serve_editor(websocket, session, save)
+
 @documents_router.get("/scores/{doc_id}", response_model=list)
-def get_final_scores(doc_id: int, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+def get_final_scores(doc_id: int, request: Request, response: Response, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
@@ -188,18 +415,38 @@ def get_final_scores(doc_id: int, Authorize: AuthJWT = Depends(), db: Session =
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
-    text_chunk = db.query(TextChunks).filter_by(document_id=doc_id).first()
-    if not text_chunk:
+    etag = document_etag("scores", document)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
+
+    chunks = load_chunks(db, doc_id, with_scores=True)
+    if not chunks:
         raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
 
-    final_scores = db.query(FinalScore).filter_by(text_chunk_id=text_chunk.id).all()
-    if not final_scores:
+    # Document-level scores are aggregated from the stored chunk scores
+    final_scores = aggregate_chunk_scores(chunks)
+    if final_scores is None:
         raise HTTPException(status_code=404, detail="No final scores found for the given document")
 
-    return final_scores
+    # id is the first stored final score row, which is what this endpoint returned before chunking
+    score_id = next(chunk.final_score.id for chunk in chunks if chunk.final_score is not None)
+    return [{"id": score_id, "document_id": doc_id, "text_chunk_id": chunks[0].id, **score_dict(final_scores)}]
+
+@documents_router.get("/export")
+def export_documents(include_pdfs: bool = Query(False), Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    # The archive is built while it is sent, so its size is not known up front
+    return StreamingResponse(
+        export_archive(db, user_id, include_pdfs),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=documents.zip"},
+    )
 
 @documents_router.get("/{doc_id}", response_model=dict)
-def get_document_details(doc_id: int, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+def get_document_details(doc_id: int, request: Request, response: Response, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
@@ -207,52 +454,57 @@ def get_document_details(doc_id: int, Authorize: AuthJWT = Depends(), db: Sessio
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
-    text_chunk = db.query(TextChunks).filter_by(document_id=doc_id).first()
-    if not text_chunk:
+    # Answer unchanged polls from the documents row alone, before the chunk text is loaded
+    etag = document_etag("document", document)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
+
+    chunks = load_chunks(db, doc_id)
+    if not chunks:
         raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
 
     document_details = {
         "id": document.id,
         "title": document.title,
         "word_count": document.word_count,
-        "text_chunk": text_chunk.input_text_chunk,
+        "text_chunk": document_text(chunks),
     }
 
     return document_details
     
 
+def find_user_document(db: Session, doc_id: int, user_id: int) -> Optional[Document]:
+    return db.query(Document).filter_by(id=doc_id, user_id=user_id).first()
+
 @documents_router.get("/pdf/{doc_id}", response_model=dict)
-def get_document_as_pdf(doc_id: int, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+async def get_document_as_pdf(doc_id: int, request: Request, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
-    document = db.query(Document).filter_by(id=doc_id, user_id=user_id).first()
+    # Queries run in worker threads so the event loop is only used to await the render
+    document = await asyncio.to_thread(find_user_document, db, doc_id, user_id)
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
-    text_chunk = db.query(TextChunks).filter_by(document_id=doc_id).first()
-    if not text_chunk:
-        raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
-
-    pdf_buffer = io.BytesIO()
-    p = canvas.Canvas(pdf_buffer, pagesize=LETTER)
-    width, height = LETTER
-    styles = getSampleStyleSheet()
-    text = text_chunk.input_text_chunk
-
-    # Create a Frame for the text
-    frame = Frame(72, 72, width - 144, height - 144, showBoundary=1)
-    story = [Paragraph(text, styles["Normal"])]
-
-    # Add the story to the frame
-    frame.addFromList(story, p)
-
-    p.showPage()
-    p.save()
-
-    pdf_buffer.seek(0)
-
-    return StreamingResponse(pdf_buffer, media_type="application/pdf", headers={"Content-Disposition": f"attachment; filename={document.title}.pdf"})
+    etag = document_etag("pdf", document)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    headers = {**cache_headers(etag), "Content-Disposition": f"attachment; filename={document.title}.pdf"}
+
+    # Exports are cached per document version, so only the first download after a change renders
+    key = export_key(document)
+    handle = await asyncio.to_thread(open_cached_export, key)
+    if handle is None:
+        chunks = await asyncio.to_thread(load_chunks, db, doc_id)
+        if not chunks:
+            raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
+        try:
+            handle = await render_export(key, document.title, document_text(chunks))
+        except BrokenProcessPool:
+            raise HTTPException(status_code=503, detail="PDF export was interrupted, please try again")
+
+    return StreamingResponse(iter_file(handle), media_type="application/pdf", headers=headers)
 
 @documents_router.post('/chatbot', response_model=ChatBotResponse)
 def chat_with_bot(request: ChatBotRequest, Authorize: AuthJWT = Depends()):
@@ -266,7 +518,7 @@ def chat_with_bot(request: ChatBotRequest, Authorize: AuthJWT = Depends()):
     
     
 @documents_router.post("/{doc_id}/save_rewrite", response_model=dict)
-def save_rewrite(doc_id: int, request: SaveRewriteRequest, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+async def save_rewrite(doc_id: int, request: SaveRewriteRequest, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
@@ -274,11 +526,167 @@ def save_rewrite(doc_id: int, request: SaveRewriteRequest, Authorize: AuthJWT =
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
-    text_chunk = db.query(TextChunks).filter_by(document_id=doc_id).first()
-    if not text_chunk:
+    chunks = load_chunks(db, doc_id, with_scores=True)
+    if not chunks:
+        raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
+
+    was_rewritten = is_rewritten(chunks)
+    changed_chunks = []
+    pieces = split_into_chunks(request.rewritten_text)
+    if request.rewritten_text == document_text(chunks, rewritten=True):
+        # Accepting the current rewrite: each chunk's rewrite becomes its input
+        for chunk in chunks:
+            chunk.input_text_chunk = chunk.rewritten_text
+    elif len(pieces) == len(chunks):
+        for chunk, piece in zip(chunks, pieces):
+            chunk.input_text_chunk = piece
+    else:
+        # The paragraph structure changed, so re-chunk the text like a document update
+        chunks, changed_chunks = replace_document_text(db, document, chunks, request.rewritten_text)
+        # As in save_document_text, nothing is written until the changed chunks are scored
+        try:
+            await rescore_chunks(db, changed_chunks)
+        except BaseException:
+            db.rollback()
+            raise
+    document.word_count = len(request.rewritten_text.split())
+    record_rewrite_change(db, user_id, was_rewritten, is_rewritten(chunks))
+    bump_document_version(db, doc_id)
+    db.commit()
+
+    return {"message": "Rewritten text saved successfully"}
+
+def get_document_chunk(db: Session, doc_id: int, chunk_id: int, user_id: int):
+    document = db.query(Document).filter_by(id=doc_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    chunk = db.query(TextChunks).filter_by(id=chunk_id, document_id=doc_id).first()
+    if not chunk:
         raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
 
-    text_chunk.input_text_chunk = request.rewritten_text
+    return document, chunk
+
+@documents_router.get("/{doc_id}/chunks", response_model=List[TextChunkDetail])
+def get_document_chunks(doc_id: int, request: Request, response: Response, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    document = db.query(Document).filter_by(id=doc_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    etag = document_etag("chunks", document)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
+
+    return [chunk_detail(chunk) for chunk in load_chunks(db, doc_id, with_scores=True)]
+
+@documents_router.get("/{doc_id}/chunks/{chunk_id}/scores", response_model=TextChunkDetail)
+def get_chunk_scores(doc_id: int, chunk_id: int, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    _, chunk = get_document_chunk(db, doc_id, chunk_id, user_id)
+    return chunk_detail(chunk)
+
+@documents_router.get("/{doc_id}/heatmap", response_model=dict)
+def get_sentence_heatmap(doc_id: int, request: Request, response: Response, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    '''
+    Per-sentence scores of the document's current (rewritten) text, read from the stored
+    FinBERT probabilities without rescoring. Offsets are into that text. The distribution
+    summarises the spread of those scores (percentiles, variance, share of negative sentences).
+    '''
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    document = db.query(Document).filter_by(id=doc_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    etag = document_etag("heatmap", document)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
+
+    chunks = db.query(TextChunks)\
+        .options(selectinload(TextChunks.sentence_scores))\
+        .filter_by(document_id=doc_id)\
+        .order_by(TextChunks.position, TextChunks.id)\
+        .all()
+
+    sentences = []
+    raw_scores = []
+    chunk_offset = 0
+    for chunk in chunks:
+        for sentence in chunk.sentence_scores:
+            raw = raw_probabilities(sentence)
+            raw_scores.append(raw)
+            sentences.append({
+                "text_chunk_id": chunk.id,
+                "start": chunk_offset + sentence.start_offset,
+                "end": chunk_offset + sentence.end_offset,
+                "text": chunk.rewritten_text[sentence.start_offset:sentence.end_offset],
+                # None when the sentence could not be scored
+                "score": round(sentence_score(raw), 2) if raw else None,
+                "tone": raw['tone'] if raw else None,
+                "fls": raw['fls'] if raw else None,
+            })
+        chunk_offset += len(chunk.rewritten_text)
+
+    return {"document_id": doc_id, "sentences": sentences, "distribution": score_distribution(raw_scores)}
+
+@documents_router.put("/{doc_id}/chunks/{chunk_id}", response_model=TextChunkUpdateResponse)
+async def update_chunk(doc_id: int, chunk_id: int, update: TextChunkUpdate, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    '''
+    Replace the text of one chunk and rescore only that chunk.
+    '''
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    document, chunk = get_document_chunk(db, doc_id, chunk_id, user_id)
+    chunks = load_chunks(db, doc_id, with_scores=True)
+
+    was_rewritten = is_rewritten(chunks)
+    new_text = keep_whitespace(chunk.input_text_chunk, update.updated_text_chunk)
+    chunk.input_text_chunk = new_text
+    text_changed = chunk.rewritten_text_hash != content_hash(new_text)
+    chunk.rewritten_text = new_text
+
+    if text_changed:
+        try:
+            await rescore_chunks(db, [chunk])
+        except BaseException:
+            db.rollback()
+            raise
+    document.word_count = len(document_text(chunks).split())
+    record_rewrite_change(db, user_id, was_rewritten, is_rewritten(chunks))
+
+    document_scores = aggregate_chunk_scores(chunks)
+    result = TextChunkUpdateResponse(
+        chunk=chunk_detail(chunk),
+        document_scores=score_dict(document_scores) if document_scores else None
+    )
+
+    bump_document_version(db, doc_id)
+    db.commit()
+
+    return result
+
+@documents_router.post("/{doc_id}/chunks/{chunk_id}/save_rewrite", response_model=dict)
+def save_chunk_rewrite(doc_id: int, chunk_id: int, request: SaveRewriteRequest, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    document, chunk = get_document_chunk(db, doc_id, chunk_id, user_id)
+    chunks = load_chunks(db, doc_id)
+
+    was_rewritten = is_rewritten(chunks)
+    chunk.input_text_chunk = keep_whitespace(chunk.input_text_chunk, request.rewritten_text)
+    document.word_count = len(document_text(chunks).split())
+    record_rewrite_change(db, user_id, was_rewritten, is_rewritten(chunks))
+    bump_document_version(db, doc_id)
     db.commit()
 
     return {"message": "Rewritten text saved successfully"}
@@ -292,15 +700,17 @@ def save_document_history(doc_id: int, history: DocumentHistoryCreate, Authorize
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
-    new_history = DocumentHistory(
-        document_id=doc_id,
-        content=history.content
-    )
-    db.add(new_history)
+    new_history = append_history(db, doc_id, history.content)
+    record_activity(db, user_id)
     db.commit()
     db.refresh(new_history)
 
-    return new_history
+    return DocumentHistoryResponse(
+        id=new_history.id,
+        document_id=new_history.document_id,
+        content=history.content,
+        created_at=new_history.created_at
+    )
 
 @documents_router.get("/{doc_id}/history", response_model=List[DocumentHistoryResponse])
 def get_document_history(doc_id: int, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
@@ -311,8 +721,110 @@ def get_document_history(doc_id: int, Authorize: AuthJWT = Depends(), db: Sessio
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
-    history = db.query(DocumentHistory).filter_by(document_id=doc_id).order_by(DocumentHistory.created_at.desc()).all()
-    return history
+    # Versions are stored as snapshots plus deltas, so rebuild them oldest first and return newest first
+    history = load_history(db, doc_id)
+    return [
+        DocumentHistoryResponse(
+            id=entry.id,
+            document_id=entry.document_id,
+            content=content,
+            created_at=entry.created_at
+        )
+        for entry, content in reversed(history)
+    ]
+
+def encode_history_cursor(created_at: datetime, history_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{history_id}".encode()).decode()
+
+def decode_history_cursor(cursor: str):
+    try:
+        created_at, history_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(history_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@documents_router.get("/{doc_id}/history/summary", response_model=DocumentHistoryPage)
+def get_document_history_summary(
+    doc_id: int,
+    cursor: str = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    Authorize: AuthJWT = Depends(),
+    db: Session = Depends(get_db)
+):
+    '''
+    List history versions newest first without their content.
+    Pages are keyed on (created_at, id) so each page is a range scan on idx_doc_history.
+    '''
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    document = db.query(Document).filter_by(id=doc_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    query = db.query(
+        DocumentHistory.id,
+        DocumentHistory.created_at,
+        DocumentHistory.content_size,
+        DocumentHistory.word_count
+    ).filter(DocumentHistory.document_id == doc_id)
+
+    if cursor:
+        cursor_created_at, cursor_id = decode_history_cursor(cursor)
+        query = query.filter(
+            (DocumentHistory.created_at < cursor_created_at) |
+            ((DocumentHistory.created_at == cursor_created_at) & (DocumentHistory.id < cursor_id))
+        )
+
+    # One extra row tells whether there is another page and gives the word delta of the last entry
+    rows = query.order_by(DocumentHistory.created_at.desc(), DocumentHistory.id.desc()).limit(limit + 1).all()
+
+    results = []
+    for index, row in enumerate(rows[:limit]):
+        previous = rows[index + 1] if index + 1 < len(rows) else None
+        results.append(DocumentHistorySummary(
+            id=row.id,
+            created_at=row.created_at,
+            size=row.content_size,
+            word_count=row.word_count,
+            word_delta=row.word_count - previous.word_count if previous else None
+        ))
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_history_cursor(last.created_at, last.id)
+
+    return DocumentHistoryPage(results=results, page_size=limit, next_cursor=next_cursor)
+
+@documents_router.get("/{doc_id}/history/{history_id}", response_model=DocumentHistoryResponse)
+def get_document_history_version(doc_id: int, history_id: int, request: Request, response: Response, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    document = db.query(Document).filter_by(id=doc_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    # History versions never change once written, so the id alone identifies the content. They
+    # are still revalidated on every use, since compaction may delete them.
+    etag = f'"history-{doc_id}-{history_id}"'
+
+    exists = db.query(DocumentHistory.id).filter_by(id=history_id, document_id=doc_id).first()
+    if not exists:
+        raise HTTPException(status_code=404, detail="History version not found")
+
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    response.headers.update(cache_headers(etag))
+    entry = db.query(DocumentHistory).filter_by(id=history_id).first()
+    return DocumentHistoryResponse(
+        id=entry.id,
+        document_id=entry.document_id,
+        content=load_version(db, entry),
+        created_at=entry.created_at
+    )
 
 @documents_router.get("/warmup", response_model=dict)
 async def warmup_endpoint(Authorize: AuthJWT = Depends()):
@@ -331,49 +843,30 @@ def get_user_stats(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
-    # Get user info
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    # Get total documents
-    total_documents = db.query(func.count(Document.id)).filter(Document.user_id == user_id).scalar()
-
-    # Get total rewrites by counting text chunks with different input and rewritten text
-    total_rewrites = db.query(func.count(TextChunks.id))\
-        .join(Document)\
-        .filter(
-            Document.user_id == user_id,
-            TextChunks.input_text_chunk != TextChunks.rewritten_text
-        ).scalar()
-
-    # Calculate time saved (20 mins per rewrite)
-    time_saved = total_rewrites * 20
-
-    # Get last activity timestamp from either document creation or history
-    last_doc = db.query(Document)\
-        .filter(Document.user_id == user_id)\
-        .order_by(Document.upload_date.desc())\
-        .first()
-    
-    last_history = db.query(DocumentHistory)\
-        .join(Document)\
-        .filter(Document.user_id == user_id)\
-        .order_by(DocumentHistory.created_at.desc())\
+    # Counters are maintained incrementally (see stats.py), so this is a single primary-key read
+    row = db.query(UserStats, User.email)\
+        .join(User, User.id == UserStats.user_id)\
+        .filter(UserStats.user_id == user_id)\
         .first()
 
-    last_activity = None
-    if last_doc and last_history:
-        last_activity = max(last_doc.upload_date, last_history.created_at)
-    elif last_doc:
-        last_activity = last_doc.upload_date
-    elif last_history:
-        last_activity = last_history.created_at
+    if not row:
+        if not db.query(User.id).filter(User.id == user_id).first():
+            raise HTTPException(status_code=404, detail="User not found")
+        # First read for a user created before stats were tracked
+        reconcile_user_stats(db, user_id)
+        db.commit()
+        row = db.query(UserStats, User.email)\
+            .join(User, User.id == UserStats.user_id)\
+            .filter(UserStats.user_id == user_id)\
+            .first()
+
+    stats, email = row
 
     return {
-        "email": user.email,
-        "totalDocuments": total_documents,
-        "totalRewrites": total_rewrites,
-        "timeSaved": time_saved,
-        "lastActivity": last_activity.isoformat() if last_activity else None
+        "email": email,
+        "totalDocuments": stats.total_documents,
+        "totalRewrites": stats.total_rewrites,
+        # Calculate time saved (20 mins per rewrite)
+        "timeSaved": stats.total_rewrites * 20,
+        "lastActivity": stats.last_activity.isoformat() if stats.last_activity else None
     }
\ No newline at end of file
@@ -1,46 +1,39 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import os
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response
 from fastapi_jwt_auth import AuthJWT
 from sqlalchemy.orm import Session
-from api_project.models import Document, TextChunks, Suggestion, FinalScore, InitialScore
+from api_project.models import Document, TextChunks, Suggestion, content_hash
 from api_project.database import get_db
 from api_project.schemas import SuggestionResponse
-from api_project.schemas import ChatRequest, ChatMessage, ChatResponse, RewriteRequest
-from typing import List
-from api_project.processing import chat_bot, rewrite_text_with_prompt, get_scoresSA
+from api_project.schemas import ChatRequest, ChatMessage, ChatResponse, RewriteRequest, SuggestionApplyRequest
+from typing import List, Tuple
+from api_project.processing import chat_bot, rewrite_text_with_prompt, TextScores
+from api_project.chunks import (
+    load_chunks, document_text, keep_whitespace, score_values, aggregate_chunk_scores, rescore_chunks,
+    score_unsaved_texts, store_rescored_text
+)
+from api_project.stats import is_rewritten, record_rewrite_change
+from api_project.suggestions import generate_document_suggestions, generation_progress
+from api_project.http_cache import etag_matches, cache_headers, not_modified, document_etag, bump_document_version
 
 rewrite_router = APIRouter()
 
-def update_scores(db: Session, text_chunk: TextChunks, scores: List[float], is_initial: bool = False) -> None:
-    """Helper function to update scores in the database"""
-    score_model = InitialScore if is_initial else FinalScore
-    existing_score = db.query(score_model).filter_by(text_chunk_id=text_chunk.id).first()
-    
-    if existing_score:
-        existing_score.score = scores[0]
-        existing_score.optimism = scores[1]
-        existing_score.confidence = scores[2]
-        existing_score.forecast = scores[3]
-    else:
-        new_score = score_model(
-            text_chunk_id=text_chunk.id,
-            score=scores[0],
-            optimism=scores[1],
-            confidence=scores[2],
-            forecast=scores[3]
-        )
-        db.add(new_score)
-    
-    db.commit()
+# Upper bound on rewrite candidates generated per chunk in one request
+MAX_REWRITE_CANDIDATES = 5
+
+# LLM requests in flight per rewrite request
+REWRITE_CONCURRENCY = int(os.environ.get('REWRITE_CONCURRENCY', 4))
 
 def text_changed_and_update(text_chunk: TextChunks, new_text: str) -> bool:
     """Check if text has changed and update if it has"""
-    if text_chunk.rewritten_text != new_text:
+    if text_chunk.rewritten_text_hash != content_hash(new_text):
         text_chunk.rewritten_text = new_text
         return True
     return False
 
 @rewrite_router.get('/{document_id}/suggestions', response_model=List[SuggestionResponse])
-def get_suggestions(document_id: int, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+def get_suggestions(document_id: int, request: Request, response: Response, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
@@ -48,90 +41,267 @@ def get_suggestions(document_id: int, Authorize: AuthJWT = Depends(), db: Sessio
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
+    etag = document_etag("suggestions", document)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
+    # Set while background generation is still running; the list then holds partial results
+    if document_id in generation_progress:
+        response.headers["X-Suggestions-Pending"] = str(generation_progress[document_id])
+
     suggestions = db.query(Suggestion).filter_by(document_id=document_id).all()
     return suggestions
 
+@rewrite_router.post('/{document_id}/suggestions', response_model=dict, status_code=202)
+def generate_suggestions(document_id: int, background_tasks: BackgroundTasks, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    '''
+    Start generating suggestions for every paragraph of the document in the background.
+    '''
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    document = db.query(Document).filter_by(id=document_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+    if document_id in generation_progress:
+        raise HTTPException(status_code=409, detail="Suggestions are already being generated")
+
+    background_tasks.add_task(generate_document_suggestions, document_id)
+    return {"message": "Suggestion generation started"}
+
+def apply_suggestions(chunks: List[TextChunks], suggestions: List[Suggestion]) -> Tuple[List[TextChunks], List[int]]:
+    '''
+    Apply suggestions in order to the accumulated rewritten text of each chunk, so earlier
+    applications are kept. Each suggestion replaces the first occurrence of its text only.
+    Returns the chunks whose text changed and the ids of the suggestions whose text was found.
+    '''
+    texts = [chunk.rewritten_text for chunk in chunks]
+    applied = []
+    for suggestion in suggestions:
+        for i, text in enumerate(texts):
+            if suggestion.input_text_chunk in text:
+                # A suggestion is made for one sentence; the same words elsewhere are left alone
+                texts[i] = text.replace(suggestion.input_text_chunk, suggestion.rewritten_text, 1)
+                applied.append(suggestion.id)
+                break
+
+    changed_chunks = [chunk for chunk, text in zip(chunks, texts) if text_changed_and_update(chunk, text)]
+    return changed_chunks, applied
+
+@rewrite_router.put('/{document_id}/suggestions/apply', response_model=dict)
+async def apply_suggestions_batch(document_id: int, apply_request: SuggestionApplyRequest, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    '''
+    Apply several suggestions in the given order, rescore the changed chunks once and delete
+    the suggestions, all in one transaction.
+    '''
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+
+    document = db.query(Document).filter_by(id=document_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    suggestion_ids = list(dict.fromkeys(apply_request.suggestion_ids))
+    suggestions = db.query(Suggestion).filter(Suggestion.document_id == document_id, Suggestion.id.in_(suggestion_ids)).all()
+    if len(suggestions) != len(suggestion_ids):
+        raise HTTPException(status_code=404, detail="Suggestion not found")
+    by_id = {suggestion.id: suggestion for suggestion in suggestions}
+
+    chunks = load_chunks(db, document_id, with_scores=True)
+    if not chunks:
+        raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
+
+    was_rewritten = is_rewritten(chunks)
+    changed_chunks, applied = apply_suggestions(chunks, [by_id[suggestion_id] for suggestion_id in suggestion_ids])
+    if changed_chunks:
+        await rescore_chunks(db, changed_chunks)
+        record_rewrite_change(db, user_id, was_rewritten, is_rewritten(chunks))
+
+    result = {
+        "message": "Suggestions applied and deleted successfully",
+        "applied": applied,
+        # Suggestions whose text no longer occurs in the document are deleted without changes
+        "skipped": [suggestion_id for suggestion_id in suggestion_ids if suggestion_id not in applied],
+        "updated_text": document_text(chunks, rewritten=True),
+        "scores": aggregate_chunk_scores(chunks)
+    }
+
+    db.query(Suggestion)\
+        .filter(Suggestion.document_id == document_id, Suggestion.id.in_(suggestion_ids))\
+        .delete(synchronize_session=False)
+    bump_document_version(db, document_id)
+    db.commit()
+
+    return result
+
 @rewrite_router.put('/{document_id}/suggestions/{suggestion_id}', response_model=dict)
 async def apply_suggestion(document_id: int, suggestion_id: int, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
+    document = db.query(Document).filter_by(id=document_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
     suggestion = db.query(Suggestion).filter_by(id=suggestion_id, document_id=document_id).first()
     if not suggestion:
         raise HTTPException(status_code=404, detail="Suggestion not found")
 
-    text_chunk = db.query(TextChunks).filter_by(document_id=document_id).first()
-    if not text_chunk:
+    chunks = load_chunks(db, document_id, with_scores=True)
+    if not chunks:
         raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
 
-    # Replace only the specific part of the text chunk
-    new_text = text_chunk.input_text_chunk.replace(suggestion.input_text_chunk, suggestion.rewritten_text)
-    
-    # Only update scores if text actually changed
-    if text_changed_and_update(text_chunk, new_text):
-        scores = await get_scoresSA(new_text)
-        update_scores(db, text_chunk, scores)
-        db.commit()
+    # Replace only the specific part of the chunk that contains it, and rescore only that chunk
+    was_rewritten = is_rewritten(chunks)
+    changed_chunks, _ = apply_suggestions(chunks, [suggestion])
+    if changed_chunks:
+        await rescore_chunks(db, changed_chunks)
+        record_rewrite_change(db, user_id, was_rewritten, is_rewritten(chunks))
+    updated_text = document_text(chunks, rewritten=True)
 
     # Delete the applied suggestion
     db.delete(suggestion)
+    bump_document_version(db, document_id)
     db.commit()
 
-    return {"message": "Suggestion applied and deleted successfully", "updated_text": text_chunk.rewritten_text}
+    return {"message": "Suggestion applied and deleted successfully", "updated_text": updated_text}
 
 @rewrite_router.delete('/{document_id}/suggestions/{suggestion_id}', response_model=dict)
 def delete_suggestion(document_id: int, suggestion_id: int, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
 
+    document = db.query(Document).filter_by(id=document_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
     suggestion = db.query(Suggestion).filter_by(id=suggestion_id, document_id=document_id).first()
     if not suggestion:
         raise HTTPException(status_code=404, detail="Suggestion not found")
 
     db.delete(suggestion)
+    bump_document_version(db, document_id)
     db.commit()
 
     return {"message": "Suggestion deleted successfully"}
 
+async def rewrite_candidates(db: Session, chunks: List[TextChunks], prompt: str, count: int) -> List[List[Tuple[str, TextScores]]]:
+    '''
+    Generate count rewrites of every chunk, at most REWRITE_CONCURRENCY at a time, and score all
+    of them in one FinBERT dispatch. Returns each chunk's (text, scores) candidates ranked by
+    overall score, best first.
+    '''
+    semaphore = asyncio.Semaphore(REWRITE_CONCURRENCY or 1)
+
+    async def rewrite(text):
+        async with semaphore:
+            return await rewrite_text_with_prompt(text, prompt)
+
+    texts = await asyncio.gather(*(rewrite(chunk.input_text_chunk) for chunk in chunks for _ in range(count)))
+    texts = [keep_whitespace(chunks[i // count].input_text_chunk, text) for i, text in enumerate(texts)]
+    results = await score_unsaved_texts(db, texts)
+
+    ranked = []
+    for i in range(len(chunks)):
+        candidates = list(zip(texts[i * count:(i + 1) * count], results[i * count:(i + 1) * count]))
+        # Stable sort, so ties keep generation order
+        ranked.append(sorted(candidates, key=lambda candidate: candidate[1].scores[0], reverse=True))
+    return ranked
+
+def keep_best_candidates(chunks: List[TextChunks], ranked: List[List[Tuple[str, TextScores]]]) -> List[TextChunks]:
+    '''Persist each chunk's best candidate with its scores. Returns the chunks that changed.'''
+    changed_chunks = []
+    for chunk, candidates in zip(chunks, ranked):
+        best_text, best_result = candidates[0]
+        if text_changed_and_update(chunk, best_text) or chunk.final_score is None:
+            store_rescored_text(chunk, best_result)
+            changed_chunks.append(chunk)
+    return changed_chunks
+
+def candidate_list(candidates: List[Tuple[str, TextScores]]) -> List[dict]:
+    return [{"rewritten_text": text, "scores": result.scores} for text, result in candidates]
+
+def check_candidate_count(rewrite_request: RewriteRequest) -> None:
+    if not 1 <= rewrite_request.candidates <= MAX_REWRITE_CANDIDATES:
+        raise HTTPException(status_code=400, detail=f"candidates must be between 1 and {MAX_REWRITE_CANDIDATES}")
+
 @rewrite_router.post('/{document_id}/rewrite', response_model=dict)
 async def rewrite_text(document_id: int, rewrite_request: RewriteRequest, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
+    check_candidate_count(rewrite_request)
 
     document = db.query(Document).filter_by(id=document_id, user_id=user_id).first()
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
 
-    text_chunk = db.query(TextChunks).filter_by(document_id=document_id).first()
-    if not text_chunk:
+    chunks = load_chunks(db, document_id, with_scores=True)
+    if not chunks:
         raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
 
-    # Get the rewritten text using the prompt
-    rewritten_text = rewrite_text_with_prompt(text_chunk.input_text_chunk, rewrite_request.prompt)
+    # All candidates of all chunks are generated concurrently and scored together;
+    # only chunks whose best candidate changed their text (or that were never scored) are stored
+    ranked = await rewrite_candidates(db, chunks, rewrite_request.prompt, rewrite_request.candidates)
+    was_rewritten = is_rewritten(chunks)
+    changed_chunks = keep_best_candidates(chunks, ranked)
+    if changed_chunks:
+        record_rewrite_change(db, user_id, was_rewritten, is_rewritten(chunks))
 
-    # Only calculate and update scores if text has changed
-    scores = None
-    if text_changed_and_update(text_chunk, rewritten_text):
-        scores = await get_scoresSA(rewritten_text)
-        update_scores(db, text_chunk, scores)
+    result = {
+        "message": "Text rewritten successfully",
+        "rewritten_text": document_text(chunks, rewritten=True),
+        "scores": aggregate_chunk_scores(chunks),
+        "candidates": [
+            {"text_chunk_id": chunk.id, "candidates": candidate_list(candidates)}
+            for chunk, candidates in zip(chunks, ranked)
+        ]
+    }
+
+    if changed_chunks:
+        bump_document_version(db, document_id)
         db.commit()
-    else:
-        # If text hasn't changed, use existing scores
-        final_score = db.query(FinalScore).filter_by(text_chunk_id=text_chunk.id).first()
-        if final_score:
-            scores = [final_score.score, final_score.optimism, final_score.confidence, final_score.forecast]
-        else:
-            # If no existing scores, calculate them
-            scores = await get_scoresSA(rewritten_text)
-            update_scores(db, text_chunk, scores)
-            db.commit()
-
-    return {
+
+    return result
+
+@rewrite_router.post('/{document_id}/chunks/{chunk_id}/rewrite', response_model=dict)
+async def rewrite_chunk(document_id: int, chunk_id: int, rewrite_request: RewriteRequest, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    '''
+    Rewrite a single chunk. Only that chunk is sent to the model and rescored.
+    '''
+    Authorize.jwt_required()
+    user_id = Authorize.get_jwt_subject()
+    check_candidate_count(rewrite_request)
+
+    document = db.query(Document).filter_by(id=document_id, user_id=user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    chunks = load_chunks(db, document_id, with_scores=True)
+    chunk = next((chunk for chunk in chunks if chunk.id == chunk_id), None)
+    if not chunk:
+        raise HTTPException(status_code=404, detail="Text chunk not found for the given document")
+
+    ranked = await rewrite_candidates(db, [chunk], rewrite_request.prompt, rewrite_request.candidates)
+    was_rewritten = is_rewritten(chunks)
+    changed = bool(keep_best_candidates([chunk], ranked))
+    if changed:
+        record_rewrite_change(db, user_id, was_rewritten, is_rewritten(chunks))
+
+    result = {
         "message": "Text rewritten successfully",
-        "rewritten_text": rewritten_text,
-        "scores": scores
+        "text_chunk_id": chunk.id,
+        "rewritten_text": chunk.rewritten_text,
+        "scores": score_values(chunk.final_score),
+        "document_scores": aggregate_chunk_scores(chunks),
+        "candidates": candidate_list(ranked[0])
     }
 
+    if changed:
+        bump_document_version(db, document_id)
+        db.commit()
+
+    return result
+
 @rewrite_router.post('/chat', response_model=ChatResponse)
 def chat_with_bot(chat_request: ChatRequest, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
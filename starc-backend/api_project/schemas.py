@@ -19,6 +19,23 @@ class DocumentCreate(BaseModel):
     title: str
     text: str
 
+class DocumentBatchCreate(BaseModel):
+    documents: List[DocumentCreate]
+
+class DocumentBatchItemResult(BaseModel):
+    index: int
+    title: str
+    status: str
+    document_id: Optional[int] = None
+    text_chunk_id: Optional[int] = None
+    word_count: Optional[int] = None
+    error: Optional[str] = None
+
+class DocumentBatchResponse(BaseModel):
+    created: int
+    failed: int
+    results: List[DocumentBatchItemResult]
+
 class DocumentResponse(BaseModel):
     id: int
     title: str
@@ -44,6 +61,25 @@ class TextChunkResponse(BaseModel):
     class Config:
         orm_mode = True
 
+class ChunkScores(BaseModel):
+    score: float
+    optimism: float
+    forecast: float
+    confidence: float
+
+class TextChunkDetail(BaseModel):
+    id: int
+    position: int
+    input_text_chunk: str
+    rewritten_text: str
+    sentence_count: int
+    initial_scores: Optional[ChunkScores] = None
+    final_scores: Optional[ChunkScores] = None
+
+class TextChunkUpdateResponse(BaseModel):
+    chunk: TextChunkDetail
+    document_scores: Optional[ChunkScores] = None
+
 class ChatBotRequest(BaseModel):
     prompt: str
 
@@ -88,10 +124,15 @@ class ChatResponse(BaseModel):
     
 class RewriteRequest(BaseModel):
     prompt: str
+    # Rewrites generated per chunk; the best scoring one is kept
+    candidates: int = 1
     
 class SaveRewriteRequest(BaseModel):
        rewritten_text: str
 
+class SuggestionApplyRequest(BaseModel):
+    suggestion_ids: List[int]
+
 class DocumentHistoryCreate(BaseModel):
     content: str
 
@@ -102,4 +143,16 @@ class DocumentHistoryResponse(BaseModel):
     created_at: datetime
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class DocumentHistorySummary(BaseModel):
+    id: int
+    created_at: datetime
+    size: int
+    word_count: int
+    word_delta: Optional[int] = None
+
+class DocumentHistoryPage(BaseModel):
+    results: List[DocumentHistorySummary]
+    page_size: int
+    next_cursor: Optional[str] = None
\ No newline at end of file
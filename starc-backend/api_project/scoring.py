@@ -0,0 +1,133 @@
+"""
+Composite score formulas
+
+The overall, optimism, confidence and FLS scores are pure functions of the per-sentence
+FinBERT probabilities. Every revision of the weights or formulas is registered in FORMULAS
+under a new version and SCORING_VERSION is bumped. Score rows record the version that
+produced them, so stored scores can be refreshed from the stored SentenceScore rows without
+calling FinBERT again (see recompute_scores.py).
+
+Formulas work on a packed (sentences x 6) float array, one row per sentence with the columns
+in PROBABILITY_COLUMNS order, so every aggregate is a single vectorized pass over it.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+# Returned when a text has no sentences or none of them could be scored
+DEFAULT_SCORES = [0.33, 0.33, 0.34, 0.33]
+
+# Formula used for new scores
+SCORING_VERSION = 1
+
+# Column layout of the packed probability array
+PROBABILITY_COLUMNS = ('Positive', 'Neutral', 'Negative', 'Specific FLS', 'Non-specific FLS', 'Not FLS')
+POSITIVE, NEUTRAL, NEGATIVE, SPECIFIC_FLS, NON_SPECIFIC_FLS, NOT_FLS = range(len(PROBABILITY_COLUMNS))
+
+# Percentiles of the per-sentence overall score reported by score_distribution
+DISTRIBUTION_PERCENTILES = (10, 25, 50, 75, 90)
+
+ScoringFormula = namedtuple('ScoringFormula', ['sentence_scores', 'compute_scores'])
+
+# Weights for overall score calculation
+WEIGHTS_V1 = {
+    'Positive': 1.0,
+    'Neutral': 0.7,
+    'Negative': 0.0,
+    'Specific FLS': 1.0,
+    'Non-specific FLS': 0.0,
+    'Not FLS': 1.0
+}
+_WEIGHT_VECTOR_V1 = np.array([WEIGHTS_V1[column] for column in PROBABILITY_COLUMNS])
+
+
+def pack_probabilities(raw_sentence_scores):
+    '''
+    Pack raw {'tone': {...}, 'fls': {...}} sentence scores into a contiguous (sentences x 6) float64 array.
+    Sentences that failed to score (None) are dropped.
+    '''
+    rows = [
+        (s['tone']['Positive'], s['tone']['Neutral'], s['tone']['Negative'],
+         s['fls']['Specific FLS'], s['fls']['Non-specific FLS'], s['fls']['Not FLS'])
+        for s in raw_sentence_scores if s is not None
+    ]
+    return np.array(rows, dtype=np.float64).reshape(-1, len(PROBABILITY_COLUMNS))
+
+
+def _truncate(value):
+    # Truncate to 2 decimal places
+    return int(float(value) * 100) / 100
+
+
+def _sentence_scores_v1(probabilities):
+    max_score = 2.0  # Sum of max weights
+    return probabilities @ _WEIGHT_VECTOR_V1 / max_score * 100
+
+
+def _compute_scores_v1(probabilities):
+    # Column sums across all sentences
+    sums = probabilities.sum(axis=0)
+
+    # Overall score for each sentence, averaged
+    overall_score = _sentence_scores_v1(probabilities).mean()
+
+    # Calculate optimism = (Positive) / (Positive + Negative) * 100
+    total_pos_neg = sums[POSITIVE] + sums[NEGATIVE]
+    optimism = (sums[POSITIVE] / total_pos_neg * 100) if total_pos_neg > 0 else 50
+
+    # Calculate confidence = (Positive + Neutral) / (Positive + Negative + Neutral) * 100
+    total_tone = sums[POSITIVE] + sums[NEGATIVE] + sums[NEUTRAL]
+    confidence = ((sums[POSITIVE] + sums[NEUTRAL]) / total_tone * 100) if total_tone > 0 else 50
+
+    # Calculate specific FLS = Specific FLS / (Specific FLS + Non-specific FLS) * 100
+    total_fls = sums[SPECIFIC_FLS] + sums[NON_SPECIFIC_FLS]
+    specific_fls = (sums[SPECIFIC_FLS] / total_fls * 100) if total_fls > 0 else 0
+
+    return [_truncate(overall_score), _truncate(optimism), _truncate(confidence), _truncate(specific_fls)]
+
+
+FORMULAS = {
+    1: ScoringFormula(_sentence_scores_v1, _compute_scores_v1),
+}
+
+
+def sentence_score(scores, version=SCORING_VERSION):
+    '''
+    Overall score (0-100) of a single sentence from its raw tone and FLS probabilities.
+    '''
+    return float(FORMULAS[version].sentence_scores(pack_probabilities([scores]))[0])
+
+
+def compute_scores(raw_sentence_scores, version=SCORING_VERSION):
+    '''
+    Collapse per-sentence FinBERT probabilities into [overall_score, optimism, confidence, specific_fls].
+    Accepts raw sentence dicts (None entries are skipped) or an already packed array. Pure: no I/O and no model calls.
+    '''
+    probabilities = raw_sentence_scores if isinstance(raw_sentence_scores, np.ndarray) else pack_probabilities(raw_sentence_scores)
+    if not len(probabilities):
+        return list(DEFAULT_SCORES)
+    return FORMULAS[version].compute_scores(probabilities)
+
+
+def score_distribution(raw_sentence_scores, version=SCORING_VERSION):
+    '''
+    Spread of the per-sentence overall scores: percentiles, variance and the share of sentences
+    whose most likely tone is Negative. None when no sentence was scored.
+    '''
+    probabilities = raw_sentence_scores if isinstance(raw_sentence_scores, np.ndarray) else pack_probabilities(raw_sentence_scores)
+    if not len(probabilities):
+        return None
+
+    scores = FORMULAS[version].sentence_scores(probabilities)
+    tone = probabilities[:, [POSITIVE, NEUTRAL, NEGATIVE]]
+    negative = tone.argmax(axis=1) == 2
+    return {
+        "sentence_count": len(probabilities),
+        "percentiles": {
+            f"p{percentile}": round(float(value), 2)
+            for percentile, value in zip(DISTRIBUTION_PERCENTILES, np.percentile(scores, DISTRIBUTION_PERCENTILES))
+        },
+        "negative_share": round(float(negative.mean()), 4),
+        "score_variance": round(float(scores.var()), 2),
+    }
@@ -0,0 +1,141 @@
+"""
+Incrementally maintained per-user dashboard statistics
+
+Routes that create, rewrite, delete or version documents adjust the user's UserStats row
+in the same transaction as the change itself. The counters are updated with SQL
+increments so concurrent requests do not overwrite each other. A periodic reconciliation
+(a job in jobs.py) recomputes them from the source tables to repair any drift.
+"""
+
+import logging
+import os
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+
+from api_project.database import upsert
+from api_project.models import User, UserStats, Document, TextChunks, DocumentHistory
+
+logger = logging.getLogger(__name__)
+
+# Seconds between background reconciliation passes (0 disables the job, see jobs.py)
+STATS_RECONCILE_INTERVAL = int(os.environ.get('STATS_RECONCILE_INTERVAL', 24 * 60 * 60))
+
+
+def is_rewritten(text_chunks: Iterable[TextChunks]) -> bool:
+    '''A document counts as one rewrite once any of its chunks differs from its input.'''
+    return any(chunk.input_text_hash != chunk.rewritten_text_hash for chunk in text_chunks)
+
+
+def compute_user_stats(db: Session, user_id: int) -> dict:
+    '''Compute the statistics from the source tables. Used on first read and for reconciliation.'''
+    total_documents = db.query(func.count(Document.id)).filter(Document.user_id == user_id).scalar()
+
+    total_rewrites = db.query(func.count(func.distinct(TextChunks.document_id)))\
+        .join(Document)\
+        .filter(
+            Document.user_id == user_id,
+            TextChunks.input_text_hash != TextChunks.rewritten_text_hash
+        ).scalar()
+
+    last_upload = db.query(func.max(Document.upload_date)).filter(Document.user_id == user_id).scalar()
+    last_history = db.query(func.max(DocumentHistory.created_at))\
+        .join(Document)\
+        .filter(Document.user_id == user_id)\
+        .scalar()
+    activity = [t for t in (last_upload, last_history) if t is not None]
+
+    return {
+        "total_documents": total_documents,
+        "total_rewrites": total_rewrites,
+        "last_activity": max(activity) if activity else None,
+    }
+
+
+def reconcile_user_stats(db: Session, user_id: int) -> bool:
+    '''
+    Recompute a user's statistics and store them if they drifted.
+    Activity is never moved backwards, since deleting a document does not undo having worked on it.
+    Returns True if the row was created or repaired. The caller is responsible for committing.
+    '''
+    db.flush()
+    computed = compute_user_stats(db, user_id)
+    stats = db.get(UserStats, user_id)
+
+    if stats is None:
+        # A concurrent first read may insert the row too; both computed the same values
+        upsert(db, UserStats, dict(user_id=user_id, **computed), update=lambda excluded: computed)
+        return True
+
+    last_activity = computed["last_activity"]
+    if stats.last_activity is not None and (last_activity is None or stats.last_activity > last_activity):
+        last_activity = stats.last_activity
+
+    if (stats.total_documents, stats.total_rewrites, stats.last_activity) == \
+            (computed["total_documents"], computed["total_rewrites"], last_activity):
+        return False
+
+    stats.total_documents = computed["total_documents"]
+    stats.total_rewrites = computed["total_rewrites"]
+    stats.last_activity = last_activity
+    return True
+
+
+def _adjust(db: Session, user_id: int, documents: int = 0, rewrites: int = 0, activity: Optional[datetime] = None) -> None:
+    values = {UserStats.updated_at: datetime.utcnow()}
+    if documents:
+        values[UserStats.total_documents] = UserStats.total_documents + documents
+    if rewrites:
+        values[UserStats.total_rewrites] = UserStats.total_rewrites + rewrites
+    if activity is not None:
+        values[UserStats.last_activity] = case(
+            ((UserStats.last_activity.is_(None)) | (UserStats.last_activity < activity), activity),
+            else_=UserStats.last_activity
+        )
+
+    updated = db.query(UserStats).filter(UserStats.user_id == user_id).update(values, synchronize_session=False)
+    if not updated:
+        # No row yet (user created before stats existed): build it from the source tables, which
+        # include this change. If a concurrent request inserted it first, apply the change to theirs.
+        db.flush()
+        upsert(
+            db, UserStats, dict(user_id=user_id, updated_at=datetime.utcnow(), **compute_user_stats(db, user_id)),
+            update=lambda excluded: {column.key: value for column, value in values.items()}
+        )
+
+def record_document_created(db: Session, user_id: int, rewritten: bool = False, at: Optional[datetime] = None, count: int = 1) -> None:
+    _adjust(db, user_id, documents=count, rewrites=int(rewritten) * count, activity=at or datetime.utcnow())
+
+
+def record_document_deleted(db: Session, document: Document) -> None:
+    '''Call before deleting the document so its rewritten chunks can still be counted.'''
+    rewritten = db.query(TextChunks.id).filter(
+        TextChunks.document_id == document.id,
+        TextChunks.input_text_hash != TextChunks.rewritten_text_hash
+    ).first() is not None
+    _adjust(db, document.user_id, documents=-1, rewrites=-int(rewritten))
+
+
+def record_rewrite_change(db: Session, user_id: int, was_rewritten: bool, now_rewritten: bool) -> None:
+    '''Record a change to a document's chunks, given the document's rewritten state before and after.'''
+    _adjust(db, user_id, rewrites=int(now_rewritten) - int(was_rewritten), activity=datetime.utcnow())
+
+
+def record_activity(db: Session, user_id: int, at: Optional[datetime] = None) -> None:
+    _adjust(db, user_id, activity=at or datetime.utcnow())
+
+
+def reconcile_all_user_stats(db: Session) -> int:
+    '''Reconcile every user's statistics. Returns the number of rows that were repaired.'''
+    repaired = 0
+    for (user_id,) in db.query(User.id).all():
+        try:
+            if reconcile_user_stats(db, user_id):
+                repaired += 1
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Stats reconciliation failed for user {user_id}: {str(e)}")
+    return repaired
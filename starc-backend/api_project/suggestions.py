@@ -0,0 +1,120 @@
+"""
+Background suggestion generation
+
+After a document is ingested its paragraphs (chunks) are sent to the LLM for sentence-level
+suggestions. Up to SUGGESTION_CONCURRENCY requests run at once on the async client. Each
+paragraph's suggestions are bulk-inserted and committed as soon as that paragraph completes,
+with a document version bump, so GET /fix/{id}/suggestions shows partial results while the
+rest are still generating. The job runs after the response is sent, so it opens its own short
+database sessions (in a worker thread) instead of holding the request's session across the LLM
+calls.
+
+Progress is tracked per process in generation_progress; the suggestions route reports it.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Dict, List
+
+from fastapi import BackgroundTasks
+from sqlalchemy import insert
+
+from api_project.database import SessionLocal
+from api_project.models import Document, TextChunks, Suggestion
+from api_project.processing import generate_sentence_suggestions
+from api_project.http_cache import bump_document_version
+
+logger = logging.getLogger(__name__)
+
+# LLM requests in flight per generation job (0 disables generation after ingest)
+SUGGESTION_CONCURRENCY = int(os.environ.get('SUGGESTION_CONCURRENCY', 4))
+
+# Paragraphs still waiting for suggestions, per document with a running job
+generation_progress: Dict[int, int] = {}
+
+
+def suggestion_rows(document_id: int, paragraph: str, suggestions: List[dict]) -> List[dict]:
+    '''Suggestion rows for one paragraph. Entries whose original text is not in the paragraph, or that change nothing, are dropped.'''
+    rows = []
+    seen = set()
+    for suggestion in suggestions:
+        if not isinstance(suggestion, dict):
+            continue
+        original = (suggestion.get('original') or '').strip()
+        suggested = (suggestion.get('suggested') or '').strip()
+        if not original or not suggested or original == suggested or original not in paragraph or original in seen:
+            continue
+        seen.add(original)
+        rows.append({"document_id": document_id, "input_text_chunk": original, "rewritten_text": suggested})
+    return rows
+
+
+def _load_paragraphs(document_id: int) -> List[str]:
+    with SessionLocal() as db:
+        return [
+            text for (text,) in db.query(TextChunks.input_text_chunk)
+            .filter_by(document_id=document_id)
+            .order_by(TextChunks.position, TextChunks.id)
+            if text and text.strip()
+        ]
+
+
+def _store_suggestions(document_id: int, rows: List[dict]) -> bool:
+    '''Store one paragraph's suggestions. Returns False if the document no longer exists.'''
+    with SessionLocal() as db:
+        if not db.query(Document.id).filter_by(id=document_id).first():
+            return False
+        db.execute(insert(Suggestion), rows)
+        bump_document_version(db, document_id)
+        db.commit()
+        return True
+
+
+async def generate_document_suggestions(document_id: int, concurrency: int = None) -> int:
+    '''
+    Generate suggestions for every paragraph of a document concurrently and store them as each
+    paragraph completes. Returns the number of suggestions stored. Failed paragraphs are logged
+    and skipped.
+    '''
+    concurrency = concurrency or SUGGESTION_CONCURRENCY or 1
+    paragraphs = await asyncio.to_thread(_load_paragraphs, document_id)
+    if not paragraphs or document_id in generation_progress:
+        return 0
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate(paragraph):
+        async with semaphore:
+            try:
+                return paragraph, await generate_sentence_suggestions(paragraph)
+            except Exception as e:
+                logger.error(f"Suggestion generation failed for document {document_id}: {str(e)}")
+                return paragraph, []
+
+    stored = 0
+    generation_progress[document_id] = len(paragraphs)
+    tasks = [asyncio.create_task(generate(paragraph)) for paragraph in paragraphs]
+    try:
+        for completed in asyncio.as_completed(tasks):
+            paragraph, suggestions = await completed
+            generation_progress[document_id] -= 1
+            rows = suggestion_rows(document_id, paragraph, suggestions)
+            if not rows:
+                continue
+            # Stop if the document was deleted while suggestions were generating
+            if not await asyncio.to_thread(_store_suggestions, document_id, rows):
+                break
+            stored += len(rows)
+    finally:
+        for task in tasks:
+            task.cancel()
+        generation_progress.pop(document_id, None)
+
+    return stored
+
+
+def schedule_suggestions(background_tasks: BackgroundTasks, document_id: int) -> None:
+    '''Generate suggestions for a newly ingested document after the response is sent, unless disabled.'''
+    if SUGGESTION_CONCURRENCY > 0:
+        background_tasks.add_task(generate_document_suggestions, document_id)
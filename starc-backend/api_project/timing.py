@@ -0,0 +1,136 @@
+"""
+Per-request phase timing
+
+span(name) times a phase of the current request, such as PDF extraction, FinBERT warmup and
+dispatch, score aggregation or an OpenAI call. Every database statement and commit is timed
+too (as "db" and "db_commit") through SQLAlchemy events. Durations of spans with the same name
+add up, and spans inside tasks or threads started by the request count towards it because
+they inherit its context.
+
+TimingMiddleware gives every request an id (the client's X-Request-ID if it sent one) and
+returns it with a Server-Timing header listing the phases finished before the response started,
+plus "app" for the whole handler. Once the response is complete, including background tasks,
+one JSON line with the request id, route, status, duration and all spans is logged to the
+api_project.timing logger. Requests faster than REQUEST_LOG_MIN_MS are not logged.
+"""
+
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Requests that finish faster are not logged (0 logs every request)
+REQUEST_LOG_MIN_MS = float(os.environ.get('REQUEST_LOG_MIN_MS', 0))
+
+# Phase name -> [total seconds, count] of the request being handled
+_spans: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar('timing_spans', default=None)
+request_id: ContextVar[Optional[str]] = ContextVar('request_id', default=None)
+
+
+def record_span(name: str, seconds: float) -> None:
+    spans = _spans.get()
+    if spans is not None:
+        entry = spans.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+
+@contextmanager
+def span(name: str):
+    '''Time a phase of the current request. Does nothing outside a request.'''
+    if _spans.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def server_timing(spans: Dict[str, List[float]], total: float) -> str:
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, (seconds, _) in spans.items()]
+    parts.append(f"app;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info['timing_statement_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _statement_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('timing_statement_started', None)
+    if started is not None:
+        record_span('db', time.perf_counter() - started)
+
+
+@event.listens_for(Session, 'before_commit')
+def _commit_started(session):
+    session.info['timing_commit_started'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_commit')
+def _commit_finished(session):
+    started = session.info.pop('timing_commit_started', None)
+    if started is not None:
+        record_span('db_commit', time.perf_counter() - started)
+
+
+class TimingMiddleware:
+    '''ASGI middleware adding X-Request-ID and Server-Timing headers and logging each request's spans.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope['headers'])
+        current_id = headers.get(b'x-request-id', b'').decode('latin-1')[:64] or uuid.uuid4().hex
+        spans: Dict[str, List[float]] = {}
+        spans_token = _spans.set(spans)
+        id_token = request_id.set(current_id)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message = {**message, 'headers': [
+                    *message.get('headers', []),
+                    (b'x-request-id', current_id.encode('latin-1')),
+                    (b'server-timing', server_timing(spans, time.perf_counter() - start).encode('latin-1')),
+                ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            _spans.reset(spans_token)
+            request_id.reset(id_token)
+            if duration_ms >= REQUEST_LOG_MIN_MS:
+                route = scope.get('route')
+                logger.info(json.dumps({
+                    "request_id": current_id,
+                    "method": scope['method'],
+                    "route": route.path if route is not None else scope['path'],
+                    "status": status,
+                    "duration_ms": round(duration_ms, 1),
+                    "spans": {name: {"ms": round(seconds * 1000, 1), "count": count} for name, (seconds, count) in spans.items()},
+                }))
@@ -0,0 +1,33 @@
+"""add position and sentence_count to text_chunks
+
+Revision ID: 2f8a5d1c6e90
+Revises: a9c6e1f04b27
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2f8a5d1c6e90'
+down_revision: Union[str, None] = 'a9c6e1f04b27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing documents have a single chunk, so position 0 and any weight are correct for them
+    op.add_column('text_chunks', sa.Column('position', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('text_chunks', sa.Column('sentence_count', sa.Integer(), nullable=False, server_default='1'))
+    op.drop_index('idx_doc_chunks', table_name='text_chunks')
+    op.create_index('idx_doc_chunks', 'text_chunks', ['document_id', 'position'])
+
+
+def downgrade() -> None:
+    op.drop_index('idx_doc_chunks', table_name='text_chunks')
+    op.create_index('idx_doc_chunks', 'text_chunks', ['document_id'])
+    op.drop_column('text_chunks', 'sentence_count')
+    op.drop_column('text_chunks', 'position')
@@ -0,0 +1,59 @@
+"""store document history as compressed snapshots and deltas
+
+Revision ID: 3b7e91c4d2a8
+Revises: fa05da820a34
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from api_project.history import decode_history
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b7e91c4d2a8'
+down_revision: Union[str, None] = 'fa05da820a34'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing rows keep their text in content and are read back as uncompressed snapshots
+    op.add_column('document_history', sa.Column('payload', sa.LargeBinary(), nullable=True))
+    op.add_column('document_history', sa.Column('is_snapshot', sa.Boolean(), nullable=False, server_default=sa.true()))
+    op.add_column('document_history', sa.Column('base_id', sa.Integer(), nullable=True))
+    op.add_column('document_history', sa.Column('content_size', sa.Integer(), nullable=False, server_default='0'))
+    op.execute("UPDATE document_history SET content_size = octet_length(content) WHERE content IS NOT NULL")
+    op.alter_column('document_history', 'content', existing_type=sa.Text(), nullable=True)
+
+
+history = sa.table(
+    'document_history',
+    sa.column('id', sa.Integer), sa.column('document_id', sa.Integer), sa.column('content', sa.Text),
+    sa.column('payload', sa.LargeBinary), sa.column('is_snapshot', sa.Boolean), sa.column('base_id', sa.Integer),
+)
+
+
+def downgrade() -> None:
+    # Write the text of compressed rows back into content, one document's chain at a time
+    bind = op.get_bind()
+    document_ids = bind.execute(
+        sa.select(history.c.document_id).where(history.c.content.is_(None)).distinct()
+    ).scalars().all()
+    for document_id in document_ids:
+        entries = bind.execute(
+            sa.select(history).where(history.c.document_id == document_id).order_by(history.c.id)
+        ).all()
+        contents = decode_history(entries)
+        bind.execute(
+            history.update().where(history.c.id == sa.bindparam('entry_id')).values(content=sa.bindparam('text')),
+            [{"entry_id": entry.id, "text": contents[entry.id]} for entry in entries if entry.content is None],
+        )
+    op.alter_column('document_history', 'content', existing_type=sa.Text(), nullable=False)
+    op.drop_column('document_history', 'content_size')
+    op.drop_column('document_history', 'base_id')
+    op.drop_column('document_history', 'is_snapshot')
+    op.drop_column('document_history', 'payload')
@@ -0,0 +1,51 @@
+"""add user_stats table
+
+Revision ID: 5e0b8c3d7a14
+Revises: c41a7e2b9f63
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e0b8c3d7a14'
+down_revision: Union[str, None] = 'c41a7e2b9f63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('user_stats',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('total_documents', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('total_rewrites', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('last_activity', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+
+    # Backfill from the same queries /docs/user/stats used to run on every request
+    op.execute("""
+        INSERT INTO user_stats (user_id, total_documents, total_rewrites, last_activity, updated_at)
+        SELECT
+            u.id,
+            (SELECT count(*) FROM documents d WHERE d.user_id = u.id),
+            (SELECT count(*) FROM text_chunks t JOIN documents d ON t.document_id = d.id
+             WHERE d.user_id = u.id AND t.input_text_hash <> t.rewritten_text_hash),
+            GREATEST(
+                (SELECT max(d.upload_date) FROM documents d WHERE d.user_id = u.id),
+                (SELECT max(h.created_at) FROM document_history h JOIN documents d ON h.document_id = d.id
+                 WHERE d.user_id = u.id)
+            ),
+            now()
+        FROM users u
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('user_stats')
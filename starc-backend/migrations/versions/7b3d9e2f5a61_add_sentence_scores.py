@@ -0,0 +1,49 @@
+"""add sentence_scores table
+
+Revision ID: 7b3d9e2f5a61
+Revises: 2f8a5d1c6e90
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b3d9e2f5a61'
+down_revision: Union[str, None] = '2f8a5d1c6e90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing chunks get sentence rows the next time they are scored
+    op.create_table(
+        'sentence_scores',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('text_chunk_id', sa.Integer(), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('start_offset', sa.Integer(), nullable=False),
+        sa.Column('end_offset', sa.Integer(), nullable=False),
+        sa.Column('text_hash', sa.String(length=64), nullable=False),
+        sa.Column('positive', sa.Float(), nullable=True),
+        sa.Column('neutral', sa.Float(), nullable=True),
+        sa.Column('negative', sa.Float(), nullable=True),
+        sa.Column('specific_fls', sa.Float(), nullable=True),
+        sa.Column('non_specific_fls', sa.Float(), nullable=True),
+        sa.Column('not_fls', sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(['text_chunk_id'], ['text_chunks.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_sentence_scores_id'), 'sentence_scores', ['id'], unique=False)
+    op.create_index('idx_chunk_sentences', 'sentence_scores', ['text_chunk_id', 'position'], unique=False)
+    op.create_index('idx_sentence_text_hash', 'sentence_scores', ['text_hash'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_sentence_text_hash', table_name='sentence_scores')
+    op.drop_index('idx_chunk_sentences', table_name='sentence_scores')
+    op.drop_index(op.f('ix_sentence_scores_id'), table_name='sentence_scores')
+    op.drop_table('sentence_scores')
@@ -0,0 +1,49 @@
+"""add word_count to document_history
+
+Revision ID: 8d2f4a6c1e05
+Revises: 3b7e91c4d2a8
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from api_project.history import decode_history
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d2f4a6c1e05'
+down_revision: Union[str, None] = '3b7e91c4d2a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+history = sa.table(
+    'document_history',
+    sa.column('id', sa.Integer), sa.column('document_id', sa.Integer), sa.column('content', sa.Text),
+    sa.column('payload', sa.LargeBinary), sa.column('is_snapshot', sa.Boolean), sa.column('base_id', sa.Integer),
+    sa.column('word_count', sa.Integer),
+)
+
+
+def upgrade() -> None:
+    op.add_column('document_history', sa.Column('word_count', sa.Integer(), nullable=False, server_default='0'))
+    # Backfill every existing row, legacy or compressed, by rebuilding each document's chain;
+    # counted the same way as new versions (see history.py)
+    bind = op.get_bind()
+    document_ids = bind.execute(sa.select(history.c.document_id).distinct()).scalars().all()
+    for document_id in document_ids:
+        entries = bind.execute(
+            sa.select(history).where(history.c.document_id == document_id).order_by(history.c.id)
+        ).all()
+        contents = decode_history(entries)
+        bind.execute(
+            history.update().where(history.c.id == sa.bindparam('entry_id')).values(word_count=sa.bindparam('words')),
+            [{"entry_id": entry.id, "words": len(contents[entry.id].split())} for entry in entries],
+        )
+
+
+def downgrade() -> None:
+    op.drop_column('document_history', 'word_count')
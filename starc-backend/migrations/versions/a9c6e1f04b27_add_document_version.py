@@ -0,0 +1,26 @@
+"""add version counter to documents
+
+Revision ID: a9c6e1f04b27
+Revises: 5e0b8c3d7a14
+Create Date: 2026-10-19 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a9c6e1f04b27'
+down_revision: Union[str, None] = '5e0b8c3d7a14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('documents', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade() -> None:
+    op.drop_column('documents', 'version')
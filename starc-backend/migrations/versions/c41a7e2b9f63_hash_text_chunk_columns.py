@@ -0,0 +1,47 @@
+"""replace full-text index on text_chunks with content hashes
+
+Revision ID: c41a7e2b9f63
+Revises: 8d2f4a6c1e05
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41a7e2b9f63'
+down_revision: Union[str, None] = '8d2f4a6c1e05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The btree over the full text rejects entries above ~2.7KB, so drop it before anything else
+    op.execute("DROP INDEX IF EXISTS idx_input_text")
+
+    op.add_column('text_chunks', sa.Column('input_text_hash', sa.String(length=64), nullable=True))
+    op.add_column('text_chunks', sa.Column('rewritten_text_hash', sa.String(length=64), nullable=True))
+
+    # Same SHA-256 hex digest as models.content_hash
+    op.execute(
+        "UPDATE text_chunks SET "
+        "input_text_hash = encode(sha256(convert_to(input_text_chunk, 'UTF8')), 'hex'), "
+        "rewritten_text_hash = encode(sha256(convert_to(rewritten_text, 'UTF8')), 'hex')"
+    )
+
+    op.alter_column('text_chunks', 'input_text_hash', existing_type=sa.String(length=64), nullable=False)
+    op.alter_column('text_chunks', 'rewritten_text_hash', existing_type=sa.String(length=64), nullable=False)
+
+    op.create_index('idx_input_text_hash', 'text_chunks', ['input_text_hash'])
+    op.create_index('idx_rewritten_text_hash', 'text_chunks', ['rewritten_text_hash'])
+
+
+def downgrade() -> None:
+    op.drop_index('idx_rewritten_text_hash', table_name='text_chunks')
+    op.drop_index('idx_input_text_hash', table_name='text_chunks')
+    op.drop_column('text_chunks', 'rewritten_text_hash')
+    op.drop_column('text_chunks', 'input_text_hash')
+    # The original idx_input_text is not restored: it cannot hold large chunks
@@ -0,0 +1,29 @@
+"""add scoring_version to initial_scores and final_scores
+
+Revision ID: d5a1f7c3b820
+Revises: 7b3d9e2f5a61
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a1f7c3b820'
+down_revision: Union[str, None] = '7b3d9e2f5a61'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Every existing score was produced by the original formula
+    op.add_column('initial_scores', sa.Column('scoring_version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('final_scores', sa.Column('scoring_version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade() -> None:
+    op.drop_column('final_scores', 'scoring_version')
+    op.drop_column('initial_scores', 'scoring_version')
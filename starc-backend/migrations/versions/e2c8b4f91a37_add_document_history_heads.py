@@ -0,0 +1,34 @@
+"""add document_history_heads table
+
+Revision ID: e2c8b4f91a37
+Revises: d5a1f7c3b820
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2c8b4f91a37'
+down_revision: Union[str, None] = 'd5a1f7c3b820'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Filled in by the first save of each document after the upgrade
+    op.create_table('document_history_heads',
+        sa.Column('document_id', sa.Integer(), nullable=False),
+        sa.Column('history_id', sa.Integer(), nullable=False),
+        sa.Column('chain_length', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('payload', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['document_id'], ['documents.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('document_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('document_history_heads')
@@ -0,0 +1,30 @@
+"""add job_runs table
+
+Revision ID: f7d3a9c2e6b1
+Revises: e2c8b4f91a37
+Create Date: 2026-10-19 15:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f7d3a9c2e6b1'
+down_revision: Union[str, None] = 'e2c8b4f91a37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('job_runs',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('last_run', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('job_runs')
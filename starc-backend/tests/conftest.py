@@ -1,4 +1,5 @@
 import pytest
+from unittest.mock import patch, AsyncMock
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -31,6 +32,19 @@ def test_db():
     yield TestingSessionLocal()
     Base.metadata.drop_all(bind=engine)
 
+@pytest.fixture(autouse=True)
+def no_llm_suggestions():
+    # Documents created in tests would otherwise start suggestion generation against the real LLM
+    with patch('api_project.suggestions.generate_sentence_suggestions', AsyncMock(return_value=[])) as mock_generate:
+        yield mock_generate
+
+@pytest.fixture(autouse=True)
+def pdf_cache_dir(tmp_path):
+    # Keep extracted text cached by one test (or a previous run) from reaching another
+    with patch('api_project.pdf_cache.PDF_CACHE_DIR', str(tmp_path / 'pdf-cache')), \
+         patch('api_project.pdf_export.PDF_EXPORT_CACHE_DIR', str(tmp_path / 'pdf-export')):
+        yield tmp_path / 'pdf-cache'
+
 @pytest.fixture
 def client(test_db):
     def _get_test_db():
@@ -39,7 +53,11 @@ def client(test_db):
         finally:
             pass
     app.dependency_overrides[get_db] = _get_test_db
-    return TestClient(app)
+    # The live editor and suggestion generation open short sessions themselves instead of depending on get_db
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=test_db.get_bind())
+    with patch('api_project.routes.documents.SessionLocal', session_factory), \
+         patch('api_project.suggestions.SessionLocal', session_factory):
+        yield TestClient(app)
 
 @pytest.fixture
 def test_user(test_db):
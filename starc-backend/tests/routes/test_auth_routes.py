@@ -1,6 +1,19 @@
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, AsyncMock
 from api_project.models import User
+from api_project.google_auth import clear_google_certs
+from api_project.passwords import hash_password
+from werkzeug.security import generate_password_hash
+from google.auth import crypt, jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+import json
+import threading
+import time
 
 def test_register_success(client, test_db):
     response = client.post("/auth/register", json={
@@ -17,6 +30,18 @@ def test_register_success(client, test_db):
     assert user.username == "newuser"
     assert user.check_password("password123")
 
+def test_register_hashes_in_password_pool(client, test_db):
+    threads = []
+
+    def recording_hash(password):
+        threads.append(threading.current_thread().name)
+        return hash_password(password)
+
+    with patch('api_project.routes.auth_routes.hash_password', side_effect=recording_hash):
+        response = client.post("/auth/register", json={"username": "pooluser", "email": "pool@example.com", "password": "password123"})
+    assert response.status_code == 200
+    assert len(threads) == 1 and threads[0].startswith("password-hash")
+
 def test_register_duplicate_username(client, test_user):
     response = client.post("/auth/register", json={
         "username": "testuser",  # Same as test_user fixture
@@ -67,7 +92,7 @@ async def test_google_login_success(client):
         "name": "Google User"
     }
     
-    with patch("google.oauth2.id_token.verify_oauth2_token", return_value=mock_user_info):
+    with patch("api_project.routes.auth_routes.verify_google_id_token", AsyncMock(return_value=mock_user_info)):
         response = client.post("/auth/google", json={"token": mock_token})
         assert response.status_code == 200
         assert "access_token" in response.json()
@@ -79,7 +104,7 @@ def test_google_login_missing_token(client):
 
 @pytest.mark.asyncio
 async def test_google_login_invalid_token(client):
-    with patch("google.oauth2.id_token.verify_oauth2_token", side_effect=ValueError("Invalid token")):
+    with patch("api_project.routes.auth_routes.verify_google_id_token", AsyncMock(side_effect=ValueError("Invalid token"))):
         response = client.post("/auth/google", json={"token": "invalid_token"})
         assert response.status_code == 401
         assert "Invalid token" in response.json()["detail"]
@@ -97,4 +122,75 @@ def test_refresh_token_with_token(client, test_tokens):
         headers={"Authorization": f"Bearer {test_tokens['refresh_token']}"}
     )
     assert response.status_code == 200
-    assert "access_token" in response.json() 
\ No newline at end of file
+    assert "access_token" in response.json() 
+
+def test_login_rehashes_outdated_password_hash(client, test_db, test_user):
+    test_user.password = generate_password_hash("testpassword", method="pbkdf2:sha256:1000")
+    test_db.commit()
+
+    response = client.post("/auth/login", json={"login_identifier": "testuser", "password": "testpassword"})
+    assert response.status_code == 200
+
+    test_db.refresh(test_user)
+    assert test_user.password.startswith("scrypt:")
+    assert test_user.check_password("testpassword")
+    response = client.post("/auth/login", json={"login_identifier": "testuser", "password": "testpassword"})
+    assert response.status_code == 200
+
+@pytest.fixture
+def google_key_server(monkeypatch):
+    # Local stand-in for Google's certificate endpoint, serving one self-signed signing key
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "test-signer")])
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())\
+        .serial_number(1).not_valid_before(datetime.utcnow() - timedelta(days=1))\
+        .not_valid_after(datetime.utcnow() + timedelta(days=1)).sign(key, hashes.SHA256())
+    body = json.dumps({"test-key": cert.public_bytes(serialization.Encoding.PEM).decode()}).encode()
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Cache-Control", "public, max-age=3600")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr('api_project.google_auth.GOOGLE_CERTS_URL', f"http://127.0.0.1:{server.server_port}/certs")
+    monkeypatch.setenv("GOOGLE_CLIENT_ID", "test-client")
+    clear_google_certs()
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    signer = crypt.RSASigner.from_string(private_pem, key_id="test-key")
+
+    def sign(audience="test-client", email="oauth@example.com"):
+        now = int(time.time())
+        payload = {"iss": "https://accounts.google.com", "aud": audience, "sub": "1", "email": email,
+                   "name": "OAuth User", "iat": now, "exp": now + 600}
+        return jwt.encode(signer, payload).decode()
+
+    yield sign, hits
+    server.shutdown()
+    clear_google_certs()
+
+def test_google_login_caches_signing_certs(client, test_db, google_key_server):
+    sign, hits = google_key_server
+    for _ in range(3):
+        response = client.post("/auth/google", json={"credential": sign()})
+        assert response.status_code == 200
+        assert "access_token" in response.json()
+
+    # Only the first login fetched the certificates
+    assert len(hits) == 1
+    user = test_db.query(User).filter_by(email="oauth@example.com").first()
+    assert user.is_oauth_user
+
+def test_google_login_rejects_wrong_audience(client, google_key_server):
+    sign, _ = google_key_server
+    response = client.post("/auth/google", json={"credential": sign(audience="someone-else")})
+    assert response.status_code == 401
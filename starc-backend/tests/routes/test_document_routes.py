@@ -1,7 +1,30 @@
 import pytest
-from unittest.mock import patch, MagicMock
-from api_project.models import Document, TextChunks, InitialScore, FinalScore
+from unittest.mock import patch, AsyncMock, Mock
+from api_project.models import Document, TextChunks, InitialScore, FinalScore, DocumentHistory, DocumentHistoryHead, UserStats
+from api_project.history import append_history, compact_document_history, load_history
+from api_project.jobs import claim_job_run
+from api_project.stats import reconcile_user_stats, record_document_created, compute_user_stats
+from api_project.chunks import split_into_chunks
+from api_project.processing import TextScores
+from api_project.scoring import FORMULAS, SCORING_VERSION, ScoringFormula
+from api_project.recompute_scores import recompute_scores
+from api_project.pdf_cache import store_pdf_text, cached_pdf_text
+from api_project.pdf_extraction import PdfExtractionError, get_pdf_executor
+from api_project.routes.documents import extract_and_prescore
+from concurrent.futures.process import BrokenProcessPool
+from api_project.editor import EditorSession
+from api_project.bulk_export import document_records
+from starlette.websockets import WebSocketDisconnect
+from reportlab.pdfgen import canvas
+from pypdf import PdfReader
+from datetime import datetime, timedelta
+import asyncio
 import io
+import os
+import json
+import threading
+import zipfile
+from sqlalchemy import event, insert
 
 @pytest.fixture
 def test_document(test_db, test_user):
@@ -42,9 +65,12 @@ def test_document(test_db, test_user):
     
     return document
 
+def _fixed_scores(texts, known_sentences=None):
+    return [TextScores([0.8, 0.7, 0.6, 0.9], []) for _ in texts]
+
 @pytest.mark.asyncio
-async def test_create_document(client, test_tokens):
-    with patch('api_project.routes.documents.get_scoresSA', return_value=[0.8, 0.7, 0.6, 0.9]), \
+async def test_create_document(client, test_tokens, no_llm_suggestions):
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
          patch('api_project.routes.documents.ensure_model_warm'):
         
         response = client.post(
@@ -57,6 +83,42 @@ async def test_create_document(client, test_tokens):
         assert response.json()["title"] == "New Doc"
         assert "id" in response.json()
         assert "word_count" in response.json()
+        # Suggestions are generated in the background after ingest
+        no_llm_suggestions.assert_called_once_with("Test content")
+
+def test_create_document_reuses_scores_for_same_text(client, test_tokens, test_document, test_db):
+    with patch('api_project.chunks.score_texts') as mock_scores, \
+         patch('api_project.routes.documents.ensure_model_warm'):
+
+        response = client.post(
+            "/docs",
+            json={"title": "Re-upload", "text": "This is a test document."},
+            headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+        )
+
+        assert response.status_code == 200
+        mock_scores.assert_not_called()
+
+    chunk = test_db.query(TextChunks).filter_by(document_id=response.json()["id"]).first()
+    assert chunk.input_text_hash == chunk.rewritten_text_hash
+    # The stored chunk's final score belongs to its current text, so that is what is reused
+    assert chunk.initial_score.score == 0.85
+
+def test_create_document_does_not_reuse_scores_of_replaced_text(client, test_tokens, test_document, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    new_scores = AsyncMock(side_effect=lambda texts, known_sentences=None: [TextScores([0.3, 0.2, 0.4, 0.5], []) for _ in texts])
+    with patch('api_project.chunks.score_texts', new_scores):
+        response = client.put(f"/docs/{test_document.id}", json={"title": "Edited", "text": "Brand new text."}, headers=headers)
+    assert response.status_code == 200
+
+    # Posting the edited text reuses the edited chunk's scores, not the ones of the text it replaced
+    with patch('api_project.chunks.score_texts') as mock_scores, \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        response = client.post("/docs", json={"title": "Copy", "text": "Brand new text."}, headers=headers)
+    assert response.status_code == 200
+    mock_scores.assert_not_called()
+    chunk = test_db.query(TextChunks).filter_by(document_id=response.json()["id"]).first()
+    assert chunk.initial_score.score == 0.3 and chunk.final_score.score == 0.3
 
 def test_create_document_unauthorized(client):
     response = client.post(
@@ -65,21 +127,22 @@ def test_create_document_unauthorized(client):
     )
     assert response.status_code == 401
 
+def _make_pdf(pages):
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer)
+    for text in pages:
+        pdf.drawString(72, 720, text)
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
 @pytest.mark.asyncio
 async def test_upload_pdf(client, test_tokens):
-    # Create a mock PDF file
-    pdf_content = b"%PDF-1.4 mock pdf content"
-    pdf_file = io.BytesIO(pdf_content)
-    
-    with patch('api_project.routes.documents.PdfReader') as mock_pdf_reader, \
-         patch('api_project.routes.documents.get_scoresSA', return_value=[0.8, 0.7, 0.6, 0.9]), \
+    pdf_file = io.BytesIO(_make_pdf(["Extracted text"]))
+
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
          patch('api_project.routes.documents.ensure_model_warm'):
         
-        # Mock PDF reader behavior
-        mock_page = MagicMock()
-        mock_page.extract_text.return_value = "Extracted text"
-        mock_pdf_reader.return_value.pages = [mock_page]
-        
         response = client.post(
             "/docs/pdf",
             files={"file": ("test.pdf", pdf_file, "application/pdf")},
@@ -90,6 +153,249 @@ async def test_upload_pdf(client, test_tokens):
         assert "document_id" in response.json()
         assert "text_chunk_id" in response.json()
 
+def test_upload_pdf_extracts_page_ranges_in_order(client, test_tokens):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    pages = [f"Page {number} reports stable revenue." for number in range(1, 8)]
+    with patch('api_project.pdf_extraction.PAGES_PER_TASK', 2), \
+         patch('api_project.chunks.MIN_CHUNK_CHARS', 0), patch('api_project.chunks.MAX_CHUNK_CHARS', 80), \
+         patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores) as mock_fetch, \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        response = client.post("/docs/pdf", files={"file": ("filing.pdf", io.BytesIO(_make_pdf(pages)), "application/pdf")}, headers=headers)
+
+    assert response.status_code == 200
+    text = client.get(f"/docs/{response.json()['document_id']}", headers=headers).json()["text_chunk"]
+    assert [line for line in text.splitlines() if line] == pages
+    # Sections completed by the first page ranges are scored during extraction and not sent again
+    assert mock_fetch.call_count > 1
+    scored = [sentence for call in mock_fetch.call_args_list for sentence in call[0][0]]
+    assert sorted(scored) == sorted(page.rstrip(".") for page in pages)
+
+def test_upload_pdf_limits(client, test_tokens):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.pdf_extraction.PDF_MAX_PAGES', 2):
+        response = client.post("/docs/pdf", files={"file": ("long.pdf", io.BytesIO(_make_pdf(["a", "b", "c"])), "application/pdf")}, headers=headers)
+    assert response.status_code == 400
+    assert "at most 2" in response.json()["detail"]
+
+    with patch('api_project.pdf_extraction.PDF_MAX_BYTES', 100):
+        response = client.post("/docs/pdf", files={"file": ("big.pdf", io.BytesIO(_make_pdf(["a"])), "application/pdf")}, headers=headers)
+    assert response.status_code == 413
+
+def test_pdf_extraction_timeout_recycles_pool(client, test_tokens):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    executor = get_pdf_executor()
+    executor.submit(os.getpid).result()
+    workers = list(executor._processes.values())
+    with patch('api_project.pdf_extraction.PDF_EXTRACTION_TIMEOUT', 0):
+        response = client.post("/docs/pdf", files={"file": ("slow.pdf", io.BytesIO(_make_pdf(["a"])), "application/pdf")}, headers=headers)
+    assert response.status_code == 408
+    # Workers of the timed-out pool are stopped and later uploads get a fresh pool
+    assert get_pdf_executor() is not executor
+    for worker in workers:
+        worker.join(5)
+        assert worker.exitcode is not None
+
+@pytest.mark.asyncio
+async def test_failed_pdf_extraction_cancels_prescoring(test_db):
+    async def failing_extraction(path):
+        yield "Revenue grew.\n\nCosts fell.\n\nMargins"
+        await asyncio.sleep(0.01)
+        raise PdfExtractionError("PDF text extraction timed out", status_code=408)
+
+    started, cancelled = asyncio.Event(), []
+    async def slow_scoring(db, texts):
+        started.set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(texts)
+            raise
+
+    with patch('api_project.routes.documents.iter_pdf_text', failing_extraction), \
+         patch('api_project.routes.documents.score_unsaved_texts', slow_scoring), \
+         patch('api_project.chunks.MIN_CHUNK_CHARS', 0):
+        with pytest.raises(PdfExtractionError):
+            await extract_and_prescore(test_db, "unused.pdf")
+
+    # The sections sent for scoring before the failure are not left running
+    assert started.is_set() and len(cancelled) == 1
+
+def test_repeat_pdf_upload_skips_extraction(client, test_tokens):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    pdf = _make_pdf(["Revenue grew in every segment."])
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        first = client.post("/docs/pdf", files={"file": ("10-K.pdf", io.BytesIO(pdf), "application/pdf")}, headers=headers)
+        with patch('api_project.routes.documents.extract_and_prescore') as mock_extract:
+            second = client.post("/docs/pdf", files={"file": ("10-K copy.pdf", io.BytesIO(pdf), "application/pdf")}, headers=headers)
+
+    assert first.status_code == 200 and second.status_code == 200
+    mock_extract.assert_not_called()
+    texts = [client.get(f"/docs/{r.json()['document_id']}", headers=headers).json()["text_chunk"] for r in (first, second)]
+    assert texts[0] == texts[1]
+    assert "Revenue grew in every segment." in texts[1]
+
+def test_pdf_cache_evicts_least_recently_used(pdf_cache_dir):
+    text = "x" * 4000
+    store_pdf_text("a" * 64, text + "a")
+    entry_size = next(pdf_cache_dir.iterdir()).stat().st_size
+    # Room for two entries
+    with patch('api_project.pdf_cache.PDF_CACHE_MAX_BYTES', entry_size * 2):
+        store_pdf_text("b" * 64, text + "b")
+        os.utime(pdf_cache_dir / ("b" * 64 + ".txt.z"), ns=(0, 0))
+        assert cached_pdf_text("a" * 64) == text + "a"
+        # "b" is now the least recently used entry and makes room for "c"
+        store_pdf_text("c" * 64, text + "c")
+        assert cached_pdf_text("b" * 64) is None
+        assert cached_pdf_text("a" * 64) == text + "a"
+        assert cached_pdf_text("c" * 64) == text + "c"
+
+def test_export_pdf_spans_pages_and_is_cached(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    paragraphs = [f"Paragraph {number} discusses revenue & margins in detail. " * 8 for number in range(1, 41)]
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Annual report", "text": "\n\n".join(paragraphs)}, headers=headers).json()["id"]
+
+    response = client.get(f"/docs/pdf/{doc_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/pdf"
+    reader = PdfReader(io.BytesIO(response.content))
+    assert len(reader.pages) > 1
+    # Nothing is cut off at the end of the first page
+    assert "Paragraph 40" in reader.pages[-1].extract_text()
+
+    with patch('api_project.routes.documents.render_export') as mock_render:
+        repeat = client.get(f"/docs/pdf/{doc_id}", headers=headers)
+        assert repeat.content == response.content
+        not_modified = client.get(f"/docs/pdf/{doc_id}", headers={**headers, "If-None-Match": response.headers["etag"]})
+        assert not_modified.status_code == 304
+    mock_render.assert_not_called()
+
+def test_export_pdf_retries_after_pool_recycle(client, test_tokens, test_document):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    broken_pool = Mock()
+    broken_pool.submit.side_effect = BrokenProcessPool()
+
+    # The first pool was recycled by another request; the retry runs in the new one
+    with patch('api_project.pdf_export.get_pdf_executor', side_effect=[broken_pool, None]):
+        response = client.get(f"/docs/pdf/{test_document.id}", headers=headers)
+    assert response.status_code == 200
+    assert "This is a test document." in PdfReader(io.BytesIO(response.content)).pages[0].extract_text()
+
+    with patch('api_project.pdf_export.PDF_EXPORT_CACHE_MAX_BYTES', 0), \
+         patch('api_project.pdf_export.get_pdf_executor', return_value=broken_pool):
+        response = client.get(f"/docs/pdf/{test_document.id}", headers=headers)
+    assert response.status_code == 503
+    assert broken_pool.submit.call_count == 3
+
+def test_export_pdf_queries_off_the_event_loop(client, test_tokens, test_db, test_document):
+    url = f"/docs/pdf/{test_document.id}"
+    query_threads = []
+    def record_thread(*args):
+        query_threads.append(threading.current_thread().name)
+
+    event.listen(test_db.get_bind(), "before_cursor_execute", record_thread)
+    try:
+        response = client.get(url, headers={"Authorization": f"Bearer {test_tokens['access_token']}"})
+    finally:
+        event.remove(test_db.get_bind(), "before_cursor_execute", record_thread)
+    assert response.status_code == 200
+    # The document and its chunks are read in the loop's worker threads, not on the loop (the test client's portal thread)
+    assert len(query_threads) >= 2 and all(name.startswith("asyncio_") for name in query_threads)
+
+def test_export_documents_zip(client, test_tokens, test_document):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    for content in ["Draft one.", "Draft one. Draft two."]:
+        client.post(f"/docs/{test_document.id}/history", json={"content": content}, headers=headers)
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        second_id = client.post("/docs", json={"title": "Second", "text": "Costs fell."}, headers=headers).json()["id"]
+
+    query_threads = []
+
+    def recording_records(db, batch):
+        query_threads.append(threading.current_thread().name)
+        return document_records(db, batch)
+
+    with patch('api_project.bulk_export.EXPORT_BATCH_SIZE', 1), \
+         patch('api_project.bulk_export.document_records', side_effect=recording_records):
+        response = client.get("/docs/export?include_pdfs=true", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    # Batches are queried in worker threads, not on the event loop
+    assert len(query_threads) == 2 and all(name.startswith("asyncio") for name in query_threads)
+
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert sorted(archive.namelist()) == sorted(["documents.ndjson", f"pdf/{test_document.id}.pdf", f"pdf/{second_id}.pdf"])
+    records = [json.loads(line) for line in archive.read("documents.ndjson").decode().splitlines()]
+    assert [record["id"] for record in records] == [test_document.id, second_id]
+    first, second = records
+    assert first["text"] == "This is a test document."
+    assert first["initial_scores"]["score"] == 0.75 and first["final_scores"]["score"] == 0.85
+    assert [entry["content"] for entry in first["history"]] == ["Draft one.", "Draft one. Draft two."]
+    assert second["chunks"][0]["input_text"] == "Costs fell." and second["history"] == []
+    assert "Costs fell." in PdfReader(archive.open(f"pdf/{second_id}.pdf")).pages[0].extract_text()
+
+    assert client.get("/docs/export").status_code == 401
+
+def _fake_sentence_scores(sentences):
+    return [{"tone": {"Positive": 0.6, "Neutral": 0.3, "Negative": 0.1},
+             "fls": {"Specific FLS": 0.2, "Non-specific FLS": 0.1, "Not FLS": 0.7}} for _ in sentences]
+
+def test_create_documents_batch(client, test_tokens, test_db):
+    documents = [
+        {"title": "Q1", "text": "Revenue grew. Margins held."},
+        {"title": "Q2", "text": "Costs fell. Outlook is stable. Cash improved."},
+        {"title": "Q1 copy", "text": "Revenue grew. Margins held."},
+    ]
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores) as mock_fetch, \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        response = client.post(
+            "/docs/batch",
+            json={"documents": documents},
+            headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+        )
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["created"] == 3 and data["failed"] == 0
+    assert [result["title"] for result in data["results"]] == ["Q1", "Q2", "Q1 copy"]
+
+    # All new sentences go out in one dispatch, and the repeated text is only scored once
+    mock_fetch.assert_called_once()
+    assert len(mock_fetch.call_args[0][0]) == 5
+
+    chunk = test_db.query(TextChunks).filter_by(id=data["results"][1]["text_chunk_id"]).first()
+    assert chunk.document.title == "Q2"
+    assert chunk.input_text_hash == chunk.rewritten_text_hash
+    assert chunk.initial_score.score == chunk.final_score.score
+
+def test_create_documents_batch_pdf_status(client, test_tokens):
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        response = client.post(
+            "/docs/batch/pdf",
+            files=[
+                ("files", ("filing.pdf", io.BytesIO(_make_pdf(["Extracted text."])), "application/pdf")),
+                ("files", ("notes.txt", io.BytesIO(b"plain text"), "text/plain")),
+            ],
+            headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+        )
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0]["status"] == "created" and results[0]["document_id"]
+    assert results[1]["status"] == "failed" and results[1]["error"] == "Invalid file type"
+
+def test_create_documents_batch_validates_body(client, test_tokens):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    response = client.post("/docs/batch", json={"documents": [{"title": "No text"}]}, headers=headers)
+    assert response.status_code == 422
+    response = client.post("/docs/batch", json={"documents": []}, headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "No documents provided"
+
 def test_delete_document(client, test_tokens, test_document):
     response = client.delete(
         f"/docs/{test_document.id}",
@@ -107,7 +413,7 @@ def test_delete_nonexistent_document(client, test_tokens):
 
 @pytest.mark.asyncio
 async def test_update_document(client, test_tokens, test_document):
-    with patch('api_project.routes.documents.get_scoresSA', return_value=[0.8, 0.7, 0.6, 0.9]):
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores):
         
         response = client.put(
             f"/docs/{test_document.id}",
@@ -136,6 +442,7 @@ def test_get_final_scores(client, test_tokens, test_document):
     assert response.status_code == 200
     assert isinstance(response.json(), list)
     score = response.json()[0]
+    assert score["id"] == test_document.text_chunks[0].final_score.id
     assert "score" in score
     assert "optimism" in score
     assert "forecast" in score
@@ -216,4 +523,485 @@ def test_search_documents_no_results(client, test_tokens):
     assert response.status_code == 200
     data = response.json()
     assert data["total_items"] == 0
-    assert len(data["results"]) == 0 
\ No newline at end of file
+    assert len(data["results"]) == 0 
+
+
+def test_document_history_roundtrip(client, test_tokens, test_document, test_db):
+    body = " ".join(f"Revenue grew in segment {i} during the quarter." for i in range(40))
+    versions = [
+        body,
+        body.replace("segment 7 ", "segment 7 strongly "),
+        body.replace("segment 7 ", "segment 7 strongly ") + " Outlook remains stable.",
+    ]
+    for content in versions:
+        response = client.post(
+            f"/docs/{test_document.id}/history",
+            json={"content": content},
+            headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+        )
+        assert response.status_code == 200
+        assert response.json()["content"] == content
+
+    response = client.get(
+        f"/docs/{test_document.id}/history",
+        headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+    )
+    assert response.status_code == 200
+    assert [entry["content"] for entry in response.json()] == list(reversed(versions))
+
+    # Only the first version is stored in full
+    rows = test_db.query(DocumentHistory).filter_by(document_id=test_document.id).order_by(DocumentHistory.id).all()
+    assert [row.is_snapshot for row in rows] == [True, False, False]
+    assert all(row.content is None for row in rows)
+
+def test_append_history_diffs_against_head(test_db, test_document):
+    versions = [
+        "Revenue grew. Margins held!\nOutlook",
+        "Revenue grew. Margins held!\nOutlook stable.",
+        "Revenue grew 3.5%. Margins held!\nOutlook stable.",
+        "Revenue grew 3.5%. Costs fell? Margins held!\nOutlook stable.",
+    ]
+    for content in versions[:2]:
+        append_history(test_db, test_document.id, content)
+        test_db.commit()
+    head = test_db.get(DocumentHistoryHead, test_document.id)
+    assert head.chain_length == 1
+
+    # Versions saved before heads existed are rebuilt from the chain once
+    test_db.delete(head)
+    test_db.commit()
+    for content in versions[2:]:
+        entry = append_history(test_db, test_document.id, content)
+        test_db.commit()
+
+    test_db.expire_all()
+    head = test_db.get(DocumentHistoryHead, test_document.id)
+    assert (head.history_id, head.chain_length) == (entry.id, 3)
+    assert [content for _, content in load_history(test_db, test_document.id)] == versions
+
+def test_compact_document_history(test_db, test_document):
+    now = datetime(2025, 3, 1, 12, 0)
+    # Three saves a day for five days, three weeks ago, then one legacy full-text row today
+    for day in range(5):
+        for hour in range(3):
+            entry = append_history(test_db, test_document.id, f"Day {day}. Save {hour}.")
+            entry.created_at = now - timedelta(days=21 - day, hours=3 - hour)
+            test_db.commit()
+    test_db.add(DocumentHistory(document_id=test_document.id, content="Latest. Save.", created_at=now))
+    test_db.commit()
+
+    removed = compact_document_history(test_db, test_document.id, now=now)
+
+    assert removed == 10
+    history = load_history(test_db, test_document.id)
+    assert [content for _, content in history] == [f"Day {day}. Save 2." for day in range(5)] + ["Latest. Save."]
+    assert all(entry.content is None for entry, _ in history)
+
+def test_periodic_job_runs_once_per_interval(test_db):
+    now = datetime(2025, 3, 1, 12, 0)
+    # Every worker tries to claim each round; only the first one gets it
+    assert claim_job_run(test_db, "history_compaction", 3600, now=now)
+    assert not claim_job_run(test_db, "history_compaction", 3600, now=now + timedelta(seconds=1))
+    assert claim_job_run(test_db, "stats_reconcile", 3600, now=now)
+    assert claim_job_run(test_db, "history_compaction", 3600, now=now + timedelta(hours=1))
+
+def test_document_history_summary_pagination(client, test_tokens, test_document, test_db):
+    for i in range(5):
+        append_history(test_db, test_document.id, " ".join(["word"] * (10 + i)))
+        test_db.commit()
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+
+    response = client.get(f"/docs/{test_document.id}/history/summary", params={"limit": 3}, headers=headers)
+    assert response.status_code == 200
+    page = response.json()
+    assert [entry["word_count"] for entry in page["results"]] == [14, 13, 12]
+    assert all(entry["word_delta"] == 1 for entry in page["results"])
+    assert "content" not in page["results"][0]
+    assert page["next_cursor"]
+
+    response = client.get(
+        f"/docs/{test_document.id}/history/summary",
+        params={"limit": 3, "cursor": page["next_cursor"]},
+        headers=headers
+    )
+    page = response.json()
+    assert [entry["word_count"] for entry in page["results"]] == [11, 10]
+    assert page["results"][-1]["word_delta"] is None
+    assert page["next_cursor"] is None
+
+def test_document_history_version_etag(client, test_tokens, test_document, test_db):
+    entry = append_history(test_db, test_document.id, "Saved version.")
+    test_db.commit()
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+
+    response = client.get(f"/docs/{test_document.id}/history/{entry.id}", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["content"] == "Saved version."
+    # Compaction can delete versions, so clients revalidate instead of caching them for good
+    assert response.headers["Cache-Control"] == "private, no-cache"
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        f"/docs/{test_document.id}/history/{entry.id}",
+        headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+def test_user_stats_tracks_document_changes(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        first = client.post("/docs", json={"title": "One", "text": "First text."}, headers=headers).json()
+        client.post("/docs", json={"title": "Two", "text": "Second text."}, headers=headers)
+
+    client.post(f"/docs/{first['id']}/save_rewrite", json={"rewritten_text": "First text, rewritten."}, headers=headers)
+
+    stats = client.get("/docs/user/stats", headers=headers).json()
+    assert stats["email"] == "test@example.com"
+    assert stats["totalDocuments"] == 2
+    assert stats["totalRewrites"] == 1
+    assert stats["timeSaved"] == 20
+    assert stats["lastActivity"] is not None
+
+    client.delete(f"/docs/{first['id']}", headers=headers)
+    stats = client.get("/docs/user/stats", headers=headers).json()
+    assert stats["totalDocuments"] == 1
+    assert stats["totalRewrites"] == 0
+
+def test_reconcile_user_stats_repairs_drift(test_db, test_user, test_document):
+    test_db.add(UserStats(user_id=test_user.id, total_documents=99, total_rewrites=7))
+    test_db.commit()
+
+    assert reconcile_user_stats(test_db, test_user.id)
+    test_db.commit()
+
+    stats = test_db.get(UserStats, test_user.id)
+    assert stats.total_documents == 1
+    assert stats.total_rewrites == 0
+    assert not reconcile_user_stats(test_db, test_user.id)
+
+def test_first_stats_change_applies_to_concurrently_inserted_row(test_db, test_user, test_document):
+    def compute_after_concurrent_insert(db, user_id):
+        # Another request creates the row between this one's UPDATE and INSERT
+        db.execute(insert(UserStats).values(user_id=user_id, total_documents=5, total_rewrites=2))
+        return compute_user_stats(db, user_id)
+
+    with patch('api_project.stats.compute_user_stats', side_effect=compute_after_concurrent_insert):
+        record_document_created(test_db, test_user.id, rewritten=True)
+    test_db.commit()
+
+    stats = test_db.get(UserStats, test_user.id)
+    assert (stats.total_documents, stats.total_rewrites) == (6, 3)
+    assert stats.last_activity is not None
+
+def test_document_etag_changes_on_write(client, test_tokens, test_document):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+
+    response = client.get(f"/docs/{test_document.id}", headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get(f"/docs/{test_document.id}", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    scores = client.get(f"/docs/scores/{test_document.id}", headers=headers)
+    assert scores.headers["ETag"] != etag
+
+    client.post(f"/docs/{test_document.id}/save_rewrite", json={"rewritten_text": "Edited."}, headers=headers)
+
+    response = client.get(f"/docs/{test_document.id}", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["text_chunk"] == "Edited."
+    assert response.headers["ETag"] != etag
+
+def test_document_etag_changes_with_scoring_version(client, test_tokens, test_document):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    etag = client.get(f"/docs/{test_document.id}/heatmap", headers=headers).headers["ETag"]
+
+    # Scores derived from stored probabilities change with the formula, without any write
+    with patch('api_project.http_cache.SCORING_VERSION', SCORING_VERSION + 1):
+        response = client.get(f"/docs/{test_document.id}/heatmap", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+
+MULTI_SECTION_TEXT = (
+    "Results\n\n"
+    + "Revenue grew in every region this quarter. " * 6 + "\n\n"
+    + "Margins held despite higher input costs. " * 6 + "\n\n"
+    + "We expect demand to remain stable next year. " * 6
+)
+
+def test_split_into_chunks_keeps_text():
+    chunks = split_into_chunks(MULTI_SECTION_TEXT)
+    assert "".join(chunks) == MULTI_SECTION_TEXT
+    assert len(chunks) == 3
+    # The short heading is merged into the paragraph that follows it
+    assert chunks[0].startswith("Results\n\nRevenue grew")
+
+    # Windows line endings separate paragraphs too
+    crlf_text = MULTI_SECTION_TEXT.replace("\n", "\r\n")
+    chunks = split_into_chunks(crlf_text)
+    assert "".join(chunks) == crlf_text
+    assert len(chunks) == 3
+
+def test_multi_chunk_document_partial_rescoring(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores) as mock_scores, \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Sections", "text": MULTI_SECTION_TEXT}, headers=headers).json()["id"]
+
+    # All chunks are scored in one call
+    mock_scores.assert_called_once()
+    assert len(mock_scores.call_args[0][0]) == 3
+
+    assert client.get(f"/docs/{doc_id}", headers=headers).json()["text_chunk"] == MULTI_SECTION_TEXT
+    chunks = client.get(f"/docs/{doc_id}/chunks", headers=headers).json()
+    assert [chunk["position"] for chunk in chunks] == [0, 1, 2]
+
+    scores = client.get(f"/docs/scores/{doc_id}", headers=headers).json()
+    assert scores[0]["score"] == 0.8 and scores[0]["forecast"] == 0.6
+
+    edited = MULTI_SECTION_TEXT.replace("Margins held", "Margins widened")
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores) as mock_scores:
+        response = client.put(f"/docs/{doc_id}", json={"title": "Sections", "text": edited}, headers=headers)
+    assert response.status_code == 200
+    # Only the edited paragraph is rescored, and the other chunks keep their rows
+    assert mock_scores.call_args[0][0] == [chunks[1]["input_text_chunk"].replace("Margins held", "Margins widened")]
+    assert [chunk["id"] for chunk in client.get(f"/docs/{doc_id}/chunks", headers=headers).json()] == [c["id"] for c in chunks]
+
+def test_update_keeps_stored_text_when_rescoring_fails(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Sections", "text": MULTI_SECTION_TEXT}, headers=headers).json()["id"]
+    etag = client.get(f"/docs/{doc_id}", headers=headers).headers["ETag"]
+
+    edited = MULTI_SECTION_TEXT.replace("Margins held", "Margins widened")
+    with patch('api_project.chunks.score_texts', side_effect=RuntimeError("FinBERT unavailable")), \
+         pytest.raises(RuntimeError):
+        client.put(f"/docs/{doc_id}", json={"title": "Sections", "text": edited}, headers=headers)
+
+    response = client.get(f"/docs/{doc_id}", headers=headers)
+    assert response.json()["text_chunk"] == MULTI_SECTION_TEXT
+    assert response.headers["ETag"] == etag
+
+def test_rewrite_and_chunk_edits_keep_stored_text_when_rescoring_fails(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Sections", "text": MULTI_SECTION_TEXT}, headers=headers).json()["id"]
+    chunk_id = client.get(f"/docs/{doc_id}/chunks", headers=headers).json()[1]["id"]
+
+    with patch('api_project.chunks.score_texts', side_effect=RuntimeError("FinBERT unavailable")):
+        # A different paragraph structure is re-chunked and rescored
+        with pytest.raises(RuntimeError):
+            client.post(f"/docs/{doc_id}/save_rewrite", json={"rewritten_text": "One paragraph only."}, headers=headers)
+        with pytest.raises(RuntimeError):
+            client.put(f"/docs/{doc_id}/chunks/{chunk_id}", json={"updated_text_chunk": "Margins widened."}, headers=headers)
+
+    assert client.get(f"/docs/{doc_id}", headers=headers).json()["text_chunk"] == MULTI_SECTION_TEXT
+
+def test_update_single_chunk(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Sections", "text": MULTI_SECTION_TEXT}, headers=headers).json()["id"]
+    chunks = client.get(f"/docs/{doc_id}/chunks", headers=headers).json()
+
+    with patch('api_project.chunks.score_texts', return_value=[TextScores([0.2, 0.3, 0.4, 0.5], [])]) as mock_scores:
+        response = client.put(
+            f"/docs/{doc_id}/chunks/{chunks[2]['id']}",
+            json={"updated_text_chunk": "Demand may weaken next year."},
+            headers=headers
+        )
+    assert response.status_code == 200
+    data = response.json()
+    # The chunk keeps its surrounding whitespace
+    mock_scores.assert_called_once()
+    assert mock_scores.call_args[0][0] == ["Demand may weaken next year. "]
+    assert data["chunk"]["final_scores"]["score"] == 0.2
+    # Document scores are weighted by each chunk's sentence count
+    assert 0.2 < data["document_scores"]["score"] < 0.8
+
+    text = client.get(f"/docs/{doc_id}", headers=headers).json()["text_chunk"]
+    assert text.endswith("\n\nDemand may weaken next year. ")
+
+def test_update_rescores_only_changed_sentences(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    text = "Revenue grew strongly. Costs were flat. Margins held. We expect stable demand."
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Diff", "text": text}, headers=headers).json()["id"]
+
+    edited = text.replace("Costs were flat", "Costs fell sharply")
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores) as mock_fetch:
+        response = client.put(f"/docs/{doc_id}", json={"title": "Diff", "text": edited}, headers=headers)
+    assert response.status_code == 200
+    # Unchanged sentences reuse their stored probabilities
+    mock_fetch.assert_called_once_with(["Costs fell sharply"])
+
+    chunk = test_db.query(TextChunks).filter_by(document_id=doc_id).first()
+    test_db.refresh(chunk)
+    assert [s.position for s in chunk.sentence_scores] == [0, 1, 2, 3]
+    assert all(s.positive == 0.6 for s in chunk.sentence_scores)
+
+def test_live_editor_scores_dirty_sentences_and_saves(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    text = "Revenue grew strongly. Costs were flat."
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Live", "text": text}, headers=headers).json()["id"]
+
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores) as mock_fetch, \
+         patch('api_project.editor.EDITOR_DEBOUNCE_SECONDS', 0), \
+         client.websocket_connect(f"/docs/{doc_id}/live?token={test_tokens['access_token']}") as websocket:
+        state = websocket.receive_json()
+        assert state["type"] == "state" and state["text"] == text
+        assert [s["text"] for s in state["sentences"]] == ["Revenue grew strongly", "Costs were flat"]
+        mock_fetch.assert_not_called()
+
+        websocket.send_json({"type": "patch", "start": len(text), "end": len(text), "text": " Demand is stable."})
+        update = websocket.receive_json()
+        assert update["type"] == "scores" and update["revision"] == 1
+        assert update["sentences"][-1]["text"] == "Demand is stable"
+        # Only the new sentence is scored
+        mock_fetch.assert_called_once_with(["Demand is stable"])
+
+        websocket.send_json({"type": "patch", "start": 500, "end": 501, "text": "x"})
+        assert websocket.receive_json()["type"] == "error"
+
+        websocket.send_json({"type": "save"})
+        saved = websocket.receive_json()
+        assert saved["type"] == "saved" and saved["revision"] == 1
+        assert saved["final_scores"]["score"] == update["scores"]["score"]
+        assert mock_fetch.call_count == 1
+
+    assert client.get(f"/docs/{doc_id}", headers=headers).json()["text_chunk"] == text + " Demand is stable."
+
+def test_live_editor_seeds_rewritten_sentences(client, test_tokens):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    text = "Revenue grew strongly. Costs were flat."
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Rewritten", "text": text}, headers=headers).json()["id"]
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.routes.rewrites.rewrite_text_with_prompt', AsyncMock(return_value="Revenue grew strongly. Costs fell.")):
+        assert client.post(f"/fix/{doc_id}/rewrite", json={"prompt": "Make it better"}, headers=headers).status_code == 200
+
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores) as mock_fetch, \
+         patch('api_project.editor.EDITOR_DEBOUNCE_SECONDS', 0), \
+         client.websocket_connect(f"/docs/{doc_id}/live?token={test_tokens['access_token']}") as websocket:
+        assert websocket.receive_json()["type"] == "state"
+        # Only the input sentence the rewrite replaced has no stored scores
+        mock_fetch.assert_called_once_with(["Costs were flat"])
+
+        start = text.index("were flat")
+        websocket.send_json({"type": "patch", "start": start, "end": start + len("were flat"), "text": "fell"})
+        assert websocket.receive_json()["type"] == "scores"
+        assert mock_fetch.call_count == 1
+
+def test_live_editor_saves_when_idle(client, test_tokens, test_document):
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.editor.EDITOR_DEBOUNCE_SECONDS', 0), \
+         patch('api_project.editor.EDITOR_IDLE_SAVE_SECONDS', 0.2), \
+         client.websocket_connect(f"/docs/{test_document.id}/live?token={test_tokens['access_token']}") as websocket:
+        assert websocket.receive_json()["type"] == "state"
+        websocket.send_json({"type": "patch", "start": 0, "end": 4, "text": "That"})
+        messages = {message["type"]: message for message in (websocket.receive_json(), websocket.receive_json())}
+        assert messages["saved"]["revision"] == 1
+
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    assert client.get(f"/docs/{test_document.id}", headers=headers).json()["text_chunk"] == "That is a test document."
+
+def test_live_editor_reports_failed_saves_and_deleted_documents(client, test_tokens, test_document):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.editor.EDITOR_DEBOUNCE_SECONDS', 0), \
+         client.websocket_connect(f"/docs/{test_document.id}/live?token={test_tokens['access_token']}") as websocket:
+        assert websocket.receive_json()["type"] == "state"
+        websocket.send_json({"type": "patch", "start": 0, "end": 4, "text": "That"})
+        assert websocket.receive_json()["type"] == "scores"
+
+        with patch('api_project.routes.documents.save_document_text', side_effect=RuntimeError("database unavailable")):
+            websocket.send_json({"type": "save"})
+            failed = websocket.receive_json()
+        assert failed["type"] == "error" and failed["detail"] == "Could not save the document"
+
+        assert client.delete(f"/docs/{test_document.id}", headers=headers).status_code == 200
+        websocket.send_json({"type": "save"})
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_json()
+    assert closed.value.code == 4404
+
+@pytest.mark.asyncio
+async def test_editor_session_keeps_only_current_sentences():
+    session = EditorSession("Revenue grew strongly. Costs were flat.")
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores):
+        await session.score()
+        assert set(session.known_sentences) == {"Revenue grew strongly", "Costs were flat"}
+        session.apply_patch(0, len(session.text), "Demand is stable.")
+        await session.score()
+    assert set(session.known_sentences) == {"Demand is stable"}
+
+def test_live_editor_rejects_invalid_token(client, test_document):
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/docs/{test_document.id}/live?token=invalid") as websocket:
+            websocket.receive_json()
+
+def test_sentence_heatmap_from_storage(client, test_tokens):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    text = "Revenue grew strongly. Costs were flat.\n\nWe expect stable demand."
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Heatmap", "text": text}, headers=headers).json()["id"]
+
+    with patch('api_project.processing.fetch_sentence_scores') as mock_fetch:
+        response = client.get(f"/docs/{doc_id}/heatmap", headers=headers)
+        mock_fetch.assert_not_called()
+
+    assert response.status_code == 200
+    sentences = response.json()["sentences"]
+    assert [s["text"] for s in sentences] == ["Revenue grew strongly", "Costs were flat", "We expect stable demand"]
+    assert all(text[s["start"]:s["end"]] == s["text"] for s in sentences)
+    assert sentences[0]["tone"]["Positive"] == 0.6
+    assert sentences[0]["score"] == 85.5
+
+    distribution = response.json()["distribution"]
+    assert distribution["sentence_count"] == 3
+    assert distribution["percentiles"]["p50"] == 85.5
+    assert distribution["negative_share"] == 0.0
+    assert distribution["score_variance"] == 0.0
+
+def test_recompute_scores_from_stored_sentences(client, test_tokens, test_db):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.processing.fetch_sentence_scores', side_effect=_fake_sentence_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Recompute", "text": "Revenue grew. Costs fell."}, headers=headers).json()["id"]
+
+    chunk = test_db.query(TextChunks).filter_by(document_id=doc_id).first()
+    original = chunk.final_score.score
+    scores_etag = client.get(f"/docs/scores/{doc_id}", headers=headers).headers["ETag"]
+
+    # A new formula version that only counts tone
+    tone_only = ScoringFormula(
+        sentence_scores=lambda probabilities: probabilities[:, 0] * 100,
+        compute_scores=lambda probabilities: [round(float(probabilities[:, 0].mean()) * 100, 2), 0, 0, 0]
+    )
+    with patch.dict(FORMULAS, {2: tone_only}), \
+         patch('api_project.processing.fetch_sentence_scores') as mock_fetch:
+        counts = recompute_scores(test_db, version=2)
+        mock_fetch.assert_not_called()
+
+    assert counts == {"final_updated": 1, "initial_updated": 1, "skipped": 0}
+    test_db.expire_all()
+    assert chunk.final_score.score == 60.0 and chunk.final_score.scoring_version == 2
+    assert chunk.initial_score.score == 60.0
+    # Recomputed scores are not served from a cached response
+    response = client.get(f"/docs/scores/{doc_id}", headers={**headers, "If-None-Match": scores_etag})
+    assert response.status_code == 200 and response.json()[0]["score"] == 60.0
+
+    # Rows already at the requested version are left alone
+    assert recompute_scores(test_db, version=2)["final_updated"] == 0
+    assert recompute_scores(test_db)["final_updated"] == 1
+    test_db.expire_all()
+    assert chunk.final_score.score == original
@@ -0,0 +1,139 @@
+from unittest.mock import patch, AsyncMock
+from fastapi import BackgroundTasks, FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+import json
+import logging
+import time
+from api_project.metrics import MetricsMiddleware
+from api_project.processing import TextScores
+from app import app
+
+
+def _fixed_scores(texts, known_sentences=None):
+    return [TextScores([0.8, 0.7, 0.6, 0.9], []) for _ in texts]
+
+def test_metrics_report_requests_per_route(client, test_tokens):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        doc_id = client.post("/docs", json={"title": "Metrics", "text": "Revenue grew."}, headers=headers).json()["id"]
+    client.get(f"/docs/{doc_id}", headers=headers)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    # Routes are labelled by their path template, not the concrete path
+    assert 'http_request_duration_seconds_count{method="GET",route="/docs/{doc_id}"}' in body
+    assert f'route="/docs/{doc_id}"' not in body
+    assert 'http_requests_total{method="POST",route="/docs",status="200"}' in body
+    assert 'http_requests_in_progress{method="GET",route="/metrics"} 1.0' in body
+    for name in ("finbert_dispatch_duration_seconds", "openai_tokens_total", "db_pool_checked_out", "finbert_warm_until_timestamp_seconds"):
+        assert name in body
+
+def test_server_timing_and_request_log(client, test_tokens, caplog):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}", "X-Request-ID": "req-123"}
+    with patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'), \
+         caplog.at_level(logging.INFO, logger="api_project.timing"):
+        response = client.post("/docs", json={"title": "Timed", "text": "Revenue grew. Costs fell."}, headers=headers)
+
+    assert response.status_code == 200
+    assert response.headers["x-request-id"] == "req-123"
+    phases = {part.split(";")[0] for part in response.headers["server-timing"].split(", ")}
+    assert {"warmup", "chunking", "scoring", "db", "db_commit", "app"} <= phases
+
+    records = [json.loads(record.getMessage()) for record in caplog.records if record.name == "api_project.timing"]
+    record = next(record for record in records if record["request_id"] == "req-123")
+    assert record["route"] == "/docs" and record["status"] == 200
+    assert record["spans"]["db_commit"]["count"] >= 2
+
+    # Requests without an id get a generated one
+    assert len(client.get("/metrics").headers["x-request-id"]) == 32
+
+def _slow_scores(texts, known_sentences=None):
+    time.sleep(0.1)
+    return _fixed_scores(texts)
+
+def test_profiling_requested_with_token(client, test_tokens, tmp_path):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    with patch('api_project.profiling.PROFILING_TOKEN', 'secret'), \
+         patch('api_project.profiling.PROFILE_DIR', str(tmp_path)), \
+         patch('api_project.chunks.score_texts', side_effect=_slow_scores), \
+         patch('api_project.routes.documents.ensure_model_warm'):
+        # A wrong token is ignored: the request is served but not profiled
+        response = client.post("/docs", json={"title": "Plain", "text": "Revenue grew."}, headers={**headers, "X-Profile": "wrong"})
+        assert response.status_code == 200
+        assert "x-profile-url" not in response.headers
+
+        response = client.post("/docs?profile=secret", json={"title": "Profiled", "text": "Revenue grew."}, headers=headers)
+        assert response.status_code == 200
+        profile_url = response.headers["x-profile-url"]
+
+        assert client.get(profile_url).status_code == 403
+        assert client.get("/profiles/" + "0" * 32, headers={"X-Profile": "secret"}).status_code == 404
+        profile = client.get(profile_url, headers={"X-Profile": "secret"}).json()
+
+    assert profile["path"] == "/docs" and profile["status"] == 200 and profile["mode"] == "requested"
+    assert sum(profile["samples"].values()) > 0
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in profile["collapsed_stacks"])
+    assert isinstance(profile["memory"], list)
+
+def test_profiling_sample_rate(client, tmp_path):
+    with patch('api_project.profiling.PROFILE_SAMPLE_RATE', 1.0), \
+         patch('api_project.profiling.PROFILE_DIR', str(tmp_path)):
+        response = client.get("/metrics")
+
+    # Sampled requests are stored without a link or a memory diff
+    assert "x-profile-url" not in response.headers
+    [stored] = list(tmp_path.glob("*.json"))
+    profile = json.loads(stored.read_text())
+    assert profile["mode"] == "sampled" and profile["memory"] is None
+
+def test_loop_watchdog_reports_blocking_route(test_db, test_tokens, caplog):
+    def blocking_warmup():
+        # Synchronous sleep inside the request's coroutine stalls the event loop
+        time.sleep(0.3)
+        return True
+
+    with patch('api_project.loop_watchdog.LOOP_BLOCK_THRESHOLD_MS', 50), \
+         patch('api_project.loop_watchdog.LOOP_WATCHDOG_INTERVAL_MS', 10), \
+         patch('api_project.chunks.score_texts', side_effect=_fixed_scores), \
+         patch('api_project.routes.documents.ensure_model_warm', AsyncMock(side_effect=blocking_warmup)), \
+         caplog.at_level(logging.WARNING, logger="api_project.loop_watchdog"):
+        # Entering the client runs the startup handlers, which start the watchdog
+        with TestClient(app) as client:
+            headers = {"Authorization": f"Bearer {test_tokens['access_token']}", "X-Request-ID": "stall-1"}
+            assert client.post("/docs", json={"title": "Stall", "text": "Revenue grew."}, headers=headers).status_code == 200
+            body = client.get("/metrics").text
+
+    [record] = [json.loads(r.getMessage()) for r in caplog.records if r.name == "api_project.loop_watchdog"]
+    assert record["route"] == "POST /docs" and record["request_id"] == "stall-1"
+    assert record["blocked_ms"] >= 250
+    assert any("blocking_warmup" in line for line in record["stack"])
+    assert 'event_loop_blocked_total{route="POST /docs"} 1.0' in body
+    assert "event_loop_lag_seconds_count" in body
+
+def test_request_latency_excludes_background_tasks():
+    background_app = FastAPI()
+    background_app.add_middleware(MetricsMiddleware)
+    in_progress_during_task = []
+
+    def slow_task():
+        time.sleep(0.3)
+        in_progress_during_task.append(REGISTRY.get_sample_value(
+            'http_requests_in_progress', {'method': 'POST', 'route': '/background'}))
+
+    @background_app.post("/background")
+    def with_background_task(background_tasks: BackgroundTasks):
+        background_tasks.add_task(slow_task)
+        return {}
+
+    labels = {'method': 'POST', 'route': '/background'}
+    assert TestClient(background_app).post("/background").status_code == 200
+
+    # The response was complete before the task ran, so neither includes it
+    assert in_progress_during_task == [0.0]
+    assert REGISTRY.get_sample_value('http_request_duration_seconds_count', labels) == 1.0
+    assert REGISTRY.get_sample_value('http_request_duration_seconds_sum', labels) < 0.3
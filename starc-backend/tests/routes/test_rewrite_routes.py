@@ -1,6 +1,10 @@
 import pytest
-from unittest.mock import patch, AsyncMock, Mock
-from api_project.models import TextChunks, Suggestion, Document
+import asyncio
+from unittest.mock import patch, AsyncMock
+from api_project.models import TextChunks, Suggestion, Document, User
+from api_project.processing import TextScores
+from api_project.suggestions import generate_document_suggestions
+from sqlalchemy.orm import sessionmaker
 
 @pytest.fixture
 def test_document(test_db, test_user):
@@ -66,13 +70,11 @@ def test_delete_suggestion(client, test_tokens, test_suggestion):
 
 @pytest.mark.asyncio
 async def test_rewrite_text(client, test_tokens, test_text_chunk):
-    # Create a regular mock for the synchronous function
-    mock_rewrite = Mock(return_value="Rewritten text")
-    # Create an async mock for the async function
-    mock_scores = AsyncMock(return_value=[0.8, 0.7, 0.6, 0.9])
+    mock_rewrite = AsyncMock(return_value="Rewritten text")
+    mock_scores = AsyncMock(return_value=[TextScores([0.8, 0.7, 0.6, 0.9], [])])
 
     with patch('api_project.routes.rewrites.rewrite_text_with_prompt', mock_rewrite), \
-         patch('api_project.routes.rewrites.get_scoresSA', mock_scores):
+         patch('api_project.chunks.score_texts', mock_scores):
         response = client.post(
             f"/fix/{test_text_chunk.document_id}/rewrite",
             json={"prompt": "Make it better"},
@@ -85,4 +87,218 @@ async def test_rewrite_text(client, test_tokens, test_text_chunk):
         assert data["scores"] == [0.8, 0.7, 0.6, 0.9]
 
         # Verify the mock was called correctly
-        mock_rewrite.assert_called_once_with(test_text_chunk.input_text_chunk, "Make it better") 
\ No newline at end of file
+        mock_rewrite.assert_called_once_with(test_text_chunk.input_text_chunk, "Make it better") 
+
+def test_get_suggestions_not_modified_until_deleted(client, test_tokens, test_suggestion):
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    url = f"/fix/{test_suggestion.document_id}/suggestions"
+
+    etag = client.get(url, headers=headers).headers["ETag"]
+    assert client.get(url, headers={**headers, "If-None-Match": etag}).status_code == 304
+
+    client.delete(f"{url}/{test_suggestion.id}", headers=headers)
+    response = client.get(url, headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json() == []
+
+def test_rewrite_single_chunk(client, test_tokens, test_db, test_document):
+    first = TextChunks(document_id=test_document.id, position=0, input_text_chunk="First part.\n\n", rewritten_text="First part.\n\n")
+    second = TextChunks(document_id=test_document.id, position=1, input_text_chunk="Second part.", rewritten_text="Second part.")
+    test_db.add_all([first, second])
+    test_db.commit()
+
+    mock_rewrite = AsyncMock(return_value="First part, improved.")
+    mock_scores = AsyncMock(return_value=[TextScores([0.8, 0.7, 0.6, 0.9], [])])
+    with patch('api_project.routes.rewrites.rewrite_text_with_prompt', mock_rewrite), \
+         patch('api_project.chunks.score_texts', mock_scores):
+        response = client.post(
+            f"/fix/{test_document.id}/chunks/{first.id}/rewrite",
+            json={"prompt": "Make it better"},
+            headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+        )
+
+    assert response.status_code == 200
+    data = response.json()
+    # The paragraph break after the chunk survives the rewrite
+    assert data["rewritten_text"] == "First part, improved.\n\n"
+    assert data["scores"] == [0.8, 0.7, 0.6, 0.9]
+    mock_rewrite.assert_called_once_with("First part.\n\n", "Make it better")
+    mock_scores.assert_called_once()
+    assert mock_scores.call_args[0][0] == ["First part, improved.\n\n"]
+
+def test_apply_suggestions_batch(client, test_tokens, test_db, test_document):
+    chunk = TextChunks(document_id=test_document.id, input_text_chunk="Revenue grew. Costs were flat.", rewritten_text="Revenue grew. Costs were flat.")
+    suggestions = [
+        Suggestion(document_id=test_document.id, input_text_chunk="Revenue grew", rewritten_text="Revenue grew strongly"),
+        Suggestion(document_id=test_document.id, input_text_chunk="Costs were flat", rewritten_text="Costs fell"),
+        Suggestion(document_id=test_document.id, input_text_chunk="Margins held", rewritten_text="Margins widened"),
+    ]
+    test_db.add_all([chunk, *suggestions])
+    test_db.commit()
+    ids = [suggestion.id for suggestion in suggestions]
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+
+    response = client.put(f"/fix/{test_document.id}/suggestions/apply", json={"suggestion_ids": [ids[0], 9999]}, headers=headers)
+    assert response.status_code == 404
+
+    mock_scores = AsyncMock(return_value=[TextScores([0.8, 0.7, 0.6, 0.9], [])])
+    with patch('api_project.chunks.score_texts', mock_scores):
+        response = client.put(f"/fix/{test_document.id}/suggestions/apply", json={"suggestion_ids": ids}, headers=headers)
+
+    assert response.status_code == 200
+    data = response.json()
+    # Both applications are kept and the chunk is rescored once
+    assert data["updated_text"] == "Revenue grew strongly. Costs fell."
+    assert data["applied"] == ids[:2] and data["skipped"] == [ids[2]]
+    assert data["scores"] == [0.8, 0.7, 0.6, 0.9]
+    mock_scores.assert_called_once()
+    assert test_db.query(Suggestion).filter_by(document_id=test_document.id).count() == 0
+
+def test_apply_suggestion_replaces_first_occurrence_only(client, test_tokens, test_db, test_document):
+    chunk = TextChunks(document_id=test_document.id, input_text_chunk="Sales rose. Costs rose. Sales rose.", rewritten_text="Sales rose. Costs rose. Sales rose.")
+    suggestion = Suggestion(document_id=test_document.id, input_text_chunk="Sales rose", rewritten_text="Sales climbed")
+    test_db.add_all([chunk, suggestion])
+    test_db.commit()
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+
+    with patch('api_project.chunks.score_texts', AsyncMock(return_value=[TextScores([0.8, 0.7, 0.6, 0.9], [])])):
+        response = client.put(f"/fix/{test_document.id}/suggestions/{suggestion.id}", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["updated_text"] == "Sales climbed. Costs rose. Sales rose."
+
+def test_suggestions_of_other_users_documents_are_not_found(client, test_tokens, test_db):
+    owner = User(username="owner", email="owner@example.com")
+    owner.set_password("password123")
+    test_db.add(owner)
+    test_db.commit()
+    document = Document(title="Not yours", user_id=owner.id, word_count=2)
+    test_db.add(document)
+    test_db.commit()
+    chunk = TextChunks(document_id=document.id, input_text_chunk="Original text", rewritten_text="Original text")
+    suggestion = Suggestion(document_id=document.id, input_text_chunk="Original text", rewritten_text="Suggested text")
+    test_db.add_all([chunk, suggestion])
+    test_db.commit()
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+
+    assert client.put(f"/fix/{document.id}/suggestions/{suggestion.id}", headers=headers).status_code == 404
+    assert client.delete(f"/fix/{document.id}/suggestions/{suggestion.id}", headers=headers).status_code == 404
+    test_db.refresh(chunk)
+    assert chunk.rewritten_text == "Original text"
+    assert test_db.get(Suggestion, suggestion.id) is not None
+
+def test_generate_suggestions_in_background(client, test_tokens, test_db, test_document, no_llm_suggestions):
+    paragraphs = ["Revenue grew. Costs were flat.\n\n", "Margins held."]
+    test_db.add_all([
+        TextChunks(document_id=test_document.id, position=position, input_text_chunk=text, rewritten_text=text)
+        for position, text in enumerate(paragraphs)
+    ])
+    test_db.commit()
+
+    async def fake_suggestions(paragraph):
+        if paragraph.startswith("Revenue"):
+            return [{"original": "Revenue grew", "suggested": "Revenue grew strongly"},
+                    {"original": "Not in the text", "suggested": "Ignored"}]
+        return [{"original": "Margins held", "suggested": "Margins held steady"}]
+    no_llm_suggestions.side_effect = fake_suggestions
+
+    headers = {"Authorization": f"Bearer {test_tokens['access_token']}"}
+    url = f"/fix/{test_document.id}/suggestions"
+    etag = client.get(url, headers=headers).headers["ETag"]
+
+    response = client.post(url, headers=headers)
+    assert response.status_code == 202
+    assert no_llm_suggestions.call_count == 2
+    # The job committed through its own sessions; the tests' shared request session still caches the document
+    test_db.expire_all()
+
+    # Each stored batch bumps the document version, so cached lists are invalidated
+    response = client.get(url, headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert "X-Suggestions-Pending" not in response.headers
+    assert sorted(s["rewritten_text"] for s in response.json()) == ["Margins held steady", "Revenue grew strongly"]
+
+@pytest.mark.asyncio
+async def test_suggestion_job_uses_its_own_sessions(test_db, test_document, no_llm_suggestions):
+    test_db.add_all([
+        TextChunks(document_id=test_document.id, position=position, input_text_chunk=text, rewritten_text=text)
+        for position, text in enumerate(["Revenue grew.", "Margins held."])
+    ])
+    test_db.commit()
+    no_llm_suggestions.side_effect = lambda paragraph: [{"original": paragraph[:-1], "suggested": paragraph[:-1] + " strongly"}]
+
+    sessions = []
+    def session_factory():
+        sessions.append(sessionmaker(bind=test_db.get_bind())())
+        return sessions[-1]
+
+    with patch('api_project.suggestions.SessionLocal', session_factory):
+        assert await generate_document_suggestions(test_document.id) == 2
+
+    # One session to read the paragraphs and one per stored batch, none held across the LLM calls
+    assert len(sessions) == 3
+    assert test_db.query(Suggestion).filter_by(document_id=test_document.id).count() == 2
+
+def test_rewrite_best_of_n_candidates(client, test_tokens, test_db, test_document):
+    chunk = TextChunks(document_id=test_document.id, position=0, input_text_chunk="Sales fell.", rewritten_text="Sales fell.")
+    test_db.add(chunk)
+    test_db.commit()
+
+    mock_rewrite = AsyncMock(side_effect=["Sales eased.", "Sales dipped slightly.", "Sales were resilient."])
+    overall = {"Sales eased.": 0.5, "Sales dipped slightly.": 0.4, "Sales were resilient.": 0.9}
+    mock_scores = AsyncMock(side_effect=lambda texts, known_sentences=None: [TextScores([overall[text], 0.5, 0.5, 0.5], []) for text in texts])
+    with patch('api_project.routes.rewrites.rewrite_text_with_prompt', mock_rewrite), \
+         patch('api_project.chunks.score_texts', mock_scores):
+        response = client.post(
+            f"/fix/{test_document.id}/chunks/{chunk.id}/rewrite",
+            json={"prompt": "Make it better", "candidates": 3},
+            headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+        )
+
+    assert response.status_code == 200
+    data = response.json()
+    # All candidates are scored in one dispatch and the best one is kept
+    assert mock_rewrite.call_count == 3
+    mock_scores.assert_called_once()
+    assert [c["rewritten_text"] for c in data["candidates"]] == ["Sales were resilient.", "Sales eased.", "Sales dipped slightly."]
+    assert data["rewritten_text"] == "Sales were resilient."
+    assert data["scores"] == [0.9, 0.5, 0.5, 0.5]
+    test_db.refresh(chunk)
+    assert chunk.rewritten_text == "Sales were resilient." and chunk.final_score.score == 0.9
+
+    response = client.post(
+        f"/fix/{test_document.id}/rewrite",
+        json={"prompt": "Make it better", "candidates": 10},
+        headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+    )
+    assert response.status_code == 400
+
+def test_rewrite_candidates_limit_concurrent_requests(client, test_tokens, test_db, test_document):
+    test_db.add_all([
+        TextChunks(document_id=test_document.id, position=i, input_text_chunk=f"Part {i}.", rewritten_text=f"Part {i}.")
+        for i in range(3)
+    ])
+    test_db.commit()
+
+    in_flight = peak = 0
+
+    async def slow_rewrite(text, prompt):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return text.replace("Part", "Section")
+
+    mock_scores = AsyncMock(side_effect=lambda texts, known_sentences=None: [TextScores([0.5, 0.5, 0.5, 0.5], []) for text in texts])
+    with patch('api_project.routes.rewrites.rewrite_text_with_prompt', side_effect=slow_rewrite) as mock_rewrite, \
+         patch('api_project.routes.rewrites.REWRITE_CONCURRENCY', 2), \
+         patch('api_project.chunks.score_texts', mock_scores):
+        response = client.post(
+            f"/fix/{test_document.id}/rewrite",
+            json={"prompt": "Make it better", "candidates": 4},
+            headers={"Authorization": f"Bearer {test_tokens['access_token']}"}
+        )
+
+    assert response.status_code == 200
+    assert mock_rewrite.call_count == 12
+    assert peak == 2